@@ -0,0 +1,110 @@
+"""
+Measure login throughput of the auth service and its effect on /validate.
+
+The script first probes `POST /validate` with a valid token on an idle
+service to get a baseline, then probes it again while `--concurrency`
+clients log in back to back for `--duration` seconds. Reported: logins/s
+by status, and the /validate latency percentiles of both phases. With
+password hashing on the event loop, /validate p99 grows to the bcrypt time
+times the number of queued logins; with the bounded executor it should stay
+close to baseline.
+
+Repeated logins with the right password are served from the credential
+cache after the first one. Use `--wrong-password` (every attempt runs
+bcrypt) or start the service with PASSWORD_CACHE_TTL=0 to measure raw
+hashing throughput.
+
+Usage:
+    python benchmarks/auth_login_load.py --url http://localhost:5000 \\
+        --user admin@acn.com --password acn12 --concurrency 64 --duration 20
+"""
+import argparse
+import asyncio
+import collections
+import statistics
+import time
+
+import httpx
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def report(label, latencies):
+    print(f"{label}: n={len(latencies)} "
+          f"p50={percentile(latencies, 50) * 1000:.1f}ms "
+          f"p95={percentile(latencies, 95) * 1000:.1f}ms "
+          f"p99={percentile(latencies, 99) * 1000:.1f}ms "
+          f"max={max(latencies) * 1000:.1f}ms "
+          f"mean={statistics.mean(latencies) * 1000:.1f}ms")
+
+
+async def probe_validate(client, url, token, stop, interval):
+    latencies = []
+    headers = {"Authorization": f"Bearer {token}"}
+    while not stop.is_set():
+        started = time.perf_counter()
+        response = await client.post(f"{url}/validate", headers=headers)
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - started)
+        await asyncio.sleep(interval)
+    return latencies
+
+
+async def login_loop(client, url, auth, stop, statuses, latencies):
+    while not stop.is_set():
+        started = time.perf_counter()
+        response = await client.post(f"{url}/login", auth=auth)
+        latencies.append(time.perf_counter() - started)
+        statuses[response.status_code] += 1
+
+
+async def timed_probe(client, args, token, seconds):
+    stop = asyncio.Event()
+    probe = asyncio.create_task(probe_validate(client, args.url, token, stop, args.interval))
+    await asyncio.sleep(seconds)
+    stop.set()
+    return await probe
+
+
+async def main(args):
+    limits = httpx.Limits(max_connections=args.concurrency + 4)
+    async with httpx.AsyncClient(timeout=httpx.Timeout(None), limits=limits) as client:
+        response = await client.post(f"{args.url}/login", auth=(args.user, args.password))
+        response.raise_for_status()
+        token = response.json()["token"]
+
+        report("validate idle", await timed_probe(client, args, token, args.baseline))
+
+        stop = asyncio.Event()
+        statuses = collections.Counter()
+        login_latencies = []
+        password = args.password + "-wrong" if args.wrong_password else args.password
+        logins = [asyncio.create_task(login_loop(client, args.url, (args.user, password), stop, statuses, login_latencies))
+                  for _ in range(args.concurrency)]
+        started = time.perf_counter()
+        loaded = await timed_probe(client, args, token, args.duration)
+        stop.set()
+        await asyncio.gather(*logins)
+        elapsed = time.perf_counter() - started
+
+        report(f"validate during {args.concurrency} login clients", loaded)
+        report("login", login_latencies)
+        for status, count in sorted(statuses.items()):
+            print(f"login status {status}: {count} ({count / elapsed:.1f}/s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--user", default="admin@acn.com")
+    parser.add_argument("--password", default="acn12")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=20, help="seconds of login load")
+    parser.add_argument("--baseline", type=float, default=5, help="seconds of idle /validate probing")
+    parser.add_argument("--interval", type=float, default=0.02)
+    parser.add_argument("--wrong-password", action="store_true", help="every login fails and runs bcrypt")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,98 @@
+"""
+Measure `POST /validate` requests/s of the auth service with production
+mode (AUTH_PRODUCTION_MODE) off and on.
+
+Each mode runs in a fresh subprocess, since the mode is read at import. The
+service app is driven in-process through httpx's ASGI transport with
+stderr redirected to /dev/null, so the numbers are the service's own cost
+per request (routing, JWT decode and logging) without network or
+database; the startup hook does not run and tokens are HS256-signed with
+JWT_SECRET. `--invalid` makes a share of the requests use a bad
+signature, which is always logged in full.
+
+Usage:
+    python benchmarks/auth_validate_throughput.py --requests 20000 --concurrency 32
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# name -> environment of the run
+CONFIGS = {
+    "debug": {"AUTH_PRODUCTION_MODE": "false"},
+    "production": {"AUTH_PRODUCTION_MODE": "true"},
+}
+
+
+async def drive(app, token, bad_token, args):
+    import httpx
+
+    every = round(1 / args.invalid) if args.invalid else 0
+
+    async def worker(n, statuses):
+        for i in range(n):
+            use_bad = every and i % every == 0
+            response = await client.post("/validate", headers={
+                "Authorization": f"Bearer {bad_token if use_bad else token}"})
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    statuses = {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://auth") as client:
+        # Warm up routing and the JWT code paths
+        await worker(50, {})
+        per_worker = args.requests // args.concurrency
+        started = time.perf_counter()
+        await asyncio.gather(*[worker(per_worker, statuses) for _ in range(args.concurrency)])
+        elapsed = time.perf_counter() - started
+    return per_worker * args.concurrency, elapsed, statuses
+
+
+def run_config(args):
+    """Serve /validate in this process and print the timings as JSON"""
+    sys.path.insert(0, ROOT)
+    sys.path.insert(0, os.path.join(ROOT, "src", "auth-service"))
+    # The handlers write to fd 2; keep the real writes but discard the output
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 2)
+
+    import server
+    secret = os.environ.setdefault("JWT_SECRET", "test_secret")
+    token = server.create_jwt("bench@acn.com", secret, True)
+    bad_token = server.create_jwt("bench@acn.com", secret + "-wrong", True)
+
+    requests, elapsed, statuses = asyncio.run(drive(server.app, token, bad_token, args))
+    print(json.dumps({"requests": requests, "seconds": elapsed, "statuses": statuses}))
+
+
+def main(args):
+    print(f"{'mode':<12}{'requests':>10}{'req/s':>10}  statuses")
+    for name in args.configs:
+        env = dict(os.environ, **CONFIGS[name])
+        command = [sys.executable, __file__, "--run-config", name, "--requests", str(args.requests),
+                   "--concurrency", str(args.concurrency), "--invalid", str(args.invalid)]
+        result = json.loads(subprocess.run(
+            command, check=True, capture_output=True, text=True, env=env,
+        ).stdout.strip().splitlines()[-1])
+        print(f"{name:<12}{result['requests']:>10}{result['requests'] / result['seconds']:>10,.0f}  "
+              f"{result['statuses']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--invalid", type=float, default=0.0, help="fraction of requests with a bad signature")
+    parser.add_argument("--configs", nargs="+", choices=list(CONFIGS), default=list(CONFIGS))
+    parser.add_argument("--run-config", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_config:
+        run_config(args)
+    else:
+        main(args)
@@ -0,0 +1,122 @@
+"""
+Compare the converter's audio extraction engines (ffmpeg vs moviepy).
+
+Each engine runs in a fresh subprocess against an in-memory stand-in for the
+GridFS video/MP3 files, and the script reports wall time, CPU time (including
+ffmpeg child processes) and peak RSS for that run. The input defaults to the
+bundled assets/video.mp4; `--repeat N` loops it N times with ffmpeg first to
+get a longer video.
+
+Usage:
+    python benchmarks/converter_engines.py --repeat 20
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+DEFAULT_INPUT = os.path.join(ROOT, "assets", "video.mp4")
+
+
+class FakeGridOut:
+    """Read side of a GridFS file, backed by a local file"""
+
+    def __init__(self, path):
+        self._f = open(path, "rb")
+
+    def read(self, n=-1):
+        return self._f.read(n)
+
+    def seek(self, pos):
+        self._f.seek(pos)
+
+    def close(self):
+        self._f.close()
+
+
+class FakeGridIn:
+    """Write side of a GridFS file that only counts bytes"""
+
+    def __init__(self):
+        self.length = 0
+
+    def write(self, data):
+        self.length += len(data)
+
+
+class QuietLogger:
+    def info(self, *args, **kwargs):
+        pass
+
+    debug = warning = error = info
+
+
+def run_engine(name, path):
+    """Run one engine in this process and print its measurements as JSON"""
+    # The engines import src.common, so the repository root goes on the path too
+    sys.path[:0] = [os.path.join(ROOT, "src", "converter-service"), ROOT]
+    from convert import engines
+
+    video = FakeGridOut(path)
+    mp3 = FakeGridIn()
+    started = time.perf_counter()
+    engines.get_engine(name).extract(video, mp3, QuietLogger(), "bench")
+    wall = time.perf_counter() - started
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    print(json.dumps({
+        "engine": name,
+        "wall_seconds": wall,
+        "cpu_seconds": own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mib": own.ru_maxrss / 1024,
+        "peak_child_rss_mib": children.ru_maxrss / 1024,
+        "mp3_bytes": mp3.length,
+    }))
+
+
+def make_input(path, repeat, workdir):
+    if repeat <= 1:
+        return path
+    looped = os.path.join(workdir, f"video_x{repeat}.mp4")
+    subprocess.run(
+        ["ffmpeg", "-v", "error", "-y", "-stream_loop", str(repeat - 1), "-i", path,
+         "-c", "copy", looped],
+        check=True,
+    )
+    return looped
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        path = make_input(args.input, args.repeat, workdir)
+        print(f"input: {path} ({os.path.getsize(path) / 1024 / 1024:.1f} MiB)")
+        print(f"{'engine':<10}{'wall s':>10}{'cpu s':>10}{'rss MiB':>10}{'child MiB':>11}{'mp3 MiB':>10}")
+        for name in args.engines:
+            output = subprocess.run(
+                [sys.executable, __file__, "--run-engine", name, "--input", path],
+                check=True, capture_output=True, text=True,
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{name:<10}{result['wall_seconds']:>10.2f}{result['cpu_seconds']:>10.2f}"
+                  f"{result['peak_rss_mib']:>10.1f}{result['peak_child_rss_mib']:>11.1f}"
+                  f"{result['mp3_bytes'] / 1024 / 1024:>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", default=DEFAULT_INPUT)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--engines", nargs="+", default=["ffmpeg", "moviepy"])
+    parser.add_argument("--run-engine", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_engine:
+        run_engine(args.run_engine, args.input)
+    else:
+        main(args)
@@ -0,0 +1,113 @@
+"""
+Measure how segment-parallel MP3 encoding scales with the number of cores.
+
+The bundled assets/video.mp4 is looped with ffmpeg to each length given by
+`--repeat`, then converted by the "segmented" engine once per `--jobs` value
+(CONVERTER_SEGMENT_JOBS), each run in a fresh subprocess. Reported per run:
+wall time, speedup over the first `--jobs` value, and a check of the seams.
+Every output is decoded back to PCM and compared with the first run's
+output: the sample counts must match exactly, and the SNR shows how close
+the audio is.
+
+Usage:
+    python benchmarks/converter_segments.py --repeat 60 240 --jobs 1 2 4 8
+"""
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from converter_engines import DEFAULT_INPUT, ROOT, FakeGridOut, QuietLogger, make_input
+
+
+class FileGridIn:
+    """Write side of a GridFS file, backed by a local file"""
+
+    def __init__(self, path):
+        self._f = open(path, "wb")
+        self.length = 0
+
+    def write(self, data):
+        self._f.write(data)
+        self.length += len(data)
+
+    def close(self):
+        self._f.close()
+
+
+def run_engine(path, output):
+    """Convert `path` to `output` in this process and print the timing as JSON"""
+    # The engines import src.common, so the repository root goes on the path too
+    sys.path[:0] = [os.path.join(ROOT, "src", "converter-service"), ROOT]
+    from convert import engines
+
+    video = FakeGridOut(path)
+    mp3 = FileGridIn(output)
+    started = time.perf_counter()
+    engines.get_engine("segmented").extract(video, mp3, QuietLogger(), "bench")
+    wall = time.perf_counter() - started
+    mp3.close()
+    print(json.dumps({"wall_seconds": wall, "mp3_bytes": mp3.length}))
+
+
+def decode(path):
+    """Decode an MP3 to 16-bit PCM samples"""
+    pcm = subprocess.run(
+        ["ffmpeg", "-v", "error", "-i", path, "-f", "s16le", "-c:a", "pcm_s16le", "pipe:1"],
+        check=True, capture_output=True,
+    ).stdout
+    return memoryview(pcm).cast("h")
+
+
+def snr_db(reference, other):
+    signal = sum(s * s for s in reference[::7])
+    noise = sum((a - b) ** 2 for a, b in zip(reference[::7], other[::7]))
+    return math.inf if noise == 0 else 10 * math.log10(signal / noise)
+
+
+def main(args):
+    print(f"{'repeat':>7}{'jobs':>6}{'wall s':>10}{'speedup':>9}{'samples':>14}{'match':>7}{'snr dB':>9}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for repeat in args.repeat:
+            path = make_input(args.input, repeat, workdir)
+            baseline_wall = reference = None
+            for jobs in args.jobs:
+                output = os.path.join(workdir, f"x{repeat}_j{jobs}.mp3")
+                env = dict(os.environ, CONVERTER_SEGMENT_JOBS=str(jobs),
+                           CONVERTER_SEGMENT_MIN_BYTES="0",
+                           CONVERTER_SEGMENT_MIN_SECONDS=str(args.min_seconds))
+                result = json.loads(subprocess.run(
+                    [sys.executable, __file__, "--run-engine", "--input", path, "--output", output],
+                    check=True, capture_output=True, text=True, env=env,
+                ).stdout.strip().splitlines()[-1])
+
+                samples = decode(output)
+                if reference is None:
+                    baseline_wall, reference = result["wall_seconds"], samples
+                match = len(samples) == len(reference)
+                snr = snr_db(reference, samples)
+                print(f"{repeat:>7}{jobs:>6}{result['wall_seconds']:>10.2f}"
+                      f"{baseline_wall / result['wall_seconds']:>9.2f}{len(samples):>14}"
+                      f"{'yes' if match else 'NO':>7}{snr:>9.1f}")
+            if path != args.input:
+                os.remove(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", default=DEFAULT_INPUT)
+    parser.add_argument("--repeat", type=int, nargs="+", default=[10, 60])
+    parser.add_argument("--jobs", type=int, nargs="+", default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    parser.add_argument("--min-seconds", type=float, default=10,
+                        help="CONVERTER_SEGMENT_MIN_SECONDS for the runs")
+    parser.add_argument("--run-engine", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_engine:
+        run_engine(args.input, args.output)
+    else:
+        main(args)
@@ -0,0 +1,97 @@
+"""
+Measure latency of the gateway index page (`GET /`) while large uploads run.
+
+The script first probes `/` on an idle gateway to get a baseline, then probes
+it again while `--uploads` concurrent uploads of `--upload-mb` MiB are being
+streamed to `/upload`. With blocking pymongo calls inside async handlers the
+p99 of the second phase explodes; with Motor it should stay close to baseline.
+
+Usage:
+    python benchmarks/gateway_root_latency.py --url http://localhost:8080 \\
+        --uploads 4 --upload-mb 512 --probes 200
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+import httpx
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def report(label, latencies):
+    print(f"{label}: n={len(latencies)} "
+          f"p50={percentile(latencies, 50) * 1000:.1f}ms "
+          f"p95={percentile(latencies, 95) * 1000:.1f}ms "
+          f"p99={percentile(latencies, 99) * 1000:.1f}ms "
+          f"max={max(latencies) * 1000:.1f}ms "
+          f"mean={statistics.mean(latencies) * 1000:.1f}ms")
+
+
+async def probe_root(client, url, probes, interval):
+    latencies = []
+    for _ in range(probes):
+        started = time.perf_counter()
+        response = await client.get(f"{url}/")
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - started)
+        await asyncio.sleep(interval)
+    return latencies
+
+
+class RandomVideo:
+    """File-like object that produces `size` pseudo-random bytes lazily."""
+
+    def __init__(self, size, block=1024 * 1024):
+        self.remaining = size
+        self.block = os.urandom(block)
+
+    def read(self, n=-1):
+        if self.remaining <= 0:
+            return b""
+        n = len(self.block) if n is None or n < 0 else min(n, len(self.block))
+        n = min(n, self.remaining)
+        self.remaining -= n
+        return self.block[:n]
+
+
+async def upload(client, url, size):
+    files = {"file": ("bench.mp4", RandomVideo(size), "video/mp4")}
+    started = time.perf_counter()
+    response = await client.post(f"{url}/upload", files=files)
+    response.raise_for_status()
+    return time.perf_counter() - started
+
+
+async def main(args):
+    timeout = httpx.Timeout(None)
+    async with httpx.AsyncClient(timeout=timeout) as client:
+        baseline = await probe_root(client, args.url, args.probes, args.interval)
+        report("idle", baseline)
+
+        size = args.upload_mb * 1024 * 1024
+        uploads = [asyncio.create_task(upload(client, args.url, size)) for _ in range(args.uploads)]
+        # Give the uploads a moment to reach the GridFS write loop
+        await asyncio.sleep(1)
+        loaded = await probe_root(client, args.url, args.probes, args.interval)
+        report(f"during {args.uploads}x{args.upload_mb}MiB uploads", loaded)
+
+        durations = await asyncio.gather(*uploads)
+        for duration in durations:
+            print(f"upload: {size / duration / 1024 / 1024:.1f} MiB/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--uploads", type=int, default=4)
+    parser.add_argument("--upload-mb", type=int, default=512)
+    parser.add_argument("--probes", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=0.05)
+    asyncio.run(main(parser.parse_args()))
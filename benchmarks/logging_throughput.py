@@ -0,0 +1,119 @@
+"""
+Measure the throughput of the shared JSON logger (src/common/log).
+
+Each configuration runs in a fresh subprocess with stderr redirected to
+/dev/null and logs `--records` INFO lines carrying a few extra fields, like
+the gateway's per-request logs. Reported per configuration:
+  - caller logs/s: how fast the logging thread gets through the log calls,
+    i.e. the time taken away from the event loop
+  - total logs/s: until every record has been written
+  - dropped: records discarded by the bounded queue in async mode
+
+"before" is the formatter as it was before the async pipeline (a second
+walk over record.__dict__ and datetime.now() per record), for comparison.
+
+Usage:
+    python benchmarks/logging_throughput.py --records 200000
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# name -> environment of the run
+CONFIGS = {
+    "before": {"LOG_MODE": "sync", "LOG_JSON": "json"},
+    "sync json": {"LOG_MODE": "sync", "LOG_JSON": "json"},
+    "sync orjson": {"LOG_MODE": "sync", "LOG_JSON": "orjson"},
+    "async json": {"LOG_MODE": "async", "LOG_JSON": "json"},
+    "async orjson": {"LOG_MODE": "async", "LOG_JSON": "orjson"},
+    "async orjson 10%": {"LOG_MODE": "async", "LOG_JSON": "orjson", "LOG_SAMPLE_RATE": "0.1"},
+}
+
+
+def legacy_logger():
+    """A logger formatted the way get_custom_logger did before"""
+    from pythonjsonlogger import jsonlogger
+
+    class LegacyFormatter(jsonlogger.JsonFormatter):
+        def add_fields(self, log_record, record, message_dict):
+            super().add_fields(log_record, record, message_dict)
+            log_record['timestamp'] = datetime.datetime.now().isoformat()
+            log_record['level'] = record.levelname
+            log_record['service'] = record.name
+            if hasattr(record, 'trace_id'):
+                log_record['trace_id'] = record.trace_id
+            if hasattr(record, 'span_id'):
+                log_record['span_id'] = record.span_id
+            for key, value in getattr(record, '__dict__', {}).items():
+                if key not in ('args', 'asctime', 'created', 'exc_info', 'exc_text', 'filename',
+                               'funcName', 'id', 'levelname', 'levelno', 'lineno', 'module',
+                               'msecs', 'message', 'msg', 'name', 'pathname', 'process',
+                               'processName', 'relativeCreated', 'stack_info', 'thread', 'threadName',
+                               'trace_id', 'span_id') and not key.startswith('_'):
+                    log_record[key] = value
+
+    logger = logging.getLogger("bench-before")
+    logger.setLevel(logging.INFO)
+    handler = logging.StreamHandler()
+    handler.setFormatter(LegacyFormatter('%(timestamp)s %(level)s %(name)s %(message)s'))
+    logger.addHandler(handler)
+    return logger
+
+
+def run_config(name, records):
+    """Log `records` lines in this process and print the timings as JSON"""
+    sys.path.insert(0, ROOT)
+    # The handlers write to fd 2; keep the real writes but discard the output
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 2)
+
+    from src.common.log import custom_logger
+    logger = legacy_logger() if name == "before" else custom_logger.get_custom_logger("bench")
+    logger.propagate = False
+
+    started = time.perf_counter()
+    for i in range(records):
+        logger.info("Publishing message to video queue", extra={
+            'request_id': '0af7651916cd43dd8448eb211c80319c',
+            'file_id': '65f1c0ffee0000000000abcd',
+            'queue': 'video.small',
+            'bytes': i
+        })
+    caller = time.perf_counter() - started
+
+    dropped = sum(getattr(h, "dropped_total", 0) for h in logger.handlers)
+    custom_logger.stop_listener()
+    total = time.perf_counter() - started
+    print(json.dumps({"caller_seconds": caller, "total_seconds": total, "dropped": dropped}))
+
+
+def main(args):
+    print(f"{'config':<18}{'caller logs/s':>15}{'total logs/s':>14}{'dropped':>9}")
+    for name in args.configs:
+        env = dict(os.environ, LOG_QUEUE_SIZE=str(args.queue_size), **CONFIGS[name])
+        result = json.loads(subprocess.run(
+            [sys.executable, __file__, "--run-config", name, "--records", str(args.records)],
+            check=True, capture_output=True, text=True, env=env,
+        ).stdout.strip().splitlines()[-1])
+        print(f"{name:<18}{args.records / result['caller_seconds']:>15,.0f}"
+              f"{args.records / result['total_seconds']:>14,.0f}{result['dropped']:>9}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=100000)
+    parser.add_argument("--queue-size", type=int, default=10000, help="LOG_QUEUE_SIZE for the async runs")
+    parser.add_argument("--configs", nargs="+", choices=list(CONFIGS), default=list(CONFIGS))
+    parser.add_argument("--run-config", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run_config:
+        run_config(args.run_config, args.records)
+    else:
+        main(args)
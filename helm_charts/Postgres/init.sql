@@ -5,4 +5,28 @@ CREATE TABLE auth_user (
 );
 
 --Add Username and Password for Admin User
-INSERT INTO auth_user (email, password) VALUES ('admin@acn.com', 'acn12');
\ No newline at end of file
+--Seeded in plaintext; auth-service replaces it with a bcrypt hash at the first login
+INSERT INTO auth_user (email, password) VALUES ('admin@acn.com', 'acn12');
+
+--Notify auth-service of changed users so it can evict them from its cache
+--(auth-service also installs this at startup)
+CREATE OR REPLACE FUNCTION notify_auth_user_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        PERFORM pg_notify('auth_user_changed', '');
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('auth_user_changed', OLD.email);
+    ELSE
+        PERFORM pg_notify('auth_user_changed', NEW.email);
+        IF TG_OP = 'UPDATE' AND OLD.email <> NEW.email THEN
+            PERFORM pg_notify('auth_user_changed', OLD.email);
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER auth_user_changed AFTER INSERT OR UPDATE OR DELETE ON auth_user
+    FOR EACH ROW EXECUTE FUNCTION notify_auth_user_changed();
+CREATE TRIGGER auth_user_truncated AFTER TRUNCATE ON auth_user
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_auth_user_changed();
@@ -0,0 +1,122 @@
+import os, hmac, hashlib, asyncio
+from concurrent.futures import ThreadPoolExecutor
+import bcrypt
+
+from src.common.cache.ttl_cache import TTLCache
+
+# bcrypt work factor for new hashes; stored hashes with a lower cost are
+# upgraded at the next successful login
+BCRYPT_ROUNDS = int(os.environ.get("PASSWORD_BCRYPT_ROUNDS", 12))
+# Threads hashing at once. bcrypt releases the GIL, so logins scale with cores
+# while the event loop stays free for /validate.
+HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS") or os.cpu_count() or 1)
+# Verifications waiting for a thread before logins are turned away
+MAX_PENDING = int(os.environ.get("PASSWORD_HASH_MAX_PENDING", HASH_WORKERS * 8))
+# Seconds a verified password is remembered, so repeated logins skip bcrypt
+CACHE_TTL = float(os.environ.get("PASSWORD_CACHE_TTL", 300))
+CACHE_SIZE = int(os.environ.get("PASSWORD_CACHE_SIZE", 10000))
+
+
+class Overloaded(Exception):
+    """Too many password verifications are already waiting"""
+
+
+def is_hashed(stored):
+    return stored.startswith(("$2a$", "$2b$", "$2y$"))
+
+
+def _cost(stored):
+    # "$2b$12$<salt+hash>"
+    return int(stored.split("$")[2])
+
+
+class PasswordHasher:
+    """
+    Verifies passwords against the stored column off the event loop.
+
+    The column holds either a bcrypt hash or, for rows created before hashing
+    was introduced, the plaintext password. `verify` returns (ok, new_hash):
+    new_hash is set when the caller should store it, for a plaintext row or a
+    hash with an outdated cost.
+
+    Successful verifications are cached under an HMAC of the credentials
+    with a per-process key, together with the stored hash they matched. A
+    cache hit only counts while the stored hash is unchanged, so a password
+    change takes effect immediately.
+    """
+
+    def __init__(self, workers=HASH_WORKERS, max_pending=MAX_PENDING, rounds=BCRYPT_ROUNDS):
+        self.rounds = rounds
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._workers = workers
+        self._max_pending = max_pending
+        self._pending = 0
+        self._key = os.urandom(32)
+        self.cache = TTLCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL)
+        self.verified = 0
+        self.rejected = 0
+        self.rehashed = 0
+        self.overloaded = 0
+
+    async def _run(self, fn, *args):
+        if self._pending >= self._max_pending:
+            self.overloaded += 1
+            raise Overloaded(f"{self._pending} password verifications pending")
+        self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self._pending -= 1
+
+    def _hash(self, password):
+        return bcrypt.hashpw(password.encode(), bcrypt.gensalt(self.rounds)).decode()
+
+    def _check_and_upgrade(self, password, stored):
+        # Runs on a bcrypt thread
+        if not bcrypt.checkpw(password.encode(), stored.encode()):
+            return False, None
+        if _cost(stored) < self.rounds:
+            return True, self._hash(password)
+        return True, None
+
+    async def hash(self, password):
+        return await self._run(self._hash, password)
+
+    async def verify(self, username, password, stored):
+        key = hmac.new(self._key, f"{username}\0{password}".encode(), hashlib.sha256).digest()
+        if is_hashed(stored) and self.cache.get(key) == stored:
+            self.verified += 1
+            return True, None
+
+        if is_hashed(stored):
+            ok, new_hash = await self._run(self._check_and_upgrade, password, stored)
+        elif hmac.compare_digest(password.encode(), stored.encode()):
+            # Legacy plaintext row: accepted once, then stored as a hash
+            ok, new_hash = True, await self.hash(password)
+        else:
+            ok, new_hash = False, None
+
+        if not ok:
+            self.rejected += 1
+            return False, None
+        self.verified += 1
+        if new_hash:
+            self.rehashed += 1
+        self.cache.set(key, new_hash or stored)
+        return True, new_hash
+
+    def stats(self):
+        return {
+            'workers': self._workers,
+            'pending': self._pending,
+            'max_pending': self._max_pending,
+            'rounds': self.rounds,
+            'verified': self.verified,
+            'rejected': self.rejected,
+            'rehashed': self.rehashed,
+            'overloaded': self.overloaded,
+            'cache': self.cache.stats(),
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=False)
@@ -1,20 +1,41 @@
 import jwt, datetime, os, logging
 from typing import Optional, Dict, Any, Tuple, List
-import asyncpg
+
+import passwords
+import signing
+import users as user_store
 
 from fastapi import FastAPI, Depends, HTTPException, Header, status, Request
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.responses import JSONResponse, PlainTextResponse
+from pydantic import BaseModel
 import uvicorn
 
 # Import custom logger
 from src.common.log.custom_logger import get_custom_logger
+from src.common.metrics import prometheus as metrics
+from src.common.tracing import otel as tracing
+from opentelemetry.instrumentation.asyncpg import AsyncPGInstrumentor
+
+# Production mode drops the root DEBUG console logging and logs only one in
+# VALIDATE_LOG_SAMPLE successful validations; failures are always logged
+PRODUCTION_MODE = os.environ.get('AUTH_PRODUCTION_MODE', 'false').lower() in ('1', 'true', 'yes')
+VALIDATE_LOG_SAMPLE = max(1, int(os.environ.get('VALIDATE_LOG_SAMPLE', 100 if PRODUCTION_MODE else 1)))
 
-# Setup console logging (only for debugging)
-logging.basicConfig(level=logging.DEBUG)
+if not PRODUCTION_MODE:
+    # Setup console logging (only for debugging)
+    logging.basicConfig(level=logging.DEBUG)
+
+# Spans are exported to OTEL_EXPORTER_OTLP_ENDPOINT when it is set; the
+# gateway's traceparent header makes each request part of the caller's trace
+tracing.setup("auth-service")
+# A span per database query
+AsyncPGInstrumentor().instrument()
 
 # Initialize FastAPI app
 app = FastAPI(title="Auth Service")
+metrics.instrument_app(app)
+tracing.instrument_app(app)
 
 # Set up logger
 logger = get_custom_logger(service_name="auth-service")
@@ -22,12 +43,31 @@ logger = get_custom_logger(service_name="auth-service")
 # Set up HTTP Basic Auth
 security = HTTPBasic()
 
-# Database pool
-db_pool = None
+# Successful validations since startup, for the sampled success log
+validated = 0
+
+# Most tokens one /validate/batch request may carry
+VALIDATE_BATCH_MAX = int(os.environ.get('VALIDATE_BATCH_MAX', 256))
+
+# Auth table access: pooled connections and the user row cache
+users = None
+# Verifies passwords on a bounded thread pool, off the event loop
+hasher = None
+# Asymmetric signing keys published as JWKS; None signs with JWT_SECRET
+key_ring = None
 
 @app.on_event("startup")
 async def startup_db_client():
-    global db_pool
+    global users, hasher, key_ring
+
+    if signing.KEYS_DIR:
+        key_ring = signing.KeyRing(signing.KEYS_DIR, logger=logger)
+
+    hasher = passwords.PasswordHasher()
+    logger.info("Password hasher ready", extra={
+        'workers': passwords.HASH_WORKERS,
+        'bcrypt_rounds': passwords.BCRYPT_ROUNDS
+    })
 
     host = os.getenv('DATABASE_HOST')
     database = os.getenv('DATABASE_NAME')
@@ -39,20 +79,23 @@ async def startup_db_client():
         'host': host,
         'database': database,
         'user': user,
-        'port': port
+        'port': port,
+        'pool_min_size': user_store.POOL_MIN_SIZE,
+        'pool_max_size': user_store.POOL_MAX_SIZE,
+        'user_cache_ttl': user_store.USER_CACHE_TTL
     })
 
     try:
-        # Create a connection pool
-        db_pool = await asyncpg.create_pool(
-            host=host,
-            database=database,
-            user=user,
-            password=password,
-            port=port,
-            min_size=5,
-            max_size=20
-        )
+        # Create the connection pool (and the cache listener)
+        store = user_store.UserStore(os.getenv('AUTH_TABLE'), logger, {
+            'host': host,
+            'database': database,
+            'user': user,
+            'password': password,
+            'port': port,
+        })
+        await store.start()
+        users = store
         logger.info("Database connection pool established")
     except Exception as e:
         logger.error(f"Failed to connect to database: {str(e)}")
@@ -60,32 +103,50 @@ async def startup_db_client():
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    global db_pool
-
-    if db_pool:
-        await db_pool.close()
+    if users:
+        await users.close()
         logger.debug("Database connection pool closed")
+    if hasher:
+        hasher.close()
 
 def create_jwt(username: str, secret: str, authz: bool) -> str:
-    """Create a JWT token"""
-    return jwt.encode(
-        {
-            "username": username,
-            "exp": datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(days=1),
-            "iat": datetime.datetime.now(tz=datetime.timezone.utc),
-            "admin": authz,
-        },
-        secret,
-        algorithm="HS256",
+    """Create a JWT token, signed by the key ring when one is configured"""
+    claims = {
+        "username": username,
+        "exp": datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(days=1),
+        "iat": datetime.datetime.now(tz=datetime.timezone.utc),
+        "admin": authz,
+    }
+    if key_ring:
+        return key_ring.sign(claims)
+    return jwt.encode(claims, secret, algorithm="HS256")
+
+def decode_token(encoded_jwt: str) -> Dict[str, Any]:
+    """Verify a token signed by the key ring (it has a kid) or with JWT_SECRET"""
+    kid = jwt.get_unverified_header(encoded_jwt).get("kid")
+    if kid is None:
+        jwt_secret = os.environ.get('JWT_SECRET', 'test_secret')
+        return jwt.decode(encoded_jwt, jwt_secret, algorithms=["HS256"])
+
+    entry = key_ring.verification_key(kid) if key_ring else None
+    if entry is None:
+        raise jwt.InvalidTokenError(f"Unknown signing key {kid}")
+    public_key, alg = entry
+    return jwt.decode(encoded_jwt, public_key, algorithms=[alg])
+
+@app.get('/.well-known/jwks.json')
+async def jwks():
+    """Public keys verifying the tokens this service signs"""
+    return JSONResponse(
+        content=key_ring.jwks() if key_ring else {"keys": []},
+        headers={"Cache-Control": f"public, max-age={signing.JWKS_MAX_AGE}"},
     )
 
 @app.post('/login')
 async def login(credentials: HTTPBasicCredentials = Depends(security)):
-    request_id = os.urandom(8).hex()  # Generate a unique request ID
+    request_id = tracing.request_id()  # Trace id, shared with the gateway's request
     logger.info("Login attempt", extra={'request_id': request_id})
 
-    auth_table_name = os.getenv('AUTH_TABLE')
-
     if not credentials or not credentials.username or not credentials.password:
         logger.warning("Missing authentication credentials", extra={
             'request_id': request_id,
@@ -101,7 +162,7 @@ async def login(credentials: HTTPBasicCredentials = Depends(security)):
 
     try:
         # Check if we have a database connection
-        if db_pool is None:
+        if users is None:
             # For testing purposes, accept any credentials
             logger.warning("No database connection, accepting any credentials for testing", extra={
                 'request_id': request_id,
@@ -110,50 +171,76 @@ async def login(credentials: HTTPBasicCredentials = Depends(security)):
             jwt_token = create_jwt(credentials.username, os.environ.get('JWT_SECRET', 'test_secret'), True)
             return {"token": jwt_token, "message": "Login successful (TEST MODE)"}
 
-        # Get a connection from the pool
-        async with db_pool.acquire() as conn:
-            query = f"SELECT email, password FROM {auth_table_name} WHERE email = $1"
+        logger.debug("Looking up user", extra={
+            'request_id': request_id,
+            'username': credentials.username
+        })
+
+        # Cached or fetched with the prepared lookup; no connection is held
+        # while the password is verified
+        user_row = await users.get(credentials.username)
 
-            logger.debug("Executing database query", extra={
+        if user_row is None:
+            logger.warning("User not found", extra={
                 'request_id': request_id,
-                'query': query,
                 'username': credentials.username
             })
-
-            # Execute the query
-            user_row = await conn.fetchrow(query, credentials.username)
-
-            if user_row is None:
-                logger.warning("User not found", extra={
-                    'request_id': request_id,
-                    'username': credentials.username
-                })
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="Could not verify",
-                    headers={"WWW-Authenticate": "Basic realm=\"Login required!\""},
-                )
-
-            email = user_row['email']
-            password = user_row['password']
-
-            if credentials.username != email or credentials.password != password:
-                logger.warning("Invalid credentials", extra={
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Could not verify",
+                headers={"WWW-Authenticate": "Basic realm=\"Login required!\""},
+            )
+
+        email = user_row['email']
+        stored_password = user_row['password']
+
+        try:
+            verified, new_hash = await hasher.verify(credentials.username, credentials.password, stored_password)
+        except passwords.Overloaded as e:
+            logger.warning(f"Login rejected, password hashing overloaded: {str(e)}", extra={
+                'request_id': request_id,
+                'username': credentials.username
+            })
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many login attempts, retry shortly",
+                headers={"Retry-After": "1"},
+            )
+
+        if credentials.username != email or not verified:
+            logger.warning("Invalid credentials", extra={
+                'request_id': request_id,
+                'username': credentials.username
+            })
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Could not verify",
+                headers={"WWW-Authenticate": "Basic realm=\"Login required!\""},
+            )
+
+        if new_hash:
+            # Plaintext row or outdated cost: store the new hash, unless the
+            # password was changed meanwhile
+            try:
+                await users.update_password(email, new_hash, stored_password)
+                logger.info("Password hash upgraded", extra={
                     'request_id': request_id,
-                    'username': credentials.username
+                    'username': credentials.username,
+                    'legacy_plaintext': not passwords.is_hashed(stored_password)
                 })
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="Could not verify",
-                    headers={"WWW-Authenticate": "Basic realm=\"Login required!\""},
-                )
-            else:
-                logger.info("Login successful", extra={
+            except Exception as e:
+                # The next login tries again
+                logger.warning(f"Failed to store upgraded password hash: {str(e)}", extra={
                     'request_id': request_id,
                     'username': credentials.username
                 })
-                jwt_token = create_jwt(credentials.username, os.environ['JWT_SECRET'], True)
-                return {"token": jwt_token, "message": "Login successful"}
+
+        logger.info("Login successful", extra={
+            'request_id': request_id,
+            'username': credentials.username
+        })
+        jwt_token = create_jwt(credentials.username, os.environ['JWT_SECRET'], True)
+        return {"token": jwt_token, "message": "Login successful"}
 
     except HTTPException:
         raise  # Re-raise HTTP exceptions
@@ -167,22 +254,35 @@ async def login(credentials: HTTPBasicCredentials = Depends(security)):
             detail="Internal server error"
         )
 
-# Debug endpoint
-@app.get('/debug-auth')
-def debug_auth(authorization: Optional[str] = Header(None)):
-    return PlainTextResponse(f"Auth header received: {authorization}")
+# Debug endpoints, not served in production mode: /debug-auth echoes credentials
+if not PRODUCTION_MODE:
+    @app.get('/debug-auth')
+    def debug_auth(authorization: Optional[str] = Header(None)):
+        return PlainTextResponse(f"Auth header received: {authorization}")
+
+    # Connection pool (size, in use, acquire wait) and user cache counters
+    @app.get('/debug-users')
+    def debug_users():
+        if users is None:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Database not connected")
+        return users.stats()
+
+    # Password verification counters (verified, rejected, rehashed, overloaded, cache)
+    @app.get('/debug-password-hasher')
+    def debug_password_hasher():
+        if hasher is None:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Password hasher not started")
+        return hasher.stats()
 
 @app.post('/validate')
 async def validate(authorization: Optional[str] = Header(None)):
-    request_id = os.urandom(8).hex()  # Generate a unique request ID
-    logger.info("Token validation request", extra={'request_id': request_id})
-
-    # Debug log the authorization header
-    logging.debug(f"Authorization header: {authorization}")
+    global validated
+    if not PRODUCTION_MODE:
+        logger.info("Token validation request", extra={'request_id': tracing.request_id()})
 
     # Check if Authorization header exists
     if not authorization:
-        logger.warning("Missing Authorization header", extra={'request_id': request_id})
+        logger.warning("Missing Authorization header", extra={'request_id': tracing.request_id()})
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Unauthorized",
@@ -196,40 +296,101 @@ async def validate(authorization: Optional[str] = Header(None)):
         else:
             encoded_jwt = authorization
 
-        logging.debug(f"Token to validate: {encoded_jwt[:20]}...")
+        # Formatted only when DEBUG is enabled; never the whole token
+        logger.debug("Token to validate: %s...", encoded_jwt[:20])
 
         # Now validate the JWT token
-        jwt_secret = os.environ.get('JWT_SECRET', 'test_secret')
-        decoded_jwt = jwt.decode(encoded_jwt, jwt_secret, algorithms=["HS256"])
-
-        logger.info("Token validated successfully", extra={
-            'request_id': request_id,
-            'username': decoded_jwt.get('username', 'unknown')
-        })
+        decoded_jwt = decode_token(encoded_jwt)
+
+        validated += 1
+        if validated % VALIDATE_LOG_SAMPLE == 0:
+            logger.info("Token validated successfully", extra={
+                'request_id': tracing.request_id(),
+                'username': decoded_jwt.get('username', 'unknown'),
+                'sample_rate': VALIDATE_LOG_SAMPLE
+            })
 
         return decoded_jwt
 
     except jwt.ExpiredSignatureError:
-        logger.warning("Expired token", extra={'request_id': request_id})
+        logger.warning("Expired token", extra={'request_id': tracing.request_id()})
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Token expired",
             headers={"WWW-Authenticate": "Basic realm=\"Login required!\""},
         )
     except jwt.InvalidTokenError as e:
-        logger.warning(f"Invalid token: {str(e)}", extra={'request_id': request_id})
+        logger.warning(f"Invalid token: {str(e)}", extra={'request_id': tracing.request_id()})
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Unauthorized",
             headers={"WWW-Authenticate": "Basic realm=\"Login required!\""},
         )
     except Exception as e:
-        logger.error(f"Validation exception: {str(e)}", extra={'request_id': request_id})
+        logger.error(f"Validation exception: {str(e)}", extra={'request_id': tracing.request_id()})
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Internal server error"
         )
 
+class TokenBatch(BaseModel):
+    # Raw tokens or "Bearer <token>" Authorization values
+    tokens: List[str]
+
+def check_token(authorization: str) -> Tuple[Optional[Dict[str, Any]], Optional[Tuple[str, int]]]:
+    """(claims, None) for a valid token, else (None, (detail, status)) as /validate would answer"""
+    encoded_jwt = authorization[7:] if authorization.startswith('Bearer ') else authorization
+    try:
+        return decode_token(encoded_jwt), None
+    except jwt.ExpiredSignatureError:
+        return None, ("Token expired", status.HTTP_401_UNAUTHORIZED)
+    except jwt.InvalidTokenError:
+        return None, ("Unauthorized", status.HTTP_401_UNAUTHORIZED)
+
+@app.post('/validate/batch')
+async def validate_batch(batch: TokenBatch):
+    """
+    Validate many tokens in one round trip. Results are in request order,
+    each {"claims": {...}} or {"error": detail, "status": code}.
+    """
+    request_id = tracing.request_id()
+    if len(batch.tokens) > VALIDATE_BATCH_MAX:
+        logger.warning("Token batch too large", extra={
+            'request_id': request_id,
+            'tokens': len(batch.tokens),
+            'max_tokens': VALIDATE_BATCH_MAX
+        })
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"At most {VALIDATE_BATCH_MAX} tokens per batch",
+        )
+
+    results = []
+    failures = {}
+    for authorization in batch.tokens:
+        try:
+            claims, err = check_token(authorization)
+        except Exception as e:
+            claims, err = None, ("Internal server error", status.HTTP_500_INTERNAL_SERVER_ERROR)
+            failures.setdefault(type(e).__name__, str(e))
+        if err:
+            detail, code = err
+            results.append({"error": detail, "status": code})
+        else:
+            results.append({"claims": claims})
+
+    # One line per batch instead of two per token
+    invalid = sum(1 for result in results if "error" in result)
+    log = logger.error if failures else logger.info
+    log("Token batch validated", extra={
+        'request_id': request_id,
+        'tokens': len(results),
+        'valid': len(results) - invalid,
+        'invalid': invalid,
+        **({'exceptions': failures} if failures else {})
+    })
+    return {"results": results}
+
 if __name__ == '__main__':
     logger.info("Starting auth service", extra={
         'host': '0.0.0.0',
@@ -0,0 +1,105 @@
+import os, json, time, glob
+import jwt
+from jwt.algorithms import get_default_algorithms
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
+from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+
+# Directory of PEM private keys named <kid>.pem (RSA or Ed25519), usually a
+# mounted Secret. Unset keeps signing with the HS256 JWT_SECRET.
+KEYS_DIR = os.environ.get("JWT_SIGNING_KEYS_DIR")
+# kid of the key new tokens are signed with; defaults to the newest file
+ACTIVE_KID = os.environ.get("JWT_ACTIVE_KID")
+# Seconds between re-reading KEYS_DIR, so keys rotate without a restart
+RELOAD_INTERVAL = float(os.environ.get("JWT_KEYS_RELOAD_INTERVAL", 60))
+# Cache-Control max-age of the JWKS response
+JWKS_MAX_AGE = int(os.environ.get("JWKS_MAX_AGE", 300))
+
+
+def _algorithm(private_key):
+    if isinstance(private_key, RSAPrivateKey):
+        return "RS256"
+    if isinstance(private_key, Ed25519PrivateKey):
+        return "EdDSA"
+    raise ValueError(f"unsupported key type {type(private_key).__name__}, use RSA or Ed25519")
+
+
+class KeyRing:
+    """
+    The asymmetric signing keys of auth-service, identified by kid.
+
+    New tokens are signed with the active key and carry its kid in the JWT
+    header. Every key in the directory is published in the JWKS, so tokens
+    signed with a retired key stay verifiable until they expire. To rotate:
+    add the new key file (it is published at the next reload), switch
+    JWT_ACTIVE_KID once verifiers have refreshed their JWKS, and remove the
+    old file after the longest token lifetime.
+    """
+
+    def __init__(self, directory, active_kid=ACTIVE_KID, reload_interval=RELOAD_INTERVAL, logger=None):
+        self.directory = directory
+        self.active_kid_setting = active_kid
+        self.reload_interval = reload_interval
+        self.logger = logger
+        self.keys = {}  # kid -> (private key, public key, algorithm)
+        self.active_kid = None
+        self._jwks = {"keys": []}
+        self._loaded_at = 0.0
+        self.load()
+
+    def load(self):
+        keys, mtimes = {}, {}
+        for path in glob.glob(os.path.join(self.directory, "*.pem")):
+            kid = os.path.splitext(os.path.basename(path))[0]
+            with open(path, "rb") as f:
+                private_key = load_pem_private_key(f.read(), password=None)
+            keys[kid] = (private_key, private_key.public_key(), _algorithm(private_key))
+            mtimes[kid] = os.path.getmtime(path)
+        if not keys:
+            raise ValueError(f"no signing keys (*.pem) in {self.directory}")
+
+        active = self.active_kid_setting or max(mtimes, key=mtimes.get)
+        if active not in keys:
+            raise ValueError(f"active kid {active} has no key file in {self.directory}")
+
+        algorithms = get_default_algorithms()
+        jwks = []
+        for kid, (_, public_key, alg) in sorted(keys.items()):
+            jwk = json.loads(algorithms[alg].to_jwk(public_key))
+            jwk.update({"kid": kid, "alg": alg, "use": "sig"})
+            jwks.append(jwk)
+
+        changed = set(keys) != set(self.keys) or active != self.active_kid
+        self.keys, self.active_kid, self._jwks = keys, active, {"keys": jwks}
+        self._loaded_at = time.monotonic()
+        if changed and self.logger:
+            self.logger.info("Signing keys loaded", extra={
+                'kids': sorted(keys),
+                'active_kid': active
+            })
+
+    def _maybe_reload(self):
+        if time.monotonic() - self._loaded_at < self.reload_interval:
+            return
+        try:
+            self.load()
+        except Exception as e:
+            # Keep the keys we have rather than failing logins
+            self._loaded_at = time.monotonic()
+            if self.logger:
+                self.logger.error(f"Failed to reload signing keys: {str(e)}")
+
+    def sign(self, claims):
+        self._maybe_reload()
+        private_key, _, alg = self.keys[self.active_kid]
+        return jwt.encode(claims, private_key, algorithm=alg, headers={"kid": self.active_kid})
+
+    def verification_key(self, kid):
+        """(public key, algorithm) for a kid, or None when it is not in the ring"""
+        self._maybe_reload()
+        entry = self.keys.get(kid)
+        return entry[1:] if entry is not None else None
+
+    def jwks(self):
+        self._maybe_reload()
+        return self._jwks
@@ -0,0 +1,190 @@
+import os, time, asyncio
+from contextlib import asynccontextmanager
+import asyncpg
+
+from src.common.cache.ttl_cache import TTLCache
+from src.common.metrics import prometheus as metrics
+
+POOL_MIN_SIZE = int(os.environ.get("DATABASE_POOL_MIN_SIZE", 5))
+POOL_MAX_SIZE = int(os.environ.get("DATABASE_POOL_MAX_SIZE", 20))
+# Seconds a user row stays cached; 0 disables the cache
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", 30))
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 10000))
+# Seconds between attempts to re-establish the LISTEN connection
+LISTEN_RETRY = float(os.environ.get("USER_CACHE_LISTEN_RETRY", 5))
+
+# The auth table trigger sends the changed email on this channel ("" after
+# a TRUNCATE). It is created by helm_charts/Postgres/init.sql; databases
+# initialized before it existed need that part of the script applied once.
+NOTIFY_CHANNEL = "auth_user_changed"
+
+
+class UserStore:
+    """
+    User rows of the auth table, read through an in-process cache.
+
+    The lookup is one constant query, so asyncpg prepares it once per pooled
+    connection (warmed when the connection is opened) and reuses the
+    statement from its per-connection cache afterwards.
+
+    Rows (and unknown emails) are cached for USER_CACHE_TTL with LRU
+    eviction. A dedicated connection LISTENs for the table's change
+    notifications and evicts the changed email. While that connection is
+    down the cache is bypassed, so a missed notification never serves a
+    stale row.
+    """
+
+    def __init__(self, table, logger, connect_kwargs, cache_ttl=USER_CACHE_TTL):
+        self.table = table
+        self.logger = logger
+        self.connect_kwargs = connect_kwargs
+        self.query = f"SELECT email, password FROM {table} WHERE email = $1"
+        self.pool = None
+        self.cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=cache_ttl) if cache_ttl > 0 else None
+        self._listener = None
+        self._listen_task = None
+        # Bumped on every invalidation; loads that overlap one are not cached
+        self._generation = 0
+        self.invalidations = 0
+        self.acquires = 0
+        self.acquire_wait_total = 0.0
+        self.acquire_wait_max = 0.0
+
+    async def start(self):
+        self.pool = await asyncpg.create_pool(
+            **self.connect_kwargs,
+            min_size=POOL_MIN_SIZE,
+            max_size=POOL_MAX_SIZE,
+            init=self._init_connection,
+        )
+        if self.cache is not None:
+            try:
+                await self._listen()
+            except Exception as e:
+                # Logins still work, straight from the database, until the
+                # listener is re-established in the background
+                self.logger.error(f"User cache bypassed, cannot listen for changes: {str(e)}")
+                self._listen_task = asyncio.create_task(self._relisten())
+
+    async def _init_connection(self, conn):
+        # Prepares the lookup into this connection's statement cache
+        await conn.fetchrow(self.query, "")
+
+    def _in_use(self):
+        return self.pool.get_size() - self.pool.get_idle_size()
+
+    @asynccontextmanager
+    async def acquire(self):
+        """A pooled connection; records how long the caller waited for it"""
+        started = time.perf_counter()
+        try:
+            async with self.pool.acquire() as conn:
+                waited = time.perf_counter() - started
+                self.acquires += 1
+                self.acquire_wait_total += waited
+                self.acquire_wait_max = max(self.acquire_wait_max, waited)
+                metrics.DB_POOL_ACQUIRE_SECONDS.observe(waited)
+                metrics.DB_POOL_IN_USE.set(self._in_use())
+                yield conn
+        finally:
+            metrics.DB_POOL_IN_USE.set(self._in_use())
+
+    async def _fetch(self, email):
+        async with self.acquire() as conn:
+            row = await conn.fetchrow(self.query, email)
+        return dict(row) if row is not None else None
+
+    async def get(self, email):
+        """The user's row as {"email", "password"}, or None for an unknown email"""
+        if self.cache is None or self._listener is None:
+            return await self._fetch(email)
+
+        async def load():
+            generation = self._generation
+            row = await self._fetch(email)
+            # A change notified while loading may predate the row just read
+            return row, (None if generation == self._generation else 0)
+
+        return await self.cache.get_or_load(email, load)
+
+    async def update_password(self, email, new_password, old_password):
+        """Replace the password unless it changed since it was read"""
+        async with self.acquire() as conn:
+            await conn.execute(
+                f"UPDATE {self.table} SET password = $1 WHERE email = $2 AND password = $3",
+                new_password, email, old_password,
+            )
+        self.invalidate(email)
+
+    def invalidate(self, email=None):
+        self._generation += 1
+        self.invalidations += 1
+        if self.cache is not None:
+            if email:
+                self.cache.invalidate(email)
+            else:
+                self.cache.clear()
+
+    def _on_notify(self, conn, pid, channel, payload):
+        self.invalidate(payload)
+
+    def _on_listener_lost(self, conn):
+        self.logger.warning("User cache listener connection lost, bypassing the cache")
+        self._listener = None
+        self.invalidate()
+        if self._listen_task is None or self._listen_task.done():
+            self._listen_task = asyncio.create_task(self._relisten())
+
+    async def _relisten(self):
+        while self._listener is None:
+            await asyncio.sleep(LISTEN_RETRY)
+            try:
+                await self._listen()
+            except Exception as e:
+                self.logger.warning(f"Failed to re-establish user cache listener: {str(e)}")
+
+    async def _listen(self):
+        conn = await asyncpg.connect(**self.connect_kwargs)
+        try:
+            await conn.add_listener(NOTIFY_CHANNEL, self._on_notify)
+        except Exception:
+            await conn.close()
+            raise
+        conn.add_termination_listener(self._on_listener_lost)
+        # Rows cached before listening may have changed unnoticed
+        self.invalidate()
+        self._listener = conn
+        self.logger.info("User cache listening for changes", extra={
+            'channel': NOTIFY_CHANNEL,
+            'table': self.table
+        })
+
+    def stats(self):
+        return {
+            'pool': {
+                'min_size': self.pool.get_min_size(),
+                'max_size': self.pool.get_max_size(),
+                'size': self.pool.get_size(),
+                'idle': self.pool.get_idle_size(),
+                'in_use': self._in_use(),
+                'acquires': self.acquires,
+                'acquire_wait_avg_ms': round(self.acquire_wait_total / self.acquires * 1000, 3) if self.acquires else 0,
+                'acquire_wait_max_ms': round(self.acquire_wait_max * 1000, 3),
+            },
+            'cache': {
+                'enabled': self.cache is not None,
+                'listening': self._listener is not None,
+                'invalidations': self.invalidations,
+                **(self.cache.stats() if self.cache is not None else {}),
+            },
+        }
+
+    async def close(self):
+        if self._listen_task is not None:
+            self._listen_task.cancel()
+        if self._listener is not None:
+            listener, self._listener = self._listener, None
+            listener.remove_termination_listener(self._on_listener_lost)
+            await listener.close()
+        if self.pool is not None:
+            await self.pool.close()
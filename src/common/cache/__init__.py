@@ -0,0 +1 @@
+# Caching utilities package
\ No newline at end of file
@@ -0,0 +1 @@
+# JWKS utilities package
\ No newline at end of file
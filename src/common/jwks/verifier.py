@@ -0,0 +1,95 @@
+import time, asyncio, logging
+import jwt
+
+logger = logging.getLogger(__name__)
+
+JWKS_PATH = "/.well-known/jwks.json"
+
+
+class JWKSVerifier:
+    """
+    Verifies JWTs locally against the JWKS published by auth-service.
+
+    The key set is fetched once and kept for `ttl` seconds; a token whose
+    kid is not in the cached set triggers an early refresh (at most once
+    every `min_refresh` seconds), so a newly rotated key is picked up
+    without waiting for the TTL. Concurrent refreshes share one request.
+    If a refresh fails the previous key set stays in use.
+
+    Each key only verifies its own published algorithm, so a token cannot
+    pick a weaker one (or "none") through its header.
+    """
+
+    def __init__(self, client, path=JWKS_PATH, ttl=300.0, min_refresh=30.0):
+        self.client = client
+        self.path = path
+        self.ttl = ttl
+        self.min_refresh = min_refresh
+        self.keys = {}  # kid -> (key, algorithm)
+        self._fetched_at = None
+        self._attempted_at = None
+        self._lock = asyncio.Lock()
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    def _fresh(self):
+        return self._fetched_at is not None and time.monotonic() - self._fetched_at < self.ttl
+
+    async def refresh(self):
+        response = await self.client.get(self.path)
+        response.raise_for_status()
+        keys = {}
+        for jwk in response.json().get("keys", []):
+            if jwk.get("use", "sig") != "sig" or "kid" not in jwk or "alg" not in jwk:
+                continue
+            try:
+                keys[jwk["kid"]] = (jwt.PyJWK(jwk).key, jwk["alg"])
+            except jwt.PyJWTError as e:
+                logger.warning(f"Skipping unusable JWK {jwk.get('kid')}: {e}")
+        self.keys = keys
+        self._fetched_at = time.monotonic()
+        self.refreshes += 1
+
+    def _may_retry(self):
+        return self._attempted_at is None or time.monotonic() - self._attempted_at >= self.min_refresh
+
+    async def _refresh_if(self, needed):
+        async with self._lock:
+            # Another caller may have refreshed while this one waited
+            if not needed():
+                return
+            self._attempted_at = time.monotonic()
+            try:
+                await self.refresh()
+            except Exception as e:
+                self.refresh_errors += 1
+                if not self.keys:
+                    raise
+                logger.error(f"JWKS refresh failed, keeping {len(self.keys)} cached keys: {e}")
+
+    async def key(self, kid):
+        """(key, algorithm) for a kid, or None when auth-service does not publish it"""
+        # Expired, or a kid it has not seen yet; retried at most every min_refresh
+        stale = lambda: (not self._fresh() or kid not in self.keys) and self._may_retry()
+        if stale():
+            await self._refresh_if(stale)
+        return self.keys.get(kid)
+
+    async def verify(self, token):
+        """The token's claims; raises jwt.InvalidTokenError (or a subclass) when it does not verify"""
+        kid = jwt.get_unverified_header(token).get("kid")
+        if kid is None:
+            raise jwt.InvalidTokenError("Token has no kid")
+        entry = await self.key(kid)
+        if entry is None:
+            raise jwt.InvalidTokenError(f"Unknown signing key {kid}")
+        key, alg = entry
+        return jwt.decode(token, key, algorithms=[alg])
+
+    def stats(self):
+        return {
+            'kids': sorted(self.keys),
+            'age_seconds': round(time.monotonic() - self._fetched_at, 1) if self._fetched_at is not None else None,
+            'refreshes': self.refreshes,
+            'refresh_errors': self.refresh_errors,
+        }
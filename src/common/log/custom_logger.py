@@ -1,8 +1,46 @@
 import logging
+import logging.handlers
 import datetime
 import os
+import queue
+import random
+import atexit
+import threading
 from pythonjsonlogger import jsonlogger
 
+try:
+    # Fills trace_id/span_id from the active OpenTelemetry span
+    from src.common.tracing.otel import TraceContextFilter
+except ImportError:
+    TraceContextFilter = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# "sync" writes each record on the calling thread; "async" only enqueues it
+# and a background thread formats and writes it
+LOG_MODE = os.environ.get("LOG_MODE", "sync")
+# Records waiting for the background thread; further records are dropped
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+# "orjson" (when installed) or "json"
+LOG_JSON = os.environ.get("LOG_JSON", "orjson")
+# Fraction of DEBUG/INFO records kept; WARNING and above are always kept
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", 1.0))
+
+LOG_FORMAT = '%(timestamp)s %(level)s %(name)s %(message)s'
+
+# LogRecord attributes (and fields set by the formatter) that are not copied
+# as extra context
+RESERVED_ATTRS = frozenset(jsonlogger.RESERVED_ATTRS) | frozenset((
+    'args', 'asctime', 'created', 'exc_info', 'exc_text', 'filename',
+    'funcName', 'id', 'levelname', 'levelno', 'lineno', 'module',
+    'msecs', 'message', 'msg', 'name', 'pathname', 'process',
+    'processName', 'relativeCreated', 'stack_info', 'thread', 'threadName',
+    'taskName',
+))
+
 
 def get_custom_logger(service_name=None):
     """
@@ -27,13 +65,20 @@ def get_custom_logger(service_name=None):
     if not logger.handlers:
         logger.setLevel(logging.INFO)
         
-        # Create handler
-        handler = logging.StreamHandler()
-        
-        # Create formatter
-        formatter = CustomJsonFormatter('%(timestamp)s %(level)s %(name)s %(message)s', service_name=service_name)
-        handler.setFormatter(formatter)
+        if LOG_MODE == "async":
+            # Every logger of the process shares one queue and writer thread
+            handler = DroppingQueueHandler(_get_listener().queue)
+        else:
+            handler = logging.StreamHandler()
+            handler.setFormatter(CustomJsonFormatter(LOG_FORMAT, service_name=service_name))
         logger.addHandler(handler)
+        
+        # Logger filters run in the calling thread, where the span is active
+        if TraceContextFilter is not None:
+            logger.addFilter(TraceContextFilter())
+        # After the trace filter, so whole traces are kept or dropped together
+        if LOG_SAMPLE_RATE < 1:
+            logger.addFilter(SamplingFilter(LOG_SAMPLE_RATE))
     
     return logger
 
@@ -41,33 +86,129 @@ def get_custom_logger(service_name=None):
 # Create formatter
 class CustomJsonFormatter(jsonlogger.JsonFormatter):
     def __init__(self, *args, service_name=None, **kwargs):
+        kwargs.setdefault('reserved_attrs', RESERVED_ATTRS)
         super(CustomJsonFormatter, self).__init__(*args, **kwargs)
         self.service_name = service_name
+        self.use_orjson = orjson is not None and LOG_JSON == "orjson"
     
     def add_fields(self, log_record, record, message_dict):
+        # Copies the extra context (and trace_id/span_id) of the record,
+        # skipping RESERVED_ATTRS
         super(CustomJsonFormatter, self).add_fields(log_record, record, message_dict)
         
-        # Add timestamp in ISO format
-        log_record['timestamp'] = datetime.datetime.now().isoformat()
+        # Add timestamp in ISO format, from the time the record was created
+        # rather than when it is written
+        log_record['timestamp'] = datetime.datetime.fromtimestamp(record.created).isoformat()
         log_record['level'] = record.levelname
         
         # Add service name
         log_record['service'] = self.service_name or record.name
-        
-        # Add trace context if available
-        if hasattr(record, 'trace_id'):
-            log_record['trace_id'] = record.trace_id
-        if hasattr(record, 'span_id'):
-            log_record['span_id'] = record.span_id
-        
-        # Add additional context from extra fields
-        for key, value in getattr(record, '__dict__', {}).items():
-            if key not in ('args', 'asctime', 'created', 'exc_info', 'exc_text', 'filename',
-                          'funcName', 'id', 'levelname', 'levelno', 'lineno', 'module',
-                          'msecs', 'message', 'msg', 'name', 'pathname', 'process',
-                          'processName', 'relativeCreated', 'stack_info', 'thread', 'threadName',
-                          'trace_id', 'span_id') and not key.startswith('_'):
-                log_record[key] = value
+    
+    def jsonify_log_record(self, log_record):
+        if self.use_orjson:
+            return orjson.dumps(log_record, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+        return super(CustomJsonFormatter, self).jsonify_log_record(log_record)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a `rate` fraction of DEBUG/INFO records. Records with a trace_id
+    are sampled by it, so all lines of a kept request are logged.
+    """
+
+    def __init__(self, rate):
+        super(SamplingFilter, self).__init__()
+        self.rate = rate
+        self.threshold = int(rate * 0x100000000)
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        trace_id = getattr(record, 'trace_id', None)
+        if trace_id:
+            return int(trace_id[-8:], 16) < self.threshold
+        return random.random() < self.rate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the background writer without ever blocking the caller.
+    When the queue is full the record is dropped and counted; the count is
+    logged as a warning once the queue has room again.
+    """
+
+    _exc_formatter = logging.Formatter()
+
+    def __init__(self, log_queue):
+        super(DroppingQueueHandler, self).__init__(log_queue)
+        # Dropped since the last report, and since the start
+        self.dropped = 0
+        self.dropped_total = 0
+        self._lock = threading.Lock()
+
+    def prepare(self, record):
+        # Resolve what must not be read later on another thread: the args may
+        # be mutated and the traceback pins frames. Formatting itself happens
+        # on the writer thread.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                self.dropped_total += 1
+            return
+        if self.dropped:
+            with self._lock:
+                dropped, self.dropped = self.dropped, 0
+            report = logging.LogRecord(record.name, logging.WARNING, __file__, 0,
+                                       "Log records dropped, queue full", None, None)
+            report.dropped = dropped
+            try:
+                self.queue.put_nowait(report)
+            except queue.Full:
+                with self._lock:
+                    self.dropped += dropped
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Wait for room instead of failing when stopped with a full queue
+        self.queue.put(self._sentinel)
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def _get_listener():
+    """The process-wide writer thread, started on first use and flushed at exit"""
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            handler = logging.StreamHandler()
+            # service_name is left unset: it falls back to the logger name
+            handler.setFormatter(CustomJsonFormatter(LOG_FORMAT))
+            _listener = _QueueListener(queue.Queue(LOG_QUEUE_SIZE), handler)
+            _listener.start()
+            atexit.register(stop_listener)
+    return _listener
+
+
+def stop_listener():
+    """Write out the queued records and stop the writer thread (also run at exit)"""
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
 
 
 # Example usage
@@ -0,0 +1 @@
+# Metrics utilities package
\ No newline at end of file
@@ -0,0 +1,134 @@
+import os, time
+
+# Port of the standalone /metrics server used by the queue consumers
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9100))
+# Set in the environment to share metrics between worker processes; it has to
+# exist before prometheus_client creates the first metric
+MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+if MULTIPROC_DIR:
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram,
+    REGISTRY, generate_latest, multiprocess, start_http_server,
+)
+
+# Request handling: sub-millisecond cache hits up to long uploads/downloads
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# Conversion stages of long videos run for minutes
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS)
+HTTP_IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "HTTP requests being handled", multiprocess_mode="livesum")
+
+GRIDFS_BYTES = Counter(
+    "gridfs_bytes_total", "Bytes read from or written to GridFS", ["op"])
+GRIDFS_SECONDS = Histogram(
+    "gridfs_operation_duration_seconds", "Duration of whole-file GridFS reads and writes",
+    ["op"], buckets=STAGE_BUCKETS)
+
+QUEUE_ACK_SECONDS = Histogram(
+    "queue_consume_to_ack_seconds", "Time from receiving a message to acking or rejecting it",
+    ["queue", "outcome"], buckets=STAGE_BUCKETS)
+QUEUE_IN_FLIGHT = Gauge(
+    "queue_messages_in_flight", "Messages received and not yet settled",
+    ["queue"], multiprocess_mode="livesum")
+
+CONVERSION_STAGE_SECONDS = Histogram(
+    "conversion_stage_duration_seconds", "Converter time per stage (fetch, decode, encode, store, publish)",
+    ["stage"], buckets=STAGE_BUCKETS)
+
+DB_POOL_ACQUIRE_SECONDS = Histogram(
+    "db_pool_acquire_seconds", "Time waiting for a pooled database connection",
+    buckets=LATENCY_BUCKETS)
+DB_POOL_IN_USE = Gauge(
+    "db_pool_connections_in_use", "Pooled database connections checked out", multiprocess_mode="livesum")
+
+SMTP_SEND_SECONDS = Histogram(
+    "smtp_send_duration_seconds", "Time to hand one email to the SMTP server",
+    ["outcome"], buckets=LATENCY_BUCKETS)
+SMTP_IN_FLIGHT = Gauge(
+    "smtp_sends_in_flight", "Emails being sent", multiprocess_mode="livesum")
+
+
+def registry():
+    """The registry to expose: aggregated over processes in multiprocess mode"""
+    if not MULTIPROC_DIR:
+        return REGISTRY
+    collector_registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collector_registry)
+    return collector_registry
+
+
+def serve(port=METRICS_PORT):
+    """Expose /metrics on its own port, for services without an HTTP server"""
+    start_http_server(port, registry=registry())
+
+
+def process_exited(pid):
+    """Drop the live gauges of a worker process that is gone"""
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
+
+
+def observe_gridfs(op, nbytes, seconds):
+    GRIDFS_BYTES.labels(op).inc(nbytes)
+    GRIDFS_SECONDS.labels(op).observe(seconds)
+
+
+def _route_template(scope):
+    # The path template ("/uploads/{upload_id}") keeps the label cardinality
+    # bounded; unmatched paths share one label. FastAPI's router stores the
+    # matched route in the scope, so nothing is matched twice.
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+class MetricsMiddleware:
+    """
+    Plain ASGI middleware recording latency per route template and the
+    number of requests in flight. It wraps `send` instead of using
+    BaseHTTPMiddleware, so responses are not buffered and the cost per
+    request is a couple of clock reads and one histogram update.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            HTTP_REQUEST_SECONDS.labels(
+                scope["method"], _route_template(scope), str(status)
+            ).observe(time.perf_counter() - started)
+
+
+def instrument_app(app):
+    """Add request metrics and a GET /metrics route to a FastAPI app"""
+    from fastapi import Response
+
+    exposed = registry()
+
+    @app.get("/metrics", include_in_schema=False)
+    def metrics():
+        return Response(generate_latest(exposed), media_type=CONTENT_TYPE_LATEST)
+
+    app.add_middleware(MetricsMiddleware)
@@ -0,0 +1 @@
+# Message queue utilities package
\ No newline at end of file
@@ -0,0 +1,64 @@
+import os
+
+
+def _parse_weights(spec):
+    weights = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip():
+            weights[name.strip()] = int(weight)
+    return weights
+
+
+# Base name of the video queues; tiers are published to "<base>.<tier>"
+VIDEO_QUEUE = os.environ.get("VIDEO_QUEUE", "video")
+# Upper size bound of each tier in bytes; anything larger is "large"
+SMALL_MAX_BYTES = int(os.environ.get("VIDEO_TIER_SMALL_MAX_BYTES", 50 * 1024 * 1024))
+MEDIUM_MAX_BYTES = int(os.environ.get("VIDEO_TIER_MEDIUM_MAX_BYTES", 500 * 1024 * 1024))
+# Relative share of conversions each tier gets while all of them have work
+TIER_WEIGHTS = _parse_weights(os.environ.get("VIDEO_TIER_WEIGHTS", "small=6,medium=3,large=1"))
+
+TIERS = ("small", "medium", "large")
+
+
+def tier_for_size(size):
+    """Return the tier name for a video of `size` bytes"""
+    if size <= SMALL_MAX_BYTES:
+        return "small"
+    if size <= MEDIUM_MAX_BYTES:
+        return "medium"
+    return "large"
+
+
+def queue_name(tier, base=VIDEO_QUEUE):
+    return f"{base}.{tier}"
+
+
+def video_queues(base=VIDEO_QUEUE):
+    """All tier queue names, smallest tier first"""
+    return [queue_name(tier, base) for tier in TIERS]
+
+
+class WeightedScheduler:
+    """
+    Smooth weighted round robin over the tier queues.
+
+    `order()` lists the queues to try for the next job, preferred one first;
+    `served(queue)` charges the queue that actually supplied it. With weights
+    6/3/1 and all tiers busy, 6 of every 10 jobs come from the small tier, but
+    a tier with work is never starved and an empty tier gives its turn away.
+    """
+
+    def __init__(self, weights):
+        self.weights = {name: max(int(weight), 1) for name, weight in weights.items()}
+        self.total = sum(self.weights.values())
+        self.current = {name: 0 for name in self.weights}
+
+    def order(self):
+        projected = {name: self.current[name] + weight for name, weight in self.weights.items()}
+        return sorted(self.weights, key=lambda name: projected[name], reverse=True)
+
+    def served(self, name):
+        for other, weight in self.weights.items():
+            self.current[other] += weight
+        self.current[name] -= self.total
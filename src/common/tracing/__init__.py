@@ -0,0 +1 @@
+# Tracing utilities package
\ No newline at end of file
@@ -0,0 +1,117 @@
+import os, logging
+from contextlib import contextmanager
+from opentelemetry import trace, propagate
+from opentelemetry.trace import SpanKind, Status, StatusCode
+
+# OTLP/HTTP collector endpoint, e.g. http://otel-collector:4318; without it
+# spans are still created, so logs and request ids stay correlated, but
+# nothing is exported
+OTLP_ENDPOINT = os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT")
+# Paths the HTTP instrumentation skips
+EXCLUDED_URLS = os.environ.get("OTEL_EXCLUDED_URLS", "metrics,healthz")
+
+# Proxy tracer: bound to the real provider once setup() ran
+tracer = trace.get_tracer("video-to-mp3")
+
+
+def setup(service_name):
+    """
+    Install the tracer provider for this process. Call once per process:
+    the converter's spawned workers call it again for themselves. Sampling
+    follows OTEL_TRACES_SAMPLER / OTEL_TRACES_SAMPLER_ARG.
+    """
+    from opentelemetry.sdk.resources import Resource, SERVICE_NAME
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+    provider = TracerProvider(resource=Resource.create({SERVICE_NAME: service_name}))
+    if OTLP_ENDPOINT:
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        # Spans are exported from a background thread in batches
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    return provider
+
+
+def instrument_app(app):
+    """Server spans for every request of a FastAPI app, continuing incoming traceparent headers"""
+    from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
+    FastAPIInstrumentor.instrument_app(app, excluded_urls=EXCLUDED_URLS)
+
+
+def inject(headers=None):
+    """Add the W3C trace context of the current span to AMQP message headers"""
+    headers = dict(headers or {})
+    propagate.inject(headers)
+    return headers
+
+
+def extract(headers):
+    """The trace context carried in AMQP message headers, if any"""
+    # Header values may arrive as bytes depending on the client library
+    carrier = {k: v.decode() if isinstance(v, bytes) else v for k, v in (headers or {}).items()}
+    return propagate.extract(carrier)
+
+
+def start_consumer_span(queue, headers, **attributes):
+    """
+    Start (without activating) the span of processing one message, as a
+    child of the publisher's span. For consumers that finish the message on
+    another thread; end it with end_span().
+    """
+    return tracer.start_span(
+        f"{queue} process", context=extract(headers), kind=SpanKind.CONSUMER,
+        attributes={"messaging.system": "rabbitmq", "messaging.source.name": queue, **attributes},
+    )
+
+
+@contextmanager
+def consumer_span(queue, headers, **attributes):
+    """Process one message inside an active consumer span"""
+    span = start_consumer_span(queue, headers, **attributes)
+    with trace.use_span(span, end_on_exit=True, record_exception=True, set_status_on_exception=True):
+        yield span
+
+
+@contextmanager
+def producer_span(queue, **attributes):
+    """Span of publishing one message; yields the headers to publish with"""
+    with tracer.start_as_current_span(
+        f"{queue} publish", kind=SpanKind.PRODUCER,
+        attributes={"messaging.system": "rabbitmq", "messaging.destination.name": queue, **attributes},
+    ):
+        yield inject()
+
+
+def set_error(span, error):
+    """Mark a span failed for an error that was handled rather than raised"""
+    span.set_status(Status(StatusCode.ERROR, str(error)))
+
+
+def end_span(span, error=None):
+    if error is not None:
+        set_error(span, error)
+    span.end()
+
+
+def request_id():
+    """
+    The current trace id, so every hop of one upload logs the same
+    request_id; a random one outside of any trace.
+    """
+    context = trace.get_current_span().get_span_context()
+    if context.is_valid:
+        return trace.format_trace_id(context.trace_id)
+    return os.urandom(8).hex()
+
+
+class TraceContextFilter(logging.Filter):
+    """Copies the ids of the span active at the logging call onto the record"""
+
+    def filter(self, record):
+        if not hasattr(record, "trace_id"):
+            context = trace.get_current_span().get_span_context()
+            if context.is_valid:
+                record.trace_id = trace.format_trace_id(context.trace_id)
+                record.span_id = trace.format_span_id(context.span_id)
+        return True
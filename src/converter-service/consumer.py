@@ -1,71 +1,341 @@
-import pika, sys, os
+import pika, sys, os, json, time, signal, functools, threading, multiprocessing
+from multiprocessing.connection import wait
+from concurrent.futures import ThreadPoolExecutor
 from pymongo import MongoClient
 import gridfs
 from convert import to_mp3
+from convert.dedup import ConversionIndex
+from convert.fairshare import UserLeases, LEASE_TTL
+from convert import jobs as conversion_jobs
 
 # Import custom logger
 from src.common.log.custom_logger import get_custom_logger
+from src.common.queues import tiers
+from src.common.metrics import prometheus as metrics
+from src.common.tracing import otel as tracing
 
 # Initialize logger
 logger = get_custom_logger(service_name="converter-service")
 
-def main():
-    logger.info("Initializing converter service")
-    
+# Number of worker processes; each one converts a single video at a time
+WORKERS = int(os.environ.get("CONVERTER_WORKERS") or os.cpu_count() or 1)
+# Seconds an idle worker waits before polling the tier queues again
+POLL_INTERVAL = float(os.environ.get("CONVERTER_POLL_INTERVAL", 0.5))
+# Heartbeats keep flowing because conversions run off the connection thread
+HEARTBEAT = int(os.environ.get("RABBITMQ_HEARTBEAT", 60))
+# Seconds a worker thread waits for the connection thread to publish
+PUBLISH_TIMEOUT = float(os.environ.get("CONVERTER_PUBLISH_TIMEOUT", 30))
+# Seconds a job may wait for its user's limit before it is converted anyway;
+# by then a lease that held it back belongs to a dead worker
+MAX_DEFER_SECONDS = float(os.environ.get("CONVERTER_MAX_DEFER_SECONDS", LEASE_TTL))
+
+
+class ThreadSafeChannel:
+    """
+    Proxy handed to to_mp3.start in worker threads. pika channels are not
+    thread-safe, so publishes are scheduled onto the connection's thread with
+    add_callback_threadsafe and the caller waits for the outcome.
+    """
+
+    def __init__(self, connection, channel):
+        self._connection = connection
+        self._channel = channel
+
+    def basic_publish(self, **kwargs):
+        done = threading.Event()
+        outcome = {}
+
+        def publish():
+            try:
+                self._channel.basic_publish(**kwargs)
+            except Exception as e:
+                outcome['error'] = e
+            finally:
+                done.set()
+
+        self._connection.add_callback_threadsafe(publish)
+        if not done.wait(PUBLISH_TIMEOUT):
+            raise TimeoutError("timed out waiting for the connection thread to publish")
+        if 'error' in outcome:
+            raise outcome['error']
+
+
+def declare_queues(connection, channel):
+    """
+    Declare the size-tier queues and return {queue: weight} for the scheduler.
+    The old single VIDEO_QUEUE is drained too while it still exists, so
+    messages published before the tiers existed are not stranded.
+    """
+    weights = {}
+    for tier, queue in zip(tiers.TIERS, tiers.video_queues()):
+        channel.queue_declare(queue=queue, durable=True)
+        weights[queue] = tiers.TIER_WEIGHTS.get(tier, 1)
+
+    # A failed passive declare closes the channel, so probe on a throwaway one
+    probe = connection.channel()
     try:
-        # Connect to MongoDB
-        mongo_uri = os.environ.get('MONGODB_URI')
-        logger.info(f"Connecting to MongoDB", extra={'uri': mongo_uri})
-        
-        client = MongoClient(mongo_uri)
-        db_videos = client.videos
-        db_mp3s = client.mp3s
-        
-        # Initialize GridFS
-        logger.debug("Initializing GridFS")
-        fs_videos = gridfs.GridFS(db_videos)
-        fs_mp3s = gridfs.GridFS(db_mp3s)
-        
-        # Connect to RabbitMQ
-        logger.info("Connecting to RabbitMQ", extra={'host': 'rabbitmq'})
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters(host='rabbitmq', heartbeat=0)
-        )
-        channel = connection.channel()
-        
-        def callback(ch, method, properties, body):
-            message_id = method.delivery_tag
-            logger.info(f"Received message from queue", extra={
-                'message_id': message_id,
-                'queue': os.environ.get("VIDEO_QUEUE")
+        probe.queue_declare(queue=tiers.VIDEO_QUEUE, passive=True)
+        weights[tiers.VIDEO_QUEUE] = 1
+    except pika.exceptions.ChannelClosedByBroker:
+        pass
+    finally:
+        if probe.is_open:
+            probe.close()
+    return weights
+
+
+def run_worker(worker_id=0):
+    """Convert videos from the tier queues in this process until SIGTERM/SIGINT, then drain."""
+    # Each spawned worker exports its own spans
+    tracing.setup("converter-service")
+    worker_logger = get_custom_logger(service_name="converter-service")
+    worker_logger.info("Starting converter worker", extra={'worker_id': worker_id})
+
+    # Connect to MongoDB
+    mongo_uri = os.environ.get('MONGODB_URI')
+    worker_logger.info(f"Connecting to MongoDB", extra={'uri': mongo_uri, 'worker_id': worker_id})
+
+    client = MongoClient(mongo_uri)
+    db_videos = client.videos
+    db_mp3s = client.mp3s
+
+    # Initialize GridFS
+    worker_logger.debug("Initializing GridFS")
+    fs_videos = gridfs.GridFS(db_videos)
+    fs_mp3s = gridfs.GridFS(db_mp3s)
+    # sha256 -> mp3_fid of earlier conversions, so re-uploads skip conversion
+    dedup = ConversionIndex(db_mp3s.conversions)
+    # Running conversions per user, shared with every other worker
+    leases = UserLeases(db_mp3s.user_leases)
+    # Per-video checkpoints, so a redelivered message resumes instead of redoing work
+    jobs = conversion_jobs.JobStore(db_mp3s.conversion_jobs)
+
+    # Connect to RabbitMQ
+    worker_logger.info("Connecting to RabbitMQ", extra={'host': 'rabbitmq', 'worker_id': worker_id})
+    connection = pika.BlockingConnection(
+        pika.ConnectionParameters(host='rabbitmq', heartbeat=HEARTBEAT)
+    )
+    channel = connection.channel()
+    # Deferred and MP3 messages are only acked/reported once the broker has them
+    channel.confirm_delivery()
+    scheduler = tiers.WeightedScheduler(declare_queues(connection, channel))
+
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"convert-{worker_id}")
+    # delivery tag -> (queue, time received) of messages not settled yet
+    in_flight = {}
+    draining = threading.Event()
+
+    def settle(ch, delivery_tag, err, requeue=True):
+        # Runs on the connection thread
+        queue, received = in_flight.pop(delivery_tag, (None, None))
+        if queue is not None:
+            metrics.QUEUE_IN_FLIGHT.labels(queue).dec()
+            metrics.QUEUE_ACK_SECONDS.labels(queue, "nack" if err else "ack").observe(time.monotonic() - received)
+        if not ch.is_open:
+            worker_logger.warning("Channel closed before ack, message will be redelivered", extra={
+                'message_id': delivery_tag
             })
-            
-            err = to_mp3.start(body, fs_videos, fs_mp3s, ch, logger)
-            
-            if err:
-                logger.error(f"Failed to process message: {err}", extra={
-                    'message_id': message_id
+        elif err:
+            ch.basic_nack(delivery_tag=delivery_tag, requeue=requeue)
+        else:
+            ch.basic_ack(delivery_tag=delivery_tag)
+
+    def process(ch, delivery_tag, queue, headers, body, username, lease_id):
+        # Runs on the worker thread, inside a span continuing the gateway's trace.
+        # Whatever happens, the message is settled, or the main loop would
+        # wait for it forever.
+        err = None
+        try:
+            with tracing.consumer_span(queue, headers, worker_id=worker_id) as span:
+                err = to_mp3.start(body, fs_videos, fs_mp3s, ThreadSafeChannel(connection, ch), worker_logger, dedup, jobs)
+                if err:
+                    tracing.set_error(span, err)
+        except Exception as e:
+            err = f"unexpected error: {str(e)}"
+        finally:
+            try:
+                if lease_id is not None:
+                    leases.release(username, lease_id)
+            except Exception as e:
+                # The lease expires on its own after CONVERTER_USER_LEASE_TTL
+                worker_logger.warning(f"Failed to release user lease: {str(e)}", extra={'username': username})
+
+        if err:
+            worker_logger.error(f"Failed to process message: {err}", extra={
+                'message_id': delivery_tag
+            })
+        else:
+            worker_logger.info("Successfully processed message", extra={
+                'message_id': delivery_tag
+            })
+        connection.add_callback_threadsafe(functools.partial(settle, ch, delivery_tag, err))
+
+    def defer(queue, method, properties, body):
+        # The user is at their limit: move the job to the back of its queue so
+        # other users' jobs go first, then drop this copy
+        headers = dict(properties.headers or {})
+        headers.setdefault("x-first-deferred", int(time.time()))
+        channel.basic_publish(
+            exchange="",
+            routing_key=queue,
+            body=body,
+            properties=pika.BasicProperties(
+                delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE,
+                headers=headers
+            ),
+        )
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+
+    def next_job():
+        # Runs on the connection thread; takes at most one message per queue
+        for queue in scheduler.order():
+            method, properties, body = channel.basic_get(queue=queue)
+            if method is None:
+                continue
+
+            try:
+                username = json.loads(body).get("username")
+            except ValueError:
+                username = None  # to_mp3.start reports the bad message
+            lease_id = os.urandom(8).hex()
+            first_deferred = (properties.headers or {}).get("x-first-deferred")
+            if not leases.acquire(username, lease_id):
+                if first_deferred is None or time.time() - first_deferred < MAX_DEFER_SECONDS:
+                    worker_logger.info("User at conversion limit, deferring job", extra={
+                        'username': username,
+                        'queue': queue,
+                        'worker_id': worker_id
+                    })
+                    defer(queue, method, properties, body)
+                    continue
+                # Bounded waiting: a stuck lease cannot hold the job back forever
+                worker_logger.warning("Job deferred too long, converting past the user limit", extra={
+                    'username': username,
+                    'queue': queue,
+                    'deferred_seconds': round(time.time() - first_deferred, 1)
                 })
-                ch.basic_nack(delivery_tag=message_id)
-            else:
-                logger.info("Successfully processed message", extra={
-                    'message_id': message_id
+                lease_id = None  # No slot was taken, so none is released
+
+            scheduler.served(queue)
+            worker_logger.info(f"Received message from queue", extra={
+                'message_id': method.delivery_tag,
+                'queue': queue,
+                'worker_id': worker_id
+            })
+            return queue, method.delivery_tag, properties.headers, body, username, lease_id
+        return None
+
+    def request_drain(signum, frame):
+        if draining.is_set():
+            return
+        worker_logger.info("Draining converter worker", extra={'worker_id': worker_id, 'signal': signum})
+        draining.set()
+
+    signal.signal(signal.SIGTERM, request_drain)
+    signal.signal(signal.SIGINT, request_drain)
+
+    worker_logger.info("Waiting for messages. To exit press CTRL+C", extra={
+        'queues': scheduler.weights,
+        'user_max_active': leases.limit
+    })
+
+    # Messages are pulled one at a time when the worker is idle, so a worker
+    # never holds a job it has not started while a smaller one waits
+    while not draining.is_set():
+        if in_flight:
+            connection.process_data_events(time_limit=0.2)
+            continue
+        job = next_job()
+        if job is None:
+            connection.process_data_events(time_limit=POLL_INTERVAL)
+            continue
+        queue, delivery_tag, headers, body, username, lease_id = job
+        in_flight[delivery_tag] = (queue, time.monotonic())
+        metrics.QUEUE_IN_FLIGHT.labels(queue).inc()
+        executor.submit(process, channel, delivery_tag, queue, headers, body, username, lease_id)
+
+    # Let the conversion in progress finish while still pumping the connection
+    # so its ack reaches RabbitMQ
+    while in_flight and connection.is_open:
+        connection.process_data_events(time_limit=1)
+    executor.shutdown(wait=True)
+    if connection.is_open:
+        connection.close()
+    client.close()
+    worker_logger.info("Converter worker stopped", extra={'worker_id': worker_id})
+
+
+def run_orphan_sweeper(stopping):
+    """Periodically delete MP3 data left behind by crashed conversions"""
+    client = MongoClient(os.environ.get('MONGODB_URI'))
+    sweeper = conversion_jobs.OrphanSweeper(client.mp3s, gridfs.GridFS(client.mp3s), logger)
+    while not stopping.wait(conversion_jobs.SWEEP_INTERVAL):
+        try:
+            sweeper.sweep()
+        except Exception as e:
+            logger.error(f"Orphan sweep failed: {str(e)}")
+    client.close()
+
+
+def main():
+    logger.info("Initializing converter service", extra={
+        'workers': WORKERS,
+        'tier_weights': tiers.TIER_WEIGHTS
+    })
+
+    # Workers write their metrics to PROMETHEUS_MULTIPROC_DIR; this process
+    # serves the aggregate
+    metrics.serve()
+
+    stopping = threading.Event()
+    if conversion_jobs.SWEEP_INTERVAL > 0:
+        threading.Thread(target=run_orphan_sweeper, args=(stopping,), name="orphan-sweeper", daemon=True).start()
+
+    if WORKERS <= 1:
+        try:
+            run_worker()
+        except Exception as e:
+            logger.critical(f"Service initialization failed: {str(e)}")
+            raise
+        return
+
+    # Each worker gets its own process (and so its own core, Mongo client and
+    # AMQP connection); spawn avoids inheriting sockets from the parent.
+    context = multiprocessing.get_context("spawn")
+    workers = {}
+
+    def start_worker(worker_id):
+        process = context.Process(target=run_worker, args=(worker_id,), name=f"converter-{worker_id}")
+        process.start()
+        workers[worker_id] = process
+
+    def shutdown(signum, frame):
+        logger.info("Stopping converter workers", extra={'signal': signum})
+        stopping.set()
+        for process in workers.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    for worker_id in range(WORKERS):
+        start_worker(worker_id)
+
+    while not stopping.is_set():
+        wait([process.sentinel for process in workers.values()], timeout=1)
+        for worker_id, process in list(workers.items()):
+            if not process.is_alive() and not stopping.is_set():
+                logger.error("Converter worker exited, restarting it", extra={
+                    'worker_id': worker_id,
+                    'exitcode': process.exitcode
                 })
-                ch.basic_ack(delivery_tag=message_id)
-        
-        video_queue = os.environ.get("VIDEO_QUEUE")
-        logger.info(f"Setting up consumer for queue", extra={'queue': video_queue})
-        
-        channel.basic_consume(
-            queue=video_queue, on_message_callback=callback
-        )
-        
-        logger.info("Waiting for messages. To exit press CTRL+C")
-        channel.start_consuming()
-        
-    except Exception as e:
-        logger.critical(f"Service initialization failed: {str(e)}")
-        raise
+                metrics.process_exited(process.pid)
+                start_worker(worker_id)
+
+    for process in workers.values():
+        process.join()
+    logger.info("All converter workers stopped")
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,79 @@
+import threading
+from pymongo.errors import DuplicateKeyError
+
+
+class ConversionIndex:
+    """
+    Content-hash index of finished conversions: sha256 of the uploaded video
+    -> mp3_fid. A re-uploaded video is answered with the existing MP3 instead
+    of being converted again.
+
+    Documents look like
+        {"sha256": ..., "mp3_fid": ObjectId, "conversion_seconds": float,
+         "hits": int, "seconds_saved": float}
+    with a unique index on sha256, so concurrent workers racing on the same
+    content store a single entry.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.collection.create_index("sha256", unique=True)
+        # The orphan sweeper looks entries up by MP3
+        self.collection.create_index("mp3_fid")
+        # Counters for this worker process; the hits and seconds_saved fields
+        # of the index documents add up across workers
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+
+    def lookup(self, sha256, fs_mp3s):
+        """Return the cached entry for sha256, or None if there is no usable MP3"""
+        if not sha256:
+            return None
+
+        entry = self.collection.find_one({"sha256": sha256})
+        if entry is not None and not fs_mp3s.exists(entry["mp3_fid"]):
+            # The MP3 was removed; forget it so the video is converted again
+            self.collection.delete_one({"_id": entry["_id"], "mp3_fid": entry["mp3_fid"]})
+            entry = None
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.seconds_saved += entry.get("conversion_seconds", 0.0)
+
+        if entry is not None:
+            self.collection.update_one({"_id": entry["_id"]}, {
+                "$inc": {"hits": 1, "seconds_saved": entry.get("conversion_seconds", 0.0)}
+            })
+        return entry
+
+    def remember(self, sha256, mp3_fid, conversion_seconds):
+        """Record a finished conversion; a concurrent duplicate keeps the first entry"""
+        if not sha256:
+            return
+        try:
+            self.collection.insert_one({
+                "sha256": sha256,
+                "mp3_fid": mp3_fid,
+                "conversion_seconds": conversion_seconds,
+                "hits": 0,
+                "seconds_saved": 0.0,
+            })
+        except DuplicateKeyError:
+            pass
+
+    def local_stats(self):
+        """Hit/miss counters of this worker process"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'dedup_hits': self.hits,
+                'dedup_misses': self.misses,
+                'dedup_hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'dedup_seconds_saved': round(self.seconds_saved, 3),
+            }
+
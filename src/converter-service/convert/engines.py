@@ -0,0 +1,372 @@
+import os, json, time, subprocess, tempfile, threading
+from concurrent.futures import ThreadPoolExecutor
+from src.common.metrics import prometheus as metrics
+
+# Audio extraction engine used by to_mp3.start: "ffmpeg", "segmented" or "moviepy"
+ENGINE = os.environ.get("CONVERTER_ENGINE", "ffmpeg").lower()
+
+FFMPEG_BINARY = os.environ.get("FFMPEG_BINARY", "ffmpeg")
+FFPROBE_BINARY = os.environ.get("FFPROBE_BINARY", "ffprobe")
+MP3_BITRATE = os.environ.get("MP3_BITRATE", "192k")
+# Leading bytes of the video handed to ffprobe. Containers whose index is not
+# within this window (e.g. MP4 with the moov atom at the end) cannot be read
+# from a pipe and are spooled to disk instead.
+PROBE_BYTES = int(os.environ.get("CONVERTER_PROBE_BYTES", 8 * 1024 * 1024))
+# Bytes moved per read/write between GridFS and ffmpeg
+IO_CHUNK_SIZE = 1024 * 1024
+# Segmented engine: videos smaller than this are converted in one piece
+SEGMENT_MIN_BYTES = int(os.environ.get("CONVERTER_SEGMENT_MIN_BYTES", 64 * 1024 * 1024))
+# Shortest audio segment worth its own encoder, in seconds
+SEGMENT_MIN_SECONDS = float(os.environ.get("CONVERTER_SEGMENT_MIN_SECONDS", 60))
+# Encoders run in parallel per conversion; each one keeps one core busy.
+# Every worker process may run a conversion, so by default the cores are
+# split between CONVERTER_WORKERS instead of each one taking all of them.
+_CPUS = os.cpu_count() or 1
+SEGMENT_JOBS = int(os.environ.get("CONVERTER_SEGMENT_JOBS")
+                   or max(_CPUS // int(os.environ.get("CONVERTER_WORKERS") or _CPUS), 1))
+# Frames encoded before (and after) each segment and then dropped, so the
+# encoder state at the boundary matches a single continuous encode
+SEGMENT_PREROLL_FRAMES = 8
+SEGMENT_POSTROLL_FRAMES = 2
+
+# MPEG-1 Layer III: every frame holds 1152 samples per channel
+SAMPLES_PER_FRAME = 1152
+MPEG1_SAMPLE_RATES = (44100, 48000, 32000)
+MPEG1_L3_BITRATES = (None, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, None)
+
+
+class ExtractionError(Exception):
+    """Raised when an engine fails to produce the MP3"""
+
+
+def copy_stream(source, sink, chunk_size=IO_CHUNK_SIZE):
+    """Copy a readable file-like object into a writable one in bounded chunks"""
+    total = 0
+    while True:
+        data = source.read(chunk_size)
+        if not data:
+            return total
+        sink.write(data)
+        total += len(data)
+
+
+class FfmpegEngine:
+    """
+    Streams the video through an `ffmpeg -vn` subprocess: GridFS chunks are
+    written to its stdin from a feeder thread while its stdout is copied
+    straight into the GridFS upload stream, so neither the video nor the MP3
+    is ever held in memory and the MP3 never touches disk. Video frames are
+    never decoded, and MP3 audio is stream-copied instead of re-encoded.
+    """
+
+    name = "ffmpeg"
+
+    def probe(self, head):
+        """Return the codec of the first audio stream in `head`, or None if unreadable"""
+        result = subprocess.run(
+            [FFPROBE_BINARY, "-v", "error", "-select_streams", "a:0",
+             "-show_entries", "stream=codec_name", "-of", "csv=p=0", "-i", "pipe:0"],
+            input=head, capture_output=True,
+        )
+        codec = result.stdout.decode(errors="replace").strip()
+        return codec or None
+
+    def extract(self, video, mp3_out, logger, video_id=None):
+        """Convert the GridOut `video` into MP3 bytes written to the GridIn `mp3_out`"""
+        head = video.read(PROBE_BYTES)
+        video.seek(0)
+        codec = self.probe(head)
+
+        # One ffmpeg pass decodes, encodes and stores concurrently, so it is
+        # reported as a single "encode" stage
+        stage = metrics.CONVERSION_STAGE_SECONDS.labels("encode")
+        codec_args = ["-c:a", "copy"] if codec == "mp3" else ["-c:a", "libmp3lame", "-b:a", MP3_BITRATE]
+        output_args = ["-vn", "-map", "0:a:0", *codec_args, "-f", "mp3", "pipe:1"]
+
+        if codec is not None:
+            logger.info("Extracting audio with ffmpeg from stdin", extra={
+                'video_id': video_id,
+                'source_codec': codec,
+                'stream_copy': codec == "mp3"
+            })
+            with stage.time():
+                return self._run(["-i", "pipe:0", *output_args], video, mp3_out)
+
+        # The container is not readable from a pipe; spool it to disk (chunk
+        # by chunk, still never in memory) so ffmpeg can seek
+        logger.info("Video is not streamable, spooling to disk for ffmpeg", extra={'video_id': video_id})
+        with tempfile.NamedTemporaryFile(suffix=".video") as spool:
+            with metrics.CONVERSION_STAGE_SECONDS.labels("fetch").time():
+                copy_stream(video, spool)
+                spool.flush()
+            with stage.time():
+                return self._run(["-i", spool.name, *output_args], None, mp3_out)
+
+    def _run(self, args, source, mp3_out):
+        command = [FFMPEG_BINARY, "-hide_banner", "-loglevel", "error"]
+        if source is None:
+            command.append("-nostdin")
+        command.extend(args)
+
+        with tempfile.TemporaryFile() as stderr:
+            proc = subprocess.Popen(
+                command,
+                stdin=subprocess.PIPE if source is not None else subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+            )
+
+            feeder = None
+            if source is not None:
+                feeder = threading.Thread(target=self._feed, args=(source, proc.stdin), daemon=True)
+                feeder.start()
+
+            try:
+                written = copy_stream(proc.stdout, mp3_out)
+            finally:
+                proc.stdout.close()
+                returncode = proc.wait()
+                if feeder:
+                    feeder.join()
+
+            if returncode != 0:
+                stderr.seek(0)
+                message = stderr.read()[-2000:].decode(errors="replace").strip()
+                raise ExtractionError(f"ffmpeg exited with {returncode}: {message}")
+            return written
+
+    @staticmethod
+    def _feed(source, stdin):
+        try:
+            copy_stream(source, stdin)
+        except (BrokenPipeError, ValueError):
+            # ffmpeg stopped reading (it failed, or needs no more input)
+            pass
+        finally:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
+
+
+def read_mp3_frames(f):
+    """
+    Yield the MPEG-1 Layer III frames of a headerless MP3 stream one by one,
+    sized from each frame header (bitrate, sample rate, padding bit).
+    """
+    while True:
+        header = f.read(4)
+        if not header:
+            return
+        # 11 sync bits, MPEG-1, Layer III, with or without CRC
+        if len(header) < 4 or header[0] != 0xFF or header[1] & 0xFE != 0xFA:
+            raise ExtractionError("invalid MP3 frame header in encoded segment")
+        bitrate = MPEG1_L3_BITRATES[header[2] >> 4]
+        rate_index = (header[2] >> 2) & 0x3
+        if bitrate is None or rate_index == 3:
+            raise ExtractionError("unsupported MP3 frame header in encoded segment")
+        length = 144 * bitrate * 1000 // MPEG1_SAMPLE_RATES[rate_index] + ((header[2] >> 1) & 0x1)
+        body = f.read(length - 4)
+        if len(body) < length - 4:
+            raise ExtractionError("truncated MP3 frame in encoded segment")
+        yield header + body
+
+
+class PcmRange:
+    """Read-only view of a byte range of the decoded PCM spool"""
+
+    def __init__(self, fd, start, end):
+        self._fd = fd
+        self._pos = start
+        self._end = end
+
+    def read(self, n=-1):
+        remaining = self._end - self._pos
+        if n < 0 or n > remaining:
+            n = remaining
+        data = os.pread(self._fd, n, self._pos) if n > 0 else b""
+        self._pos += len(data)
+        return data
+
+
+class SegmentedFfmpegEngine(FfmpegEngine):
+    """
+    Splits long audio into segments encoded in parallel, one ffmpeg per core.
+
+    The audio is decoded once into a raw PCM spool file. The timeline is cut
+    on MP3 frame boundaries (multiples of 1152 samples) and each segment is
+    encoded as CBR with the bit reservoir off, so every frame is
+    self-contained. An encoder started mid-stream gets a few frames of the
+    preceding audio first and those frames are dropped again, which puts
+    every kept frame at exactly the position and sample offset it would
+    have in a single continuous encode. The frames are then concatenated in
+    order into the GridFS file, without gaps or overlaps at the seams.
+    Small videos and MP3 stream copies go through the plain ffmpeg path.
+    """
+
+    name = "segmented"
+
+    def probe_audio(self, head=None, path=None):
+        """Return codec, sample rate and channels of the first audio stream, or None"""
+        result = subprocess.run(
+            [FFPROBE_BINARY, "-v", "error", "-select_streams", "a:0",
+             "-show_entries", "stream=codec_name,sample_rate,channels", "-of", "json",
+             "-i", path or "pipe:0"],
+            input=head, capture_output=True,
+        )
+        try:
+            stream = json.loads(result.stdout)["streams"][0]
+        except (ValueError, KeyError, IndexError):
+            return None
+        return {
+            "codec": stream.get("codec_name"),
+            "sample_rate": int(stream.get("sample_rate") or 0),
+            "channels": int(stream.get("channels") or 0),
+        }
+
+    def extract(self, video, mp3_out, logger, video_id=None):
+        if getattr(video, "length", SEGMENT_MIN_BYTES) < SEGMENT_MIN_BYTES:
+            return super().extract(video, mp3_out, logger, video_id)
+
+        head = video.read(PROBE_BYTES)
+        video.seek(0)
+        info = self.probe_audio(head)
+        if info is not None and info["codec"] == "mp3":
+            return super().extract(video, mp3_out, logger, video_id)
+
+        with tempfile.NamedTemporaryFile(suffix=".video") as spool, tempfile.TemporaryFile() as pcm:
+            source = video
+            input_args = ["-i", "pipe:0"]
+            if info is None:
+                logger.info("Video is not streamable, spooling to disk for ffmpeg", extra={'video_id': video_id})
+                with metrics.CONVERSION_STAGE_SECONDS.labels("fetch").time():
+                    copy_stream(video, spool)
+                    spool.flush()
+                info = self.probe_audio(path=spool.name)
+                source = None
+                input_args = ["-i", spool.name]
+            if info is None:
+                raise ExtractionError("no readable audio stream in video")
+
+            # MPEG-1 rates keep 1152-sample frames; LAME takes at most stereo
+            rate = info["sample_rate"] if info["sample_rate"] in MPEG1_SAMPLE_RATES else 44100
+            channels = min(info["channels"] or 2, 2)
+            with metrics.CONVERSION_STAGE_SECONDS.labels("decode").time():
+                self._run([*input_args, "-vn", "-map", "0:a:0", "-c:a", "pcm_s16le", "-f", "s16le",
+                           "-ar", str(rate), "-ac", str(channels), "pipe:1"], source, pcm)
+            pcm.flush()
+            spool.truncate(0)
+
+            frame_bytes = SAMPLES_PER_FRAME * channels * 2
+            total_bytes = pcm.seek(0, os.SEEK_END)
+            total_frames = -(-total_bytes // frame_bytes)
+            segment_frames = max(int(SEGMENT_MIN_SECONDS * rate) // SAMPLES_PER_FRAME, 1)
+            jobs = max(min(SEGMENT_JOBS, total_frames // segment_frames), 1)
+            # Frame index where each segment starts, plus the end
+            bounds = [total_frames * i // jobs for i in range(jobs)] + [total_frames]
+
+            logger.info("Encoding audio in parallel segments", extra={
+                'video_id': video_id,
+                'source_codec': info["codec"],
+                'segments': jobs,
+                'audio_seconds': round(total_bytes / (rate * channels * 2), 1)
+            })
+            return self._encode_segments(pcm.fileno(), total_bytes, frame_bytes, bounds, rate, channels, mp3_out)
+
+    def _encode_segments(self, pcm_fd, total_bytes, frame_bytes, bounds, rate, channels, mp3_out):
+        segments = list(zip(bounds, bounds[1:]))
+        started = time.perf_counter()
+        # Time spent writing frames to GridFS; the rest is waiting on encoders
+        storing = 0.0
+        with ThreadPoolExecutor(max_workers=len(segments)) as pool:
+            futures = [
+                pool.submit(self._encode_segment, pcm_fd, total_bytes, frame_bytes, first, last, rate, channels)
+                for first, last in segments
+            ]
+            written = 0
+            try:
+                for (first, last), future in zip(segments, futures):
+                    encoded, skip = future.result()
+                    with encoded:
+                        encoded.seek(0)
+                        frames = read_mp3_frames(encoded)
+                        for index, frame in enumerate(frames):
+                            if index < skip:
+                                continue
+                            # The final segment keeps the encoder flush frames
+                            if last != bounds[-1] and index >= skip + last - first:
+                                break
+                            write_started = time.perf_counter()
+                            mp3_out.write(frame)
+                            storing += time.perf_counter() - write_started
+                            written += len(frame)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        metrics.CONVERSION_STAGE_SECONDS.labels("encode").observe(time.perf_counter() - started - storing)
+        metrics.CONVERSION_STAGE_SECONDS.labels("store").observe(storing)
+        return written
+
+    def _encode_segment(self, pcm_fd, total_bytes, frame_bytes, first, last, rate, channels):
+        """Encode frames [first, last) plus pre/post-roll; returns (mp3 file, frames to skip)"""
+        preroll = min(first, SEGMENT_PREROLL_FRAMES)
+        start = (first - preroll) * frame_bytes
+        end = min((last + SEGMENT_POSTROLL_FRAMES) * frame_bytes, total_bytes)
+        encoded = tempfile.TemporaryFile()
+        try:
+            self._run(["-f", "s16le", "-ar", str(rate), "-ac", str(channels), "-i", "pipe:0",
+                       "-c:a", "libmp3lame", "-b:a", MP3_BITRATE, "-reservoir", "0", "-threads", "1",
+                       "-write_xing", "0", "-id3v2_version", "0", "-f", "mp3", "pipe:1"],
+                      PcmRange(pcm_fd, start, end), encoded)
+        except BaseException:
+            encoded.close()
+            raise
+        return encoded, preroll
+
+
+class MoviepyEngine:
+    """
+    The original extraction path: spools the video to a temporary file,
+    decodes it with moviepy and writes the MP3 to /tmp before copying it into
+    GridFS.
+    """
+
+    name = "moviepy"
+
+    def extract(self, video, mp3_out, logger, video_id=None):
+        import moviepy.editor
+
+        with tempfile.NamedTemporaryFile() as tf:
+            copy_stream(video, tf)
+            tf.flush()
+
+            logger.info("Extracting audio from video with moviepy", extra={'video_id': video_id})
+            encode_started = time.perf_counter()
+            clip = moviepy.editor.VideoFileClip(tf.name)
+            mp3_path = os.path.join(tempfile.gettempdir(), f"{video_id or os.getpid()}.mp3")
+            try:
+                clip.audio.write_audiofile(mp3_path, logger=None)
+                metrics.CONVERSION_STAGE_SECONDS.labels("encode").observe(time.perf_counter() - encode_started)
+                with open(mp3_path, "rb") as f:
+                    return copy_stream(f, mp3_out)
+            finally:
+                clip.close()
+                if os.path.exists(mp3_path):
+                    os.remove(mp3_path)
+
+
+ENGINES = {
+    FfmpegEngine.name: FfmpegEngine,
+    SegmentedFfmpegEngine.name: SegmentedFfmpegEngine,
+    MoviepyEngine.name: MoviepyEngine,
+}
+
+
+def get_engine(name=None):
+    """Return an instance of the configured (or named) extraction engine"""
+    name = (name or ENGINE).lower()
+    try:
+        return ENGINES[name]()
+    except KeyError:
+        raise ValueError(f"unknown converter engine: {name} (expected one of {', '.join(ENGINES)})")
@@ -0,0 +1,47 @@
+import os, time
+from pymongo.errors import DuplicateKeyError
+
+# Conversions one user may have running at once across all workers; 0 disables
+USER_MAX_ACTIVE = int(os.environ.get("CONVERTER_USER_MAX_ACTIVE", 2))
+# A lease not released within this many seconds (crashed worker) is dropped
+LEASE_TTL = float(os.environ.get("CONVERTER_USER_LEASE_TTL", 2 * 60 * 60))
+
+
+class UserLeases:
+    """
+    Per-user cap on concurrent conversions, shared by every worker through
+    MongoDB.
+
+    Each user has one document holding the leases of their running jobs:
+        {"_id": username, "leases": [{"id": str, "expires": float}]}
+    A lease is only pushed while the array is shorter than the limit, in one
+    atomic update, so two workers cannot both take the last slot. Leases of
+    workers that died are dropped once they expire.
+    """
+
+    def __init__(self, collection, limit=USER_MAX_ACTIVE, lease_ttl=LEASE_TTL):
+        self.collection = collection
+        self.limit = limit
+        self.lease_ttl = lease_ttl
+
+    def acquire(self, username, lease_id):
+        """Take a slot for `username`; False when the user is at the limit"""
+        if not self.limit or not username:
+            return True
+        now = time.time()
+        self.collection.update_one({"_id": username}, {"$pull": {"leases": {"expires": {"$lt": now}}}})
+        try:
+            self.collection.update_one(
+                {"_id": username, f"leases.{self.limit - 1}": {"$exists": False}},
+                {"$push": {"leases": {"id": lease_id, "expires": now + self.lease_ttl}}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # The document exists but did not match: every slot is taken
+            return False
+        return True
+
+    def release(self, username, lease_id):
+        if not self.limit or not username:
+            return
+        self.collection.update_one({"_id": username}, {"$pull": {"leases": {"id": lease_id}}})
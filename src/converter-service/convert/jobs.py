@@ -0,0 +1,117 @@
+import os, time, datetime
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+
+# Seconds between orphan sweeps in the parent process; 0 disables them
+SWEEP_INTERVAL = float(os.environ.get("CONVERTER_ORPHAN_SWEEP_INTERVAL", 600))
+# Only files and chunks older than this are considered, so conversions that
+# are still running are never touched
+SWEEP_GRACE = float(os.environ.get("CONVERTER_ORPHAN_GRACE", 6 * 60 * 60))
+# How far back the first sweep looks
+SWEEP_LOOKBACK = float(os.environ.get("CONVERTER_ORPHAN_LOOKBACK", 7 * 24 * 60 * 60))
+
+# Seconds a published job's checkpoint is kept; redeliveries arrive well
+# within this, and MongoDB's TTL monitor removes the document afterwards
+JOB_RETENTION = int(os.environ.get("CONVERTER_JOB_RETENTION", 7 * 24 * 60 * 60))
+
+# Stages in order; a job only ever moves forward
+STAGES = ("retrieved", "encoded", "stored", "published")
+
+
+class JobStore:
+    """
+    Checkpoints of each video's conversion, keyed by video_fid:
+        {"_id": video_fid, "stage": str, "mp3_fid": ObjectId, "attempts": int,
+         "updated": datetime, "finished_at": datetime}
+    A redelivered message resumes after the last completed stage instead of
+    converting the video again. Published jobs expire `retention` seconds
+    after finished_at.
+    """
+
+    def __init__(self, collection, retention=JOB_RETENTION):
+        self.collection = collection
+        self.collection.create_index("finished_at", expireAfterSeconds=retention)
+
+    def begin(self, video_id):
+        """Count a processing attempt and return the job document"""
+        return self.collection.find_one_and_update(
+            {"_id": video_id},
+            {"$inc": {"attempts": 1}, "$setOnInsert": {"stage": None},
+             "$currentDate": {"updated": True}},
+            upsert=True, return_document=ReturnDocument.AFTER,
+        )
+
+    def advance(self, video_id, stage, **fields):
+        """Record that `stage` completed"""
+        dates = {"updated": True}
+        if stage == STAGES[-1]:
+            dates["finished_at"] = True
+        self.collection.update_one({"_id": video_id}, {
+            "$set": {"stage": stage, **fields},
+            "$currentDate": dates,
+        })
+
+    @staticmethod
+    def reached(job, stage):
+        return job.get("stage") in STAGES and STAGES.index(job["stage"]) >= STAGES.index(stage)
+
+
+def find_stored_mp3(fs_mp3s, video_id):
+    """An MP3 finished for this video by an attempt that died before checkpointing"""
+    found = fs_mp3s.find({"metadata.video_fid": video_id}).sort("uploadDate", -1).limit(1)
+    for grid_out in found:
+        return grid_out._id
+    return None
+
+
+class OrphanSweeper:
+    """
+    Deletes MP3 data no job or dedup entry points to:
+      - MP3 files tagged with a video_fid that are not the job's mp3_fid
+        (left by an attempt that was converted again after a crash); files
+        whose job has expired are kept, as nothing tells them apart
+      - fs.chunks without an fs.files document (a crash mid-upload)
+    Runs in the converter's parent process, so one sweep per pod.
+    """
+
+    def __init__(self, db_mp3s, fs_mp3s, logger, grace=SWEEP_GRACE, lookback=SWEEP_LOOKBACK):
+        self.db = db_mp3s
+        self.fs = fs_mp3s
+        self.logger = logger
+        self.grace = grace
+        # Files and chunks created before this point were checked by an earlier sweep
+        self._checked_until = time.time() - lookback
+
+    def _orphaned(self, doc):
+        job = self.db.conversion_jobs.find_one({"_id": doc["metadata"]["video_fid"]}, {"mp3_fid": 1})
+        if job is None or job.get("mp3_fid") == doc["_id"]:
+            return False
+        return self.db.conversions.find_one({"mp3_fid": doc["_id"]}, {"_id": 1}) is None
+
+    def sweep(self):
+        cutoff = time.time() - self.grace
+        since = datetime.datetime.fromtimestamp(self._checked_until, datetime.timezone.utc)
+        until = datetime.datetime.fromtimestamp(cutoff, datetime.timezone.utc)
+
+        files_deleted = 0
+        candidates = self.db.fs.files.find(
+            {"metadata.video_fid": {"$exists": True}, "uploadDate": {"$gte": since, "$lt": until}},
+            {"_id": 1, "metadata.video_fid": 1},
+        )
+        for doc in candidates:
+            if self._orphaned(doc):
+                self.fs.delete(doc["_id"])
+                files_deleted += 1
+
+        chunks_deleted = 0
+        window = {"$gte": ObjectId.from_datetime(since), "$lt": ObjectId.from_datetime(until)}
+        for files_id in self.db.fs.chunks.distinct("files_id", {"_id": window, "n": 0}):
+            if self.db.fs.files.find_one({"_id": files_id}, {"_id": 1}) is None:
+                chunks_deleted += self.db.fs.chunks.delete_many({"files_id": files_id}).deleted_count
+        self._checked_until = cutoff
+
+        self.logger.info("Orphan sweep finished", extra={
+            'files_deleted': files_deleted,
+            'chunks_deleted': chunks_deleted
+        })
+        return files_deleted, chunks_deleted
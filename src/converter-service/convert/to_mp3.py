@@ -1,76 +1,134 @@
-import pika, json, tempfile, os
+import pika, json, os, time
 from bson.objectid import ObjectId
-import moviepy.editor
+from convert import engines
+from convert.jobs import JobStore, find_stored_mp3
+from src.common.metrics import prometheus as metrics
+from src.common.tracing import otel as tracing
 
-def start(message, fs_videos, fs_mp3s, channel, logger):
+def convert(video_id, fs_videos, fs_mp3s, logger, jobs=None):
+    """
+    Extract the audio of a stored video into a new MP3 in GridFS, tagged with
+    the video's id so an attempt that dies before checkpointing can be found.
+    Returns (mp3_id, conversion_seconds, None) or (None, None, error).
+    """
+    # Get the video from GridFS
+    logger.debug(f"Retrieving video from GridFS", extra={'video_id': video_id})
+    try:
+        with tracing.tracer.start_as_current_span("fetch"), metrics.CONVERSION_STAGE_SECONDS.labels("fetch").time():
+            out = fs_videos.get(ObjectId(video_id))
+    except Exception as e:
+        logger.error(f"Failed to retrieve video from GridFS: {str(e)}", extra={'video_id': video_id})
+        return None, None, f"Failed to retrieve video: {str(e)}"
+    if jobs:
+        jobs.advance(video_id, "retrieved")
+
+    # Extract the audio straight into a GridFS upload stream
+    engine = engines.get_engine()
+    mp3_file = fs_mp3s.new_file(metadata={"video_fid": video_id})
+    logger.info("Extracting audio from video", extra={
+        'video_id': video_id,
+        'engine': engine.name
+    })
+
+    try:
+        started = time.perf_counter()
+        with tracing.tracer.start_as_current_span("extract", attributes={'engine': engine.name, 'video.bytes': out.length}):
+            size = engine.extract(out, mp3_file, logger, video_id)
+        if jobs:
+            jobs.advance(video_id, "encoded")
+        mp3_file.close()
+        elapsed = time.perf_counter() - started
+        # The engine streams both files, so each transfer spans the whole extraction
+        metrics.observe_gridfs("read", out.length, elapsed)
+        metrics.observe_gridfs("write", size, elapsed)
+        if jobs:
+            jobs.advance(video_id, "stored", mp3_fid=mp3_file._id)
+
+        logger.info("MP3 saved to GridFS", extra={
+            'video_id': video_id,
+            'mp3_id': str(mp3_file._id),
+            'engine': engine.name,
+            'bytes': size,
+            'duration_seconds': round(elapsed, 3)
+        })
+        return mp3_file._id, elapsed, None
+
+    except Exception as e:
+        mp3_file.abort()
+        logger.error(f"Failed to extract audio: {str(e)}", extra={'video_id': video_id})
+        return None, None, f"Failed to extract audio: {str(e)}"
+    finally:
+        out.close()
+
+def start(message, fs_videos, fs_mp3s, channel, logger, dedup=None, jobs=None):
     try:
         message_data = json.loads(message)
         video_id = message_data.get("video_fid")
-        
+        sha256 = message_data.get("sha256")
+
         logger.info("Starting conversion process", extra={
             'video_id': video_id
         })
-        
-        # Get the video from GridFS
-        logger.debug(f"Retrieving video from GridFS", extra={'video_id': video_id})
-        try:
-            out = fs_videos.get(ObjectId(video_id))
-        except Exception as e:
-            logger.error(f"Failed to retrieve video from GridFS: {str(e)}", extra={'video_id': video_id})
-            return f"Failed to retrieve video: {str(e)}"
-        
-        # Create temporary file for video processing
-        logger.debug("Creating temporary file")
-        tf = tempfile.NamedTemporaryFile()
-        
-        # Write video content to temporary file
-        tf.write(out.read())
-        
-        # Extract audio from video
-        logger.info("Extracting audio from video", extra={'video_id': video_id})
-        try:
-            audio = moviepy.editor.VideoFileClip(tf.name).audio
-            tf.close()
-        except Exception as e:
-            logger.error(f"Failed to extract audio: {str(e)}", extra={'video_id': video_id})
-            return f"Failed to extract audio: {str(e)}"
-        
-        # Create MP3 file
-        tf_path = tempfile.gettempdir() + f"/{video_id}.mp3"
-        logger.info("Writing audio to MP3 file", extra={
-            'video_id': video_id, 
-            'mp3_path': tf_path
-        })
-        
-        try:
-            audio.write_audiofile(tf_path)
-        except Exception as e:
-            logger.error(f"Failed to write audio file: {str(e)}", extra={'video_id': video_id})
-            return f"Failed to write audio file: {str(e)}"
-        
-        # Save MP3 to MongoDB
-        logger.info("Saving MP3 to GridFS", extra={'video_id': video_id})
-        try:
-            f = open(tf_path, "rb")
-            data = f.read()
-            mp3_id = fs_mp3s.put(data)
-            f.close()
-            
-            # Remove temporary MP3 file
-            os.remove(tf_path)
-            
-            logger.debug("MP3 saved successfully", extra={
+
+        # Checkpoint of an earlier delivery of this message, if any
+        job = jobs.begin(video_id) if jobs else {}
+        if jobs and JobStore.reached(job, "published"):
+            logger.info("Video already converted and published, skipping redelivery", extra={
                 'video_id': video_id,
-                'mp3_id': str(mp3_id)
+                'mp3_id': str(job.get("mp3_fid")),
+                'attempts': job.get("attempts")
             })
-            
-            # Update message with MP3 ID
-            message_data["mp3_fid"] = str(mp3_id)
-            
-        except Exception as e:
-            logger.error(f"Failed to save MP3 to GridFS: {str(e)}", extra={'video_id': video_id})
-            return f"Failed to save MP3: {str(e)}"
-        
+            return None
+
+        cached = None
+        mp3_id = None
+        if jobs and JobStore.reached(job, "stored") and fs_mp3s.exists(job["mp3_fid"]):
+            mp3_id = job["mp3_fid"]
+        elif jobs:
+            # An attempt may have stored the MP3 and died before checkpointing
+            mp3_id = find_stored_mp3(fs_mp3s, video_id)
+            if mp3_id is not None:
+                jobs.advance(video_id, "stored", mp3_fid=mp3_id)
+        if mp3_id is not None:
+            logger.info("Resuming conversion with already stored MP3", extra={
+                'video_id': video_id,
+                'mp3_id': str(mp3_id),
+                'attempts': job.get("attempts")
+            })
+        else:
+            # A video with the same content was converted before: reuse its MP3
+            cached = dedup.lookup(sha256, fs_mp3s) if dedup else None
+        if cached:
+            mp3_id = cached["mp3_fid"]
+            if jobs:
+                jobs.advance(video_id, "stored", mp3_fid=mp3_id)
+            logger.info("Duplicate video, reusing existing MP3", extra={
+                'video_id': video_id,
+                'mp3_id': str(mp3_id),
+                'sha256': sha256,
+                'seconds_saved': cached.get("conversion_seconds"),
+                **dedup.local_stats()
+            })
+        elif mp3_id is None:
+            mp3_id, conversion_seconds, err = convert(video_id, fs_videos, fs_mp3s, logger, jobs)
+            if err:
+                return err
+            if dedup:
+                # Recorded before the publish: with checkpoints the MP3 is kept
+                # for the retry, and without them lookup() drops the entry once
+                # the MP3 has been deleted
+                try:
+                    dedup.remember(sha256, mp3_id, conversion_seconds)
+                except Exception as e:
+                    # Only future dedup hits are lost
+                    logger.warning(f"Failed to record conversion for dedup: {str(e)}", extra={
+                        'video_id': video_id,
+                        'mp3_id': str(mp3_id)
+                    })
+
+        # Update message with MP3 ID
+        message_data["mp3_fid"] = str(mp3_id)
+
         # Publish message to MP3 queue
         mp3_queue = os.environ.get("MP3_QUEUE")
         logger.info("Publishing message to MP3 queue", extra={
@@ -78,36 +136,55 @@ def start(message, fs_videos, fs_mp3s, channel, logger):
             'mp3_id': str(mp3_id),
             'queue': mp3_queue
         })
-        
+
         try:
-            channel.basic_publish(
-                exchange="",
-                routing_key=mp3_queue,
-                body=json.dumps(message_data),
-                properties=pika.BasicProperties(
-                    delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE
-                ),
-            )
-            
+            publish_started = time.perf_counter()
+            # The trace context travels in the headers to the notification service
+            with tracing.producer_span(mp3_queue, video_fid=video_id, mp3_fid=str(mp3_id)) as headers:
+                channel.basic_publish(
+                    exchange="",
+                    routing_key=mp3_queue,
+                    body=json.dumps(message_data),
+                    properties=pika.BasicProperties(
+                        delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE,
+                        headers=headers
+                    ),
+                )
+            metrics.CONVERSION_STAGE_SECONDS.labels("publish").observe(time.perf_counter() - publish_started)
+
+            if jobs:
+                try:
+                    jobs.advance(video_id, "published", mp3_fid=mp3_id)
+                except Exception as e:
+                    # A redelivery would only publish the notification again
+                    logger.warning(f"Failed to checkpoint published job: {str(e)}", extra={
+                        'video_id': video_id,
+                        'mp3_id': str(mp3_id)
+                    })
+
             logger.info("Conversion completed successfully", extra={
                 'video_id': video_id,
-                'mp3_id': str(mp3_id)
+                'mp3_id': str(mp3_id),
+                'deduplicated': bool(cached),
+                **(dedup.local_stats() if dedup else {})
             })
-            
+
             return None
-            
+
         except Exception as e:
             logger.error(f"Failed to publish message: {str(e)}", extra={
                 'video_id': video_id,
                 'mp3_id': str(mp3_id)
             })
-            
-            # Cleanup: delete MP3 file from GridFS if message publishing fails
-            logger.debug("Cleaning up MP3 from GridFS after publish failure", extra={'mp3_id': str(mp3_id)})
-            fs_mp3s.delete(mp3_id)
-            
+
+            # The MP3 stays in GridFS: the requeued message resumes from the
+            # "stored" checkpoint and only retries the publish
+            if not jobs and not cached:
+                logger.debug("Cleaning up MP3 from GridFS after publish failure", extra={'mp3_id': str(mp3_id)})
+                fs_mp3s.delete(mp3_id)
+
             return f"Failed to publish message: {str(e)}"
-            
+
     except json.JSONDecodeError as e:
         logger.error(f"Invalid message format: {str(e)}")
         return f"Invalid message format: {str(e)}"
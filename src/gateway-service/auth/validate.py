@@ -1,6 +1,8 @@
-import os, requests, json, logging
+import os, jwt, json, logging, time, hashlib
 from fastapi import Request, HTTPException, Depends, Header
 from typing import Optional, Tuple, Any, Dict, Union
+from auth_svc.client import get_client
+from src.common.cache.ttl_cache import TTLCache
 
 # Create a logger for debugging
 logger = logging.getLogger("validate")
@@ -9,42 +11,116 @@ handler = logging.StreamHandler()
 handler.setLevel(logging.DEBUG)
 logger.addHandler(handler)
 
+# "remote" asks auth-service /validate for every token, "local" verifies the
+# HS256 signature in-process with the JWT_SECRET auth-service signs with,
+# "jwks" verifies tokens that carry a kid against auth-service's published
+# public keys (app.state.jwks) and sends the rest to /validate.
+VALIDATION_MODE = os.environ.get('AUTH_VALIDATION_MODE', 'remote').lower()
+
+# Decoded claims of recently validated tokens, keyed by the token's SHA-256.
+# Entries expire at min(exp, TOKEN_CACHE_TTL); TOKEN_CACHE_SIZE=0 disables it.
+token_cache = TTLCache(
+    maxsize=int(os.environ.get('TOKEN_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('TOKEN_CACHE_TTL', 60)),
+)
+
 async def get_token(authorization: Optional[str] = Header(None)):
     """Extract token from authorization header"""
     if not authorization:
         raise HTTPException(status_code=401, detail="missing credentials")
     return authorization
 
-async def token(request: Request = None, authorization: str = Depends(get_token)) -> Tuple[Optional[str], Optional[Tuple[str, int]]]:
-    """Validate token with auth service"""
+def decode_local(authorization: str) -> Tuple[Optional[Dict[str, Any]], Optional[Tuple[str, int]]]:
+    """Verify an HS256 token locally, mirroring auth-service /validate"""
+    encoded_jwt = authorization[7:] if authorization.startswith('Bearer ') else authorization
+    secret = os.environ.get('JWT_SECRET')
+    if not secret:
+        logger.error("AUTH_VALIDATION_MODE=local requires JWT_SECRET")
+        return None, ("local token validation is not configured", 500)
+
+    try:
+        return jwt.decode(encoded_jwt, secret, algorithms=["HS256"]), None
+    except jwt.ExpiredSignatureError:
+        logger.warning("Token expired")
+        return None, ("Token expired", 401)
+    except jwt.InvalidTokenError as e:
+        logger.warning(f"Invalid token: {e}")
+        return None, ("Unauthorized", 401)
+
+async def decode_jwks(verifier, authorization: str) -> Tuple[Optional[Dict[str, Any]], Optional[Tuple[str, int]]]:
+    """Verify an asymmetrically signed token against the cached JWKS"""
+    encoded_jwt = authorization[7:] if authorization.startswith('Bearer ') else authorization
+    try:
+        return await verifier.verify(encoded_jwt), None
+    except jwt.ExpiredSignatureError:
+        logger.warning("Token expired")
+        return None, ("Token expired", 401)
+    except jwt.InvalidTokenError as e:
+        logger.warning(f"Invalid token: {e}")
+        return None, ("Unauthorized", 401)
+
+def has_kid(authorization: str) -> bool:
+    encoded_jwt = authorization[7:] if authorization.startswith('Bearer ') else authorization
+    try:
+        return "kid" in jwt.get_unverified_header(encoded_jwt)
+    except jwt.InvalidTokenError:
+        return False
+
+async def validate_remote(client, authorization: str, batcher=None) -> Tuple[Optional[Dict[str, Any]], Optional[Tuple[str, int]]]:
+    """Ask auth-service to validate the token over the shared keep-alive client"""
+    if batcher is not None:
+        # Shares a /validate/batch request with concurrent validations
+        return await batcher.validate(authorization)
+
+    logger.debug(f"Sending token to auth service")
+    response = await client.post("/validate", headers={"Authorization": authorization})
+
+    logger.debug(f"Auth service response: {response.status_code}")
+
+    if response.status_code == 200:
+        try:
+            logger.debug("Token validated successfully")
+            return response.json(), None
+        except json.JSONDecodeError as e:
+            logger.error(f"Error parsing auth response: {e}")
+            return None, (f"error parsing auth response: {e}", 500)
+    else:
+        logger.warning(f"Auth validation failed: {response.status_code} {response.text}")
+        return None, (response.text, response.status_code)
+
+def token_key(authorization: str) -> str:
+    """Cache key for a token; the raw token never sits in the cache"""
+    encoded_jwt = authorization[7:] if authorization.startswith('Bearer ') else authorization
+    return hashlib.sha256(encoded_jwt.encode()).hexdigest()
+
+async def token(request: Request, authorization: str = Depends(get_token)) -> Tuple[Optional[Dict[str, Any]], Optional[Tuple[str, int]]]:
+    """Validate token and return its decoded claims"""
     if not authorization:
         logger.error("No authorization header provided")
         return None, ("missing credentials", 401)
-    
+
     # Log the token for debugging (first 10 chars only for security)
     safe_token = authorization[:10] + "..." if authorization else "None"
     logger.debug(f"Token received: {safe_token}")
-    
-    try:
-        # Forward token as-is to auth service
-        logger.debug(f"Sending token to auth service")
-        response = requests.post(
-            f"http://{os.environ.get('AUTH_SVC_ADDRESS')}/validate",
-            headers={"Authorization": authorization},
-        )
-        
-        logger.debug(f"Auth service response: {response.status_code}")
-        
-        if response.status_code == 200:
-            try:
-                logger.debug("Token validated successfully")
-                return response.text, None
-            except Exception as e:
-                logger.error(f"Error parsing auth response: {e}")
-                return None, (f"error parsing auth response: {e}", 500)
-        else:
-            logger.warning(f"Auth validation failed: {response.status_code} {response.text}")
-            return None, (response.text, response.status_code)
-    except Exception as e:
-        logger.error(f"Error validating token: {e}")
-        return None, (f"error validating token: {e}", 500)
\ No newline at end of file
+
+    async def load():
+        try:
+            if VALIDATION_MODE == 'local':
+                claims, err = decode_local(authorization)
+            elif VALIDATION_MODE == 'jwks' and has_kid(authorization):
+                claims, err = await decode_jwks(request.app.state.jwks, authorization)
+            else:
+                claims, err = await validate_remote(get_client(request), authorization,
+                                                   getattr(request.app.state, 'auth_batcher', None))
+        except Exception as e:
+            logger.error(f"Error validating token: {e}")
+            claims, err = None, (f"error validating token: {e}", 500)
+
+        # Only successful validations are cached, and never past the token's exp
+        ttl = 0
+        if not err:
+            exp = claims.get("exp")
+            ttl = exp - time.time() if isinstance(exp, (int, float)) else None
+        return (claims, err), ttl
+
+    return await token_cache.get_or_load(token_key(authorization), load)
@@ -1,19 +1,18 @@
-import os, requests, json
+import json
 from fastapi import Request, HTTPException, Depends
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from auth_svc.client import get_client
 
 security = HTTPBasic()
 
-async def login_with_credentials(credentials: HTTPBasicCredentials):
+async def login_with_credentials(client, credentials: HTTPBasicCredentials):
     """Handle login with basic auth credentials"""
     if not credentials.username or not credentials.password:
         raise HTTPException(status_code=401, detail="missing credentials")
 
     basicAuth = (credentials.username, credentials.password)
 
-    response = requests.post(
-        f"http://{os.environ.get('AUTH_SVC_ADDRESS')}/login", auth=basicAuth
-    )
+    response = await client.post("/login", auth=basicAuth)
 
     if response.status_code == 200:
         try:
@@ -26,6 +25,6 @@ async def login_with_credentials(credentials: HTTPBasicCredentials):
     else:
         return None, (response.text, response.status_code)
 
-async def login(request: Request = None, credentials: HTTPBasicCredentials = Depends(security)):
+async def login(request: Request, credentials: HTTPBasicCredentials = Depends(security)):
     """Handle login request from either FastAPI Request or direct credentials"""
-    return await login_with_credentials(credentials)
\ No newline at end of file
+    return await login_with_credentials(get_client(request), credentials)
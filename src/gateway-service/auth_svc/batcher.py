@@ -0,0 +1,88 @@
+import asyncio, os
+
+# Seconds the first validation of a batch waits for others to join; 0 sends
+# every validation to /validate on its own
+BATCH_WINDOW = float(os.environ.get('AUTH_BATCH_WINDOW_MS', 0)) / 1000
+# A batch is sent as soon as it holds this many tokens
+BATCH_MAX = int(os.environ.get('AUTH_BATCH_MAX', 64))
+
+
+class ValidationBatcher:
+    """
+    Coalesces concurrent token validations into auth-service /validate/batch.
+
+    The first validation starts a `window`-second timer; every validation
+    arriving before it fires (or before the batch reaches `max_batch`) goes
+    out in the same request. validate() returns what validate_remote would:
+    (claims, None) or (None, (detail, status)). When the batch request
+    itself fails, each caller gets that failure.
+    """
+
+    def __init__(self, client, window=BATCH_WINDOW, max_batch=BATCH_MAX):
+        self.client = client
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = []  # (authorization, future)
+        self._timer = None
+        self._in_flight = set()
+        self.counters = {"batches": 0, "tokens": 0, "failed_batches": 0}
+
+    async def validate(self, authorization):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((authorization, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._send(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _send(self, batch):
+        self.counters["batches"] += 1
+        self.counters["tokens"] += len(batch)
+        try:
+            response = await self.client.post("/validate/batch", json={"tokens": [token for token, _ in batch]})
+            if response.status_code == 200:
+                results = [
+                    (result["claims"], None) if "claims" in result else (None, (result["error"], result["status"]))
+                    for result in response.json()["results"]
+                ]
+                if len(results) != len(batch):
+                    # Unmatched callers would wait forever
+                    raise ValueError(f"auth-service returned {len(results)} results for {len(batch)} tokens")
+            else:
+                self.counters["failed_batches"] += 1
+                results = [(None, (response.text, response.status_code))] * len(batch)
+        except Exception as e:
+            self.counters["failed_batches"] += 1
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def close(self):
+        """Send what is pending and wait for the batches in flight"""
+        self._flush()
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+
+    def stats(self):
+        return {
+            **self.counters,
+            'window_ms': self.window * 1000,
+            'max_batch': self.max_batch,
+            'pending': len(self._pending),
+            'in_flight': len(self._in_flight),
+        }
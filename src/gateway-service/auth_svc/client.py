@@ -0,0 +1,26 @@
+import os, httpx
+from fastapi import Request
+from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
+
+def create_client() -> httpx.AsyncClient:
+    """
+    Build the shared keep-alive HTTP client used to talk to the auth service.
+    Created once in the gateway lifespan and closed on shutdown.
+    """
+    timeout = float(os.environ.get('AUTH_HTTP_TIMEOUT', 5.0))
+    limits = httpx.Limits(
+        max_connections=int(os.environ.get('AUTH_HTTP_MAX_CONNECTIONS', 100)),
+        max_keepalive_connections=int(os.environ.get('AUTH_HTTP_MAX_KEEPALIVE', 20)),
+    )
+    client = httpx.AsyncClient(
+        base_url=f"http://{os.environ.get('AUTH_SVC_ADDRESS')}",
+        timeout=httpx.Timeout(timeout, connect=min(timeout, 2.0)),
+        limits=limits,
+    )
+    # Client spans, and traceparent headers so auth-service joins the trace
+    HTTPXClientInstrumentor.instrument_client(client)
+    return client
+
+def get_client(request: Request) -> httpx.AsyncClient:
+    """Return the client stored on the application state by the lifespan."""
+    return request.app.state.auth_client
@@ -0,0 +1,149 @@
+import asyncio, os
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from pymongo.errors import OperationFailure, PyMongoError
+
+# Use absolute import for logger
+from src.common.log.custom_logger import get_custom_logger
+
+logger = get_custom_logger(service_name="gateway-events")
+
+# Events buffered per SSE client before it is considered too slow and dropped
+SUBSCRIBER_QUEUE_SIZE = int(os.environ.get('SSE_QUEUE_SIZE', 100))
+# Poll interval of the fallback watcher used when change streams are unavailable
+POLL_INTERVAL = float(os.environ.get('SSE_POLL_INTERVAL', 2.0))
+
+_PROJECTION = {"_id": 1, "filename": 1, "uploadDate": 1}
+
+
+def to_event(doc):
+    """Turn an fs.files document into an SSE event dict"""
+    file_id = str(doc["_id"])
+    return {
+        "id": file_id,
+        "filename": doc.get("filename", f"mp3_{file_id}"),
+    }
+
+
+class Subscriber:
+    """One SSE client: a bounded queue plus an overflow flag"""
+
+    def __init__(self, maxsize):
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.overflowed = asyncio.Event()
+
+
+class FileEventBroadcaster:
+    """
+    Watches the mp3 `fs.files` collection once per process and fans new-file
+    events out to every connected SSE client.
+
+    A change stream is used when MongoDB supports it (replica sets); on a
+    standalone server it falls back to polling for files with an uploadDate
+    newer than the last one seen. Clients that fall more than
+    SSE_QUEUE_SIZE events behind are disconnected and catch up through
+    Last-Event-ID when the browser reconnects.
+    """
+
+    def __init__(self, files_collection, queue_size=SUBSCRIBER_QUEUE_SIZE, poll_interval=POLL_INTERVAL):
+        self.files = files_collection
+        self.queue_size = queue_size
+        self.poll_interval = poll_interval
+        self.subscribers = set()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    def subscribe(self):
+        subscriber = Subscriber(self.queue_size)
+        self.subscribers.add(subscriber)
+        logger.info("SSE subscriber added", extra={'subscribers': len(self.subscribers)})
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+        logger.info("SSE subscriber removed", extra={'subscribers': len(self.subscribers)})
+
+    def publish(self, event):
+        for subscriber in list(self.subscribers):
+            if subscriber.overflowed.is_set():
+                continue
+            try:
+                subscriber.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                logger.warning("SSE subscriber queue full, disconnecting it")
+                subscriber.overflowed.set()
+
+    async def backfill(self, last_event_id):
+        """Return the events a client missed after the file `last_event_id`"""
+        try:
+            last = await self.files.find_one({"_id": ObjectId(last_event_id)}, _PROJECTION)
+        except InvalidId:
+            return []
+        if last is None:
+            return []
+
+        cursor = self.files.find({"$or": [
+            {"uploadDate": {"$gt": last["uploadDate"]}},
+            {"uploadDate": last["uploadDate"], "_id": {"$gt": last["_id"]}},
+        ]}, _PROJECTION).sort([("uploadDate", 1), ("_id", 1)])
+        return [to_event(doc) async for doc in cursor]
+
+    async def _run(self):
+        use_change_stream = True
+        while True:
+            try:
+                if use_change_stream:
+                    await self._watch()
+                else:
+                    await self._poll()
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                # Code 40573: change streams are only supported on replica sets
+                if use_change_stream and e.code == 40573:
+                    logger.info("Change streams unavailable, polling fs.files instead")
+                    use_change_stream = False
+                    continue
+                logger.error(f"SSE watcher failed: {str(e)}")
+            except PyMongoError as e:
+                logger.error(f"SSE watcher failed: {str(e)}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def _watch(self):
+        pipeline = [{"$match": {"operationType": "insert"}}]
+        resume_token = None
+        logger.info("SSE watcher using change stream")
+        while True:
+            async with self.files.watch(pipeline, resume_after=resume_token) as stream:
+                async for change in stream:
+                    resume_token = stream.resume_token
+                    self.publish(to_event(change["fullDocument"]))
+
+    async def _poll(self):
+        latest = await self.files.find_one({}, _PROJECTION, sort=[("uploadDate", -1), ("_id", -1)])
+        last_date = latest["uploadDate"] if latest else None
+        # Ids already published at last_date, since uploadDate is not unique
+        seen_at_last_date = {latest["_id"]} if latest else set()
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            query = {"uploadDate": {"$gte": last_date}} if last_date else {}
+            cursor = self.files.find(query, _PROJECTION).sort([("uploadDate", 1), ("_id", 1)])
+            async for doc in cursor:
+                if doc["uploadDate"] == last_date and doc["_id"] in seen_at_last_date:
+                    continue
+                if doc["uploadDate"] != last_date:
+                    last_date = doc["uploadDate"]
+                    seen_at_last_date = set()
+                seen_at_last_date.add(doc["_id"])
+                self.publish(to_event(doc))
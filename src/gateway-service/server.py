@@ -1,23 +1,32 @@
-import os, gridfs, pika, json
+import os, json
 from fastapi import FastAPI, Request, Depends, HTTPException, File, UploadFile, Query, Header, Form
-from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse, HTMLResponse
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse, HTMLResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from sse_starlette.sse import EventSourceResponse
 import asyncio # Needed for SSE loop
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
 from auth import validate
-from auth_svc import access
-from storage import util
+from auth_svc import access, client as auth_client
+from auth_svc.batcher import ValidationBatcher, BATCH_WINDOW
+from storage import util, listing, resumable
+from events.broadcaster import FileEventBroadcaster
+from messaging.publisher import Publisher
+from src.common.queues import tiers
+from src.common.metrics import prometheus as metrics
+from src.common.tracing import otel as tracing
+from src.common.jwks.verifier import JWKSVerifier
 from bson.objectid import ObjectId
 from typing import Optional, Set
 import uvicorn
-import io
 from contextlib import asynccontextmanager
 
 # Import custom logger
 from src.common.log.custom_logger import get_custom_logger
 
+# Spans are exported to OTEL_EXPORTER_OTLP_ENDPOINT when it is set
+tracing.setup("gateway-service")
+
 # Set up logger
 # The get_custom_logger function now handles the configuration internally
 logger = get_custom_logger(service_name="gateway-service")
@@ -30,28 +39,57 @@ mongo_video = None
 mongo_mp3 = None
 fs_videos = None
 fs_mp3s = None
-channel = None
-connection = None
+publisher = None
+file_events = None
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global mongo_video, mongo_mp3, fs_videos, fs_mp3s, channel, connection
+    global mongo_video, mongo_mp3, fs_videos, fs_mp3s, publisher, file_events
     # Startup logic
     logger.info("Connecting to MongoDB", extra={
         'videos_uri': os.environ.get('MONGODB_VIDEOS_URI'),
         'mp3s_uri': os.environ.get('MONGODB_MP3S_URI')
     })
     try:
-        mongo_video = MongoClient(os.environ.get('MONGODB_VIDEOS_URI'))
-        mongo_mp3 = MongoClient(os.environ.get('MONGODB_MP3S_URI'))
+        # Motor runs pymongo I/O on its own thread pool (sized by MOTOR_MAX_WORKERS)
+        # so GridFS reads and writes never block the event loop.
+        mongo_video = AsyncIOMotorClient(os.environ.get('MONGODB_VIDEOS_URI'))
+        mongo_mp3 = AsyncIOMotorClient(os.environ.get('MONGODB_MP3S_URI'))
         
         logger.debug("Initializing GridFS")
-        fs_videos = gridfs.GridFS(mongo_video.get_database())
-        fs_mp3s = gridfs.GridFS(mongo_mp3.get_database())
+        fs_videos = AsyncIOMotorGridFSBucket(mongo_video.get_database())
+        fs_mp3s = AsyncIOMotorGridFSBucket(mongo_mp3.get_database())
+        
+        try:
+            await listing.ensure_index(mongo_mp3.get_database().fs.files)
+        except Exception as e:
+            # Listing still works without the index, only slower
+            logger.error(f"Failed to create MP3 listing index: {str(e)}")
+        
+        try:
+            await resumable.ensure_indexes(mongo_video.get_database())
+        except Exception as e:
+            logger.error(f"Failed to create resumable upload indexes: {str(e)}")
         
-        logger.info("Connecting to RabbitMQ", extra={'host': 'rabbitmq'})
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host="rabbitmq", heartbeat=0))
-        channel = connection.channel()
+        # One fs.files watcher per process feeds every SSE client
+        file_events = FileEventBroadcaster(mongo_mp3.get_database().fs.files)
+        file_events.start()
+        
+        # One pooled keep-alive client for every call to auth-service
+        app.state.auth_client = auth_client.create_client()
+        # auth-service's public signing keys, fetched on first use
+        app.state.jwks = JWKSVerifier(
+            app.state.auth_client,
+            ttl=float(os.environ.get('JWKS_CACHE_TTL', 300)),
+            min_refresh=float(os.environ.get('JWKS_MIN_REFRESH', 30)),
+        )
+        # Remote validations arriving together share one /validate/batch call
+        app.state.auth_batcher = ValidationBatcher(app.state.auth_client) if BATCH_WINDOW > 0 else None
+        
+        # Owns the RabbitMQ connection; uploads only hand it messages
+        logger.info("Starting RabbitMQ publisher")
+        publisher = Publisher(queues=tiers.video_queues())
+        publisher.start()
         
         logger.info("Service initialization completed successfully")
         yield # The application runs while yielded
@@ -61,89 +99,84 @@ async def lifespan(app: FastAPI):
     finally:
         # Shutdown logic
         logger.info("Shutting down service connections")
+        if file_events:
+            await file_events.stop()
+            logger.debug("SSE file watcher stopped")
         if mongo_video:
             mongo_video.close()
             logger.debug("MongoDB video connection closed")
         if mongo_mp3:
             mongo_mp3.close()
             logger.debug("MongoDB mp3 connection closed")
-        if connection and connection.is_open:
-            connection.close()
-            logger.debug("RabbitMQ connection closed")
+        if getattr(app.state, 'auth_batcher', None):
+            await app.state.auth_batcher.close()
+        if getattr(app.state, 'auth_client', None):
+            await app.state.auth_client.aclose()
+            logger.debug("Auth service client closed")
+        if publisher:
+            await publisher.stop()
+            logger.debug("RabbitMQ publisher stopped")
         logger.info("Service shutdown completed")
 
 # Initialize FastAPI app with lifespan manager
 app = FastAPI(title="Gateway Service", lifespan=lifespan)
+metrics.instrument_app(app)
+tracing.instrument_app(app)
 
 # --- SSE Endpoint for File Updates ---
-async def file_update_generator(request: Request):
+async def file_update_generator(last_event_id: Optional[str] = None):
     """
     Generator function for Server-Sent Events.
-    Periodically checks MongoDB for new MP3 files and sends updates.
+    Replays files missed since Last-Event-ID, then relays events from the
+    shared broadcaster until the client disconnects or falls too far behind.
     """
-    known_file_ids: Set[str] = set()
-    initial_check_done = False
+    sent_ids: Set[str] = set()
+    # Subscribe before replaying so nothing published meanwhile is lost
+    subscriber = file_events.subscribe()
 
     try:
-        while True:
-            # Check if client is still connected before doing work
-            if await request.is_disconnected():
-                logger.info("SSE client disconnected.")
-                break
-
-            current_file_ids = set()
-            new_files_found = []
-            try:
-                mp3_db = mongo_mp3.get_database()
-                cursor = mp3_db.fs.files.find({}, {"_id": 1, "filename": 1})
-                
-                for doc in cursor:
-                    file_id_str = str(doc["_id"])
-                    current_file_ids.add(file_id_str)
-                    
-                    # Only send updates for files not seen before, after the initial check
-                    if initial_check_done and file_id_str not in known_file_ids:
-                        new_files_found.append({
-                            "id": file_id_str,
-                            "filename": doc.get("filename", f"mp3_{file_id_str}")
-                        })
-                
-                # Update known files after processing all current files
-                known_file_ids = current_file_ids
-                initial_check_done = True # Mark initial population complete
+        if last_event_id:
+            missed = await file_events.backfill(last_event_id)
+            logger.info(f"SSE: Resuming after {last_event_id}, replaying {len(missed)} files")
+            for file_data in missed:
+                sent_ids.add(file_data["id"])
+                yield {"id": file_data["id"], "data": json.dumps(file_data)}
 
-                # Send events for newly found files
-                if new_files_found:
-                    for file_data in new_files_found:
-                         logger.info(f"SSE: Sending update for new file: {file_data['filename']} ({file_data['id']})")
-                         # Send data as JSON string
-                         yield json.dumps(file_data) 
+        overflow = asyncio.create_task(subscriber.overflowed.wait())
+        try:
+            while True:
+                next_event = asyncio.create_task(subscriber.queue.get())
+                done, _ = await asyncio.wait({next_event, overflow}, return_when=asyncio.FIRST_COMPLETED)
+                if next_event not in done:
+                    next_event.cancel()
+                    logger.warning("SSE: Client too slow, closing stream so it resumes via Last-Event-ID")
+                    break
 
-            except Exception as e:
-                logger.error(f"SSE: Error checking/sending MP3 file updates: {str(e)}")
-                # Optionally send an error event to the client
-                # yield json.dumps({"error": "Failed to check for updates"})
-                # Continue loop after error, maybe with backoff?
-
-            # Wait before checking again
-            await asyncio.sleep(5) # Check every 5 seconds
+                file_data = next_event.result()
+                if file_data["id"] in sent_ids:
+                    continue
+                logger.debug(f"SSE: Sending update for new file: {file_data['filename']} ({file_data['id']})")
+                yield {"id": file_data["id"], "data": json.dumps(file_data)}
+        finally:
+            overflow.cancel()
 
     except asyncio.CancelledError:
         logger.info("SSE connection cancelled.")
     except Exception as e:
         logger.error(f"SSE: Unhandled exception in generator: {str(e)}")
     finally:
+        file_events.unsubscribe(subscriber)
         logger.info("SSE generator finished.")
 
 
 @app.get("/events")
-async def sse_endpoint(request: Request):
+async def sse_endpoint(last_event_id: Optional[str] = Header(None)):
     """Endpoint for clients to subscribe to file update events."""
     logger.info("SSE client connected.")
     # Requires user to be logged in? Add Depends(validate.token) if needed.
     # For simplicity now, allow connection without strict auth check here,
     # but the download itself is still protected.
-    return EventSourceResponse(file_update_generator(request))
+    return EventSourceResponse(file_update_generator(last_event_id))
 # --- End SSE Endpoint ---
 
 # Mount static files directory (if it exists)
@@ -154,21 +187,13 @@ templates = Jinja2Templates(directory="templates")
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
-    """Serves the main HTML page and lists available MP3 files."""
+    """Serves the main HTML page with the first page of MP3 files; the rest load from /files."""
     logger.info("Root path requested, serving index.html")
     
     available_files = []
+    next_cursor = None
     try:
-        # Access the mp3s database and the fs.files collection
-        mp3_db = mongo_mp3.get_database()
-        # Query for all files in the mp3s GridFS collection, sort by uploadDate descending
-        # Project _id and filename fields
-        cursor = mp3_db.fs.files.find({}, {"_id": 1, "filename": 1}).sort("uploadDate", -1) # Added sort here
-        for doc in cursor:
-            available_files.append({
-                "id": str(doc["_id"]), # Convert ObjectId to string for template
-                "filename": doc.get("filename", f"mp3_{doc['_id']}") # Use filename or generate one
-            })
+        available_files, next_cursor = await listing.list_files(mongo_mp3.get_database().fs.files)
         logger.info(f"Found {len(available_files)} MP3 files to display.")
     except Exception as e:
         logger.error(f"Failed to retrieve MP3 file list from MongoDB: {str(e)}")
@@ -176,12 +201,35 @@ async def read_root(request: Request):
         
     return templates.TemplateResponse("index.html", {
         "request": request,
-        "mp3_files": available_files # Pass the list to the template
+        "mp3_files": available_files, # Pass the list to the template
+        "next_cursor": next_cursor
     })
 
+@app.get("/files")
+async def list_files_route(cursor: Optional[str] = Query(None),
+                           limit: int = Query(listing.PAGE_SIZE, ge=1, le=listing.MAX_PAGE_SIZE),
+                           if_none_match: Optional[str] = Header(None)):
+    """Newest-first page of MP3 files, continued with the returned next_cursor."""
+    try:
+        files, next_cursor = await listing.list_files(mongo_mp3.get_database().fs.files, limit, cursor)
+    except ValueError as e:
+        return JSONResponse(content={"detail": str(e)}, status_code=400)
+    except Exception as e:
+        logger.error(f"Failed to list MP3 files: {str(e)}")
+        raise HTTPException(status_code=500, detail="internal server error")
+    
+    etag = listing.page_etag(files, next_cursor)
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers={"ETag": etag})
+    
+    return JSONResponse(
+        content={"files": files, "next_cursor": next_cursor},
+        headers={"ETag": etag, "Cache-Control": "no-cache"}
+    )
+
 @app.post("/login")
 async def login_route(auth_result=Depends(access.login)):
-    request_id = os.urandom(8).hex()  # Generate a unique request ID
+    request_id = tracing.request_id()  # Trace id, shared by every service handling this request
     logger.info("Login request received", extra={'request_id': request_id})
     
     try:
@@ -207,10 +255,20 @@ async def debug_token(authorization: Optional[str] = Header(None)):
     # Return the token format for debugging
     return PlainTextResponse(f"Token received: {authorization}")
 
+# RabbitMQ publisher state and counters (pending, confirmed, rejected, dropped)
+@app.get("/debug-publisher")
+async def debug_publisher():
+    return publisher.stats()
+
+# Token cache counters (hits, misses, evictions)
+@app.get("/debug-token-cache")
+async def debug_token_cache():
+    return JSONResponse(content=validate.token_cache.stats())
+
 # Direct file upload - bypass auth for simplicity
 @app.post("/upload")
 async def upload_route(file: UploadFile = File(...)):
-    request_id = os.urandom(8).hex()  # Generate a unique request ID
+    request_id = tracing.request_id()  # Trace id, shared by every service handling this request
     logger.info("Direct upload request received", extra={'request_id': request_id})
     
     # Create a fake admin access for testing
@@ -227,7 +285,7 @@ async def upload_route(file: UploadFile = File(...)):
         })
         
         # Process file with direct admin access
-        err = await util.upload(file, fs_videos, channel, access_info)
+        err = await util.upload(file, fs_videos, publisher, access_info)
         
         if err:
             logger.error(f"Upload failed: {err}", extra={
@@ -243,9 +301,102 @@ async def upload_route(file: UploadFile = File(...)):
         logger.error(f"Upload exception: {str(e)}", extra={'request_id': request_id})
         raise HTTPException(status_code=500, detail="internal server error")
 
+# Resumable uploads (tus-style): create a session, PATCH bytes at the current
+# offset, HEAD to find the offset after an interruption, then finalize.
+# Like /upload, these use the direct admin access for now.
+def tus_headers(**headers):
+    return {"Tus-Resumable": resumable.TUS_VERSION, "Cache-Control": "no-store",
+            **{name.replace("_", "-").title(): str(value) for name, value in headers.items()}}
+
+@app.post("/uploads")
+async def create_upload_route(upload_length: int = Header(...), upload_metadata: Optional[str] = Header(None)):
+    try:
+        metadata = resumable.parse_metadata(upload_metadata)
+        session = await resumable.create_session(
+            mongo_video.get_database(), upload_length,
+            metadata.get("filename", "upload"), "admin@acn.com")
+    except resumable.UploadError as e:
+        return JSONResponse(content={"detail": e.detail}, status_code=e.status, headers=tus_headers())
+    
+    upload_id = str(session["_id"])
+    return Response(status_code=201, headers=tus_headers(
+        location=f"/uploads/{upload_id}", upload_offset=0, upload_length=upload_length))
+
+@app.head("/uploads/{upload_id}")
+async def upload_offset_route(upload_id: str):
+    try:
+        session = await resumable.get_session(mongo_video.get_database(), upload_id)
+    except resumable.UploadError as e:
+        return Response(status_code=e.status, headers=tus_headers())
+    return Response(status_code=200, headers=tus_headers(
+        upload_offset=session["offset"], upload_length=session["length"]))
+
+@app.patch("/uploads/{upload_id}")
+async def upload_chunk_route(upload_id: str, request: Request, upload_offset: int = Header(...),
+                             content_type: Optional[str] = Header(None)):
+    if content_type != "application/offset+octet-stream":
+        return JSONResponse(content={"detail": "Content-Type must be application/offset+octet-stream"},
+                            status_code=415, headers=tus_headers())
+    try:
+        offset = await resumable.append(mongo_video.get_database(), upload_id, upload_offset, request.stream())
+    except resumable.UploadError as e:
+        return JSONResponse(content={"detail": e.detail}, status_code=e.status, headers=tus_headers())
+    except Exception as e:
+        logger.error(f"Upload chunk failed: {str(e)}", extra={'upload_id': upload_id})
+        raise HTTPException(status_code=500, detail="internal server error")
+    return Response(status_code=204, headers=tus_headers(upload_offset=offset))
+
+@app.post("/uploads/{upload_id}/finalize")
+async def finalize_upload_route(upload_id: str):
+    request_id = tracing.request_id()  # Trace id, shared by every service handling this request
+    db = mongo_video.get_database()
+    try:
+        session = await resumable.get_session(db, upload_id)
+        if session["completed"] and session.get("queued", True):
+            # Retried finalize: the video was already queued
+            return JSONResponse(content={"video_fid": str(session["file_id"])})
+        if session["completed"]:
+            # Stored by an earlier finalize that could not queue it
+            fid, size, sha256, username, _ = await resumable.finalized_file(db, session)
+        else:
+            fid, size, sha256, username, _ = await resumable.finalize(db, upload_id)
+    except resumable.UploadError as e:
+        return JSONResponse(content={"detail": e.detail}, status_code=e.status)
+    except Exception as e:
+        logger.error(f"Upload finalize failed: {str(e)}", extra={'upload_id': upload_id})
+        raise HTTPException(status_code=500, detail="internal server error")
+    
+    # The video is only queued for conversion once all of it is stored. On
+    # failure the file and the session stay, so the client retries finalize
+    # instead of uploading again.
+    err = await util.enqueue_video(fid, size, sha256, username, fs_videos, publisher, request_id,
+                                   delete_on_error=False)
+    if err:
+        return JSONResponse(content=err[0], status_code=err[1])
+    try:
+        await resumable.mark_queued(db, session)
+    except Exception as e:
+        # A retried finalize queues the video again; the converter deduplicates it
+        logger.error(f"Failed to mark upload as queued: {str(e)}", extra={'upload_id': upload_id})
+    return JSONResponse(content={"video_fid": str(fid)})
+
+@app.delete("/uploads/{upload_id}")
+async def delete_upload_route(upload_id: str):
+    db = mongo_video.get_database()
+    try:
+        session = await resumable.get_session(db, upload_id)
+    except resumable.UploadError as e:
+        return Response(status_code=e.status, headers=tus_headers())
+    if session["completed"]:
+        return JSONResponse(content={"detail": "upload already finalized"}, status_code=409)
+    await resumable.delete_session(db, session)
+    return Response(status_code=204, headers=tus_headers())
+
 @app.get("/download")
-async def download_route(fid: str = Query(...), auth_result=Depends(validate.token)):
-    request_id = os.urandom(8).hex()  # Generate a unique request ID
+async def download_route(fid: str = Query(...), auth_result=Depends(validate.token),
+                         range_header: Optional[str] = Header(None, alias="Range"),
+                         if_range: Optional[str] = Header(None)):
+    request_id = tracing.request_id()  # Trace id, shared by every service handling this request
     logger.info("Download request received", extra={'request_id': request_id})
     
     try:
@@ -257,7 +408,6 @@ async def download_route(fid: str = Query(...), auth_result=Depends(validate.tok
             logger.warning(f"Token validation failed: {err}", extra={'request_id': request_id})
             return JSONResponse(content=err[0], status_code=err[1])
         
-        access_info = json.loads(access_info)
         username = access_info.get("username", "unknown")
         
         # Check admin status
@@ -278,20 +428,48 @@ async def download_route(fid: str = Query(...), auth_result=Depends(validate.tok
                     'file_id': fid
                 })
                 
-                out = fs_mp3s.get(ObjectId(fid))
+                out = await fs_mp3s.open_download_stream(ObjectId(fid))
+                etag, last_modified = util.file_validators(out)
+                headers = {
+                    "Content-Disposition": f"attachment; filename={fid}.mp3",
+                    "Accept-Ranges": "bytes",
+                    "ETag": etag,
+                    "Last-Modified": last_modified,
+                }
+                
+                try:
+                    byte_range = util.parse_range(range_header, out.length, if_range, etag, last_modified)
+                except ValueError as e:
+                    out.close()
+                    logger.warning(f"Unsatisfiable range: {str(e)}", extra={
+                        'request_id': request_id,
+                        'file_id': fid
+                    })
+                    headers["Content-Range"] = f"bytes */{out.length}"
+                    return Response(status_code=416, headers=headers)
+                
+                if byte_range is None:
+                    start, end, status_code = 0, out.length - 1, 200
+                else:
+                    start, end = byte_range
+                    status_code = 206
+                    headers["Content-Range"] = f"bytes {start}-{end}/{out.length}"
+                headers["Content-Length"] = str(end - start + 1)
                 
-                logger.info(f"File download successful", extra={
+                logger.info(f"File download started", extra={
                     'request_id': request_id,
-                    'file_id': fid
+                    'file_id': fid,
+                    'range_start': start,
+                    'range_end': end,
+                    'status_code': status_code
                 })
                 
-                # Create a bytes io stream from the GridFS file
-                file_like = io.BytesIO(out.read())
-                
+                # Stream GridFS chunks as they are read instead of loading the whole file
                 return StreamingResponse(
-                    file_like, 
+                    util.iter_file(out, start, end),
+                    status_code=status_code,
                     media_type="audio/mpeg",
-                    headers={"Content-Disposition": f"attachment; filename={fid}.mp3"}
+                    headers=headers
                 )
             
             except Exception as e:
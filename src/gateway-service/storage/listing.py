@@ -0,0 +1,69 @@
+import os, base64, hashlib, datetime
+from bson.objectid import ObjectId
+
+# Use absolute import for logger
+from src.common.log.custom_logger import get_custom_logger
+
+logger = get_custom_logger(service_name="gateway-storage")
+
+PAGE_SIZE = int(os.environ.get('FILES_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = 200
+
+# Supports the newest-first listing and the keyset cursor below
+LIST_INDEX = [("uploadDate", -1), ("_id", -1)]
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+async def ensure_index(files):
+    """Create the fs.files index the listing sorts and seeks on"""
+    name = await files.create_index(LIST_INDEX)
+    logger.info("MP3 listing index ready", extra={'index': name})
+
+def encode_cursor(doc):
+    """Opaque keyset cursor pointing just after `doc`"""
+    upload_date = doc["uploadDate"].replace(tzinfo=None)
+    millis = (upload_date - _EPOCH) // datetime.timedelta(milliseconds=1)
+    raw = f"{millis}:{doc['_id']}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor; raises ValueError for a malformed cursor"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        millis, file_id = raw.split(":", 1)
+        return _EPOCH + datetime.timedelta(milliseconds=int(millis)), ObjectId(file_id)
+    except Exception as e:
+        raise ValueError(f"invalid cursor: {cursor}") from e
+
+async def list_files(files, limit=PAGE_SIZE, cursor=None):
+    """
+    Return one newest-first page of MP3 files and the cursor of the next page
+    (None on the last page). Uses keyset pagination on (uploadDate, _id), so
+    every page costs the same index seek no matter how deep it is.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    query = {}
+    if cursor:
+        upload_date, file_id = decode_cursor(cursor)
+        query = {"$or": [
+            {"uploadDate": {"$lt": upload_date}},
+            {"uploadDate": upload_date, "_id": {"$lt": file_id}},
+        ]}
+
+    docs = await files.find(query, {"_id": 1, "filename": 1, "uploadDate": 1}) \
+        .sort(LIST_INDEX).limit(limit + 1).to_list(length=limit + 1)
+
+    next_cursor = encode_cursor(docs[limit - 1]) if len(docs) > limit else None
+    items = [{
+        "id": str(doc["_id"]),
+        "filename": doc.get("filename", f"mp3_{doc['_id']}"),
+    } for doc in docs[:limit]]
+    return items, next_cursor
+
+def page_etag(items, next_cursor):
+    """Weak ETag over the files on a page and where the next page starts"""
+    digest = hashlib.sha1()
+    for item in items:
+        digest.update(f"{item['id']}:{item['filename']}\n".encode())
+    digest.update((next_cursor or "").encode())
+    return f'W/"{digest.hexdigest()}"'
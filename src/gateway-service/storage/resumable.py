@@ -0,0 +1,262 @@
+import os, time, base64, hashlib, datetime
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from pymongo import ReturnDocument
+
+# Use absolute import for logger
+from src.common.log.custom_logger import get_custom_logger
+from src.common.metrics import prometheus as metrics
+
+logger = get_custom_logger(service_name="gateway-storage")
+
+# GridFS default chunk size; uploaded bytes are stored as fs.chunks of this size
+CHUNK_SIZE = 255 * 1024
+# Unfinished uploads are purged after this many seconds without a PATCH
+SESSION_TTL = float(os.environ.get('UPLOAD_SESSION_TTL', 24 * 60 * 60))
+# A PATCH still holding the session lock after this long is assumed dead
+LOCK_TTL = float(os.environ.get('UPLOAD_LOCK_TTL', 5 * 60))
+# Largest upload a session may be created for
+MAX_LENGTH = int(os.environ.get('UPLOAD_MAX_BYTES', 20 * 1024 ** 3))
+# Expired sessions cleaned up per session creation
+PURGE_BATCH = 20
+
+TUS_VERSION = "1.0.0"
+
+
+class UploadError(Exception):
+    """A request the upload session cannot accept; carries the HTTP status"""
+
+    def __init__(self, status, detail):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+
+
+async def ensure_indexes(db):
+    """Indexes for session expiry and for addressing chunks by (files_id, n)"""
+    await db.upload_sessions.create_index("expires")
+    await db["fs.chunks"].create_index([("files_id", 1), ("n", 1)], unique=True)
+    logger.info("Resumable upload indexes ready")
+
+
+def parse_metadata(header):
+    """Decode a tus Upload-Metadata header ("key base64value,...") into a dict"""
+    metadata = {}
+    for pair in (header or "").split(","):
+        key, _, value = pair.strip().partition(" ")
+        if not key:
+            continue
+        try:
+            metadata[key] = base64.b64decode(value).decode() if value else ""
+        except ValueError:
+            raise UploadError(400, f"invalid Upload-Metadata value for {key}")
+    return metadata
+
+
+async def create_session(db, length, filename, username):
+    """
+    Open an upload session for `length` bytes. The chunks are written under
+    a file id reserved now; the fs.files document only appears at finalize,
+    so GridFS readers never see a half-uploaded video.
+    """
+    if length <= 0 or length > MAX_LENGTH:
+        raise UploadError(413 if length > MAX_LENGTH else 400, f"Upload-Length must be between 1 and {MAX_LENGTH}")
+    await purge_expired(db)
+
+    now = time.time()
+    session = {
+        "_id": ObjectId(),
+        "file_id": ObjectId(),
+        "filename": filename,
+        "username": username,
+        "length": length,
+        "offset": 0,
+        "chunk_size": CHUNK_SIZE,
+        "completed": False,
+        # Set once the finalized video is in the publisher's outbox
+        "queued": False,
+        "lock": None,
+        "expires": now + SESSION_TTL,
+    }
+    await db.upload_sessions.insert_one(session)
+    logger.info("Upload session created", extra={
+        'upload_id': str(session["_id"]),
+        'file_id': str(session["file_id"]),
+        'bytes': length
+    })
+    return session
+
+
+async def get_session(db, upload_id):
+    try:
+        session = await db.upload_sessions.find_one({"_id": ObjectId(upload_id)})
+    except (InvalidId, TypeError):
+        session = None
+    if session is None or session["expires"] < time.time():
+        raise UploadError(404, "upload not found")
+    return session
+
+
+async def _lock(db, upload_id, match):
+    """Take the session lock if `match` holds; explain the failure otherwise"""
+    now = time.time()
+    token = os.urandom(8).hex()
+    try:
+        session_id = ObjectId(upload_id)
+    except (InvalidId, TypeError):
+        raise UploadError(404, "upload not found")
+    session = await db.upload_sessions.find_one_and_update(
+        {"_id": session_id, "expires": {"$gte": now}, "completed": False,
+         "$or": [{"lock": None}, {"lock.expires": {"$lt": now}}], **match},
+        {"$set": {"lock": {"token": token, "expires": now + LOCK_TTL}}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if session is not None:
+        return session, token
+
+    session = await get_session(db, upload_id)
+    if session["completed"]:
+        raise UploadError(409, "upload already finalized")
+    if "offset" in match and session["offset"] != match["offset"]:
+        raise UploadError(409, f"offset mismatch, upload is at {session['offset']}")
+    if "offset" not in match and session["offset"] != session["length"]:
+        raise UploadError(409, f"upload incomplete, {session['offset']} of {session['length']} bytes received")
+    raise UploadError(423, "another request is writing to this upload")
+
+
+async def _put_chunk(chunks, file_id, n, data):
+    started = time.perf_counter()
+    await chunks.replace_one({"files_id": file_id, "n": n},
+                             {"files_id": file_id, "n": n, "data": data}, upsert=True)
+    metrics.observe_gridfs("write", len(data), time.perf_counter() - started)
+
+
+async def append(db, upload_id, offset, stream):
+    """
+    Write the bytes of `stream` at `offset` straight into fs.chunks and
+    return the new offset.
+
+    Only one request may write to a session at a time, and only at the
+    session's current offset. Whatever arrived before the client went away
+    is kept, so the client resumes from the offset reported by HEAD. A chunk
+    left partially filled is completed by the next PATCH.
+    """
+    session, token = await _lock(db, upload_id, {"offset": offset})
+    chunks = db["fs.chunks"]
+    file_id, length, chunk_size = session["file_id"], session["length"], session["chunk_size"]
+
+    n, partial = divmod(offset, chunk_size)
+    buffer = bytearray()
+    if partial:
+        existing = await chunks.find_one({"files_id": file_id, "n": n})
+        buffer += existing["data"][:partial]
+    received = offset
+
+    try:
+        async for data in stream:
+            if received + len(data) > length:
+                raise UploadError(413, "data beyond Upload-Length")
+            buffer += data
+            received += len(data)
+            while len(buffer) >= chunk_size:
+                await _put_chunk(chunks, file_id, n, bytes(buffer[:chunk_size]))
+                del buffer[:chunk_size]
+                n += 1
+    finally:
+        persisted = n * chunk_size
+        # A full buffer means a whole-chunk write failed; the client re-sends
+        # from the last whole chunk rather than getting an oversized one
+        if buffer and len(buffer) < chunk_size:
+            try:
+                await _put_chunk(chunks, file_id, n, bytes(buffer))
+                persisted += len(buffer)
+            except Exception as e:
+                # Only whole chunks count; the client re-sends the rest
+                logger.error(f"Failed to store partial chunk: {str(e)}", extra={'upload_id': upload_id})
+        await db.upload_sessions.update_one(
+            {"_id": session["_id"], "lock.token": token},
+            {"$set": {"offset": persisted, "lock": None, "expires": time.time() + SESSION_TTL}},
+        )
+    return persisted
+
+
+async def finalize(db, upload_id):
+    """
+    Turn a fully received session into a GridFS file: verify the chunks,
+    compute the SHA-256 the converter deduplicates on and insert the
+    fs.files document. Returns (file_id, length, sha256, username, filename).
+    """
+    session, token = await _lock(db, upload_id, {"$expr": {"$eq": ["$offset", "$length"]}})
+    file_id, length, chunk_size = session["file_id"], session["length"], session["chunk_size"]
+    try:
+        digest = hashlib.sha256()
+        expected_n = 0
+        cursor = db["fs.chunks"].find({"files_id": file_id}).sort("n", 1)
+        async for chunk in cursor:
+            last = expected_n == (length - 1) // chunk_size
+            expected_size = length - expected_n * chunk_size if last else chunk_size
+            if chunk["n"] != expected_n or len(chunk["data"]) != expected_size:
+                raise UploadError(500, f"upload data is inconsistent at chunk {expected_n}")
+            digest.update(chunk["data"])
+            expected_n += 1
+        if expected_n * chunk_size < length:
+            raise UploadError(500, "upload data is incomplete")
+        sha256 = digest.hexdigest()
+
+        await db["fs.files"].insert_one({
+            "_id": file_id,
+            "length": length,
+            "chunkSize": chunk_size,
+            "uploadDate": datetime.datetime.now(datetime.timezone.utc),
+            "filename": session["filename"],
+            "metadata": {"sha256": sha256},
+        })
+        await db.upload_sessions.update_one(
+            {"_id": session["_id"], "lock.token": token},
+            {"$set": {"completed": True, "lock": None}},
+        )
+    except BaseException:
+        await db.upload_sessions.update_one(
+            {"_id": session["_id"], "lock.token": token}, {"$set": {"lock": None}})
+        raise
+
+    logger.info("Upload finalized", extra={
+        'upload_id': upload_id,
+        'file_id': str(file_id),
+        'bytes': length,
+        'sha256': sha256
+    })
+    return file_id, length, sha256, session["username"], session["filename"]
+
+
+async def finalized_file(db, session):
+    """
+    (file_id, length, sha256, username, filename) of a finalized session,
+    for queuing it again after the first attempt failed
+    """
+    files = await db["fs.files"].find_one({"_id": session["file_id"]}, {"metadata": 1})
+    if files is None:
+        raise UploadError(500, "finalized upload has no file")
+    return (session["file_id"], session["length"], files["metadata"]["sha256"],
+            session["username"], session["filename"])
+
+
+async def mark_queued(db, session):
+    await db.upload_sessions.update_one({"_id": session["_id"]}, {"$set": {"queued": True}})
+
+
+async def delete_session(db, session):
+    """Drop a session, and its chunks unless they became a finalized file"""
+    if not session["completed"]:
+        await db["fs.chunks"].delete_many({"files_id": session["file_id"]})
+    await db.upload_sessions.delete_one({"_id": session["_id"]})
+
+
+async def purge_expired(db):
+    cursor = db.upload_sessions.find({"expires": {"$lt": time.time()}}).limit(PURGE_BATCH)
+    async for session in cursor:
+        await delete_session(db, session)
+        logger.info("Expired upload session purged", extra={
+            'upload_id': str(session["_id"]),
+            'completed': session["completed"]
+        })
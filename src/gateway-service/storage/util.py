@@ -1,5 +1,9 @@
-import pika, json, os, sys
+import json, os, sys, time, datetime, hashlib
+from email.utils import format_datetime
 from fastapi import UploadFile
+from src.common.queues import tiers
+from src.common.metrics import prometheus as metrics
+from src.common.tracing import otel as tracing
 
 # Use absolute import for logger
 from src.common.log.custom_logger import get_custom_logger
@@ -7,9 +11,121 @@ from src.common.log.custom_logger import get_custom_logger
 # Initialize logger
 logger = get_custom_logger(service_name="gateway-storage")
 
-async def upload(f: UploadFile, fs, channel, access):
+# Bytes read from the UploadFile per iteration. Kept a multiple of the GridFS
+# chunk size (255 KiB) so every write fills whole chunks.
+UPLOAD_READ_SIZE = int(os.environ.get('UPLOAD_READ_SIZE', 4 * 255 * 1024))
+
+async def stream_to_gridfs(f: UploadFile, fs, file_name, read_size=UPLOAD_READ_SIZE):
+    """
+    Copy an UploadFile into a GridFS upload stream in bounded chunks.
+
+    Only one read buffer is held at a time, so memory per upload stays
+    constant regardless of the file size. A SHA-256 of the content is computed
+    on the way through and stored in the file's metadata, so the converter can
+    recognise re-uploads. Returns (file_id, bytes_written, elapsed_seconds,
+    sha256). The partially written file is aborted on failure.
+    """
+    grid_in = fs.open_upload_stream(file_name)
+    digest = hashlib.sha256()
+    total = 0
+    started = time.perf_counter()
+    try:
+        while True:
+            chunk = await f.read(read_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            await grid_in.write(chunk)
+            total += len(chunk)
+        await grid_in.set("metadata", {"sha256": digest.hexdigest()})
+        await grid_in.close()
+    except Exception:
+        await grid_in.abort()
+        raise
+    elapsed = time.perf_counter() - started
+    metrics.observe_gridfs("write", total, elapsed)
+    return grid_in._id, total, elapsed, digest.hexdigest()
+
+# Bytes handed to the response per iteration when streaming a download.
+DOWNLOAD_READ_SIZE = int(os.environ.get('DOWNLOAD_READ_SIZE', 255 * 1024))
+
+def file_validators(grid_out):
+    """Return the (ETag, Last-Modified) header values for a GridFS file."""
+    etag = f'"{grid_out.md5 or grid_out._id}"'
+    upload_date = grid_out.upload_date
+    if upload_date.tzinfo is None:
+        upload_date = upload_date.replace(tzinfo=datetime.timezone.utc)
+    return etag, format_datetime(upload_date, usegmt=True)
+
+def parse_range(range_header, length, if_range=None, etag=None, last_modified=None):
+    """
+    Resolve a Range request against a file of `length` bytes.
+
+    Returns None when the whole file should be served (no Range header,
+    a stale If-Range validator, a malformed range, which RFC 9110 says to
+    ignore, or a multi-range request, which we do not support), (start, end)
+    with an inclusive end for a satisfiable single range, and raises
+    ValueError when a well-formed range cannot be satisfied.
+    """
+    if not range_header:
+        return None
+    if if_range and if_range.strip() not in (etag, last_modified):
+        return None
+
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+
+    first, sep, last = spec.strip().partition("-")
+    first, last = first.strip(), last.strip()
+    if not sep or not (first or last) or not all(part.isascii() and part.isdigit() for part in (first, last) if part):
+        return None
+    if first:
+        start = int(first)
+        end = int(last) if last else length - 1
+        if last and end < start:
+            return None
+    else:
+        # Suffix range: the final N bytes
+        suffix = int(last)
+        if suffix == 0:
+            raise ValueError(f"unsatisfiable range: {range_header}")
+        start = max(length - suffix, 0)
+        end = length - 1
+
+    if start >= length:
+        raise ValueError(f"unsatisfiable range: {range_header}")
+    return start, min(end, length - 1)
+
+async def iter_file(grid_out, start=0, end=None, read_size=DOWNLOAD_READ_SIZE):
+    """
+    Yield the bytes of a Motor GridFS file between start and end (inclusive)
+    as they are read from MongoDB, closing the file when done.
+    """
+    if end is None:
+        end = grid_out.length - 1
+    remaining = end - start + 1
+    sent = 0
+    # Only time spent reading from MongoDB, not waiting for the client
+    reading = 0.0
+    try:
+        grid_out.seek(start)
+        while remaining > 0:
+            started = time.perf_counter()
+            data = await grid_out.read(min(read_size, remaining))
+            reading += time.perf_counter() - started
+            if not data:
+                break
+            remaining -= len(data)
+            sent += len(data)
+            yield data
+    finally:
+        grid_out.close()
+        metrics.observe_gridfs("read", sent, reading)
+
+async def upload(f: UploadFile, fs, publisher, access):
     username = access.get("username", "unknown")
-    request_id = os.urandom(8).hex()  # Generate a unique request ID for this upload
+    request_id = tracing.request_id()  # Trace id, shared by every service handling this upload
     
     file_name = f.filename
     
@@ -20,14 +136,17 @@ async def upload(f: UploadFile, fs, channel, access):
     })
     
     try:
-        logger.debug("Saving file to GridFS", extra={'request_id': request_id})
-        # Read the file content
-        content = await f.read()
-        fid = fs.put(content, filename=file_name)
+        logger.debug("Streaming file to GridFS", extra={'request_id': request_id})
+        with tracing.tracer.start_as_current_span("gridfs store"):
+            fid, size, elapsed, sha256 = await stream_to_gridfs(f, fs, file_name)
         
         logger.info("File saved to GridFS", extra={
             'request_id': request_id,
-            'file_id': str(fid)
+            'file_id': str(fid),
+            'bytes': size,
+            'duration_seconds': round(elapsed, 3),
+            'bytes_per_second': int(size / elapsed) if elapsed > 0 else size,
+            'sha256': sha256
         })
         
     except Exception as err:
@@ -37,28 +156,40 @@ async def upload(f: UploadFile, fs, channel, access):
         })
         return "internal server error, fs level", 500
 
+    return await enqueue_video(fid, size, sha256, username, fs, publisher, request_id)
+
+async def enqueue_video(fid, size, sha256, username, fs, publisher, request_id, delete_on_error=True):
+    """
+    Queue a stored video for conversion. Returns None, or an (error, status)
+    tuple when it could not be queued; the video is deleted then unless
+    `delete_on_error` is False.
+    """
     # Prepare message for video processing queue
     message = {
         "video_fid": str(fid),
         "mp3_fid": None,
         "username": username,
+        "sha256": sha256,
+        "size": size,
     }
+    # Small videos go to a queue the converter serves more often, so short
+    # clips are not stuck behind long videos
+    tier = tiers.tier_for_size(size)
+    video_queue = tiers.queue_name(tier)
 
     try:
         logger.info("Publishing message to video queue", extra={
             'request_id': request_id,
             'file_id': str(fid),
-            'queue': 'video'
+            'queue': video_queue,
+            'bytes': size
         })
         
-        channel.basic_publish(
-            exchange="",
-            routing_key="video",
-            body=json.dumps(message),
-            properties=pika.BasicProperties(
-                delivery_mode=pika.spec.PERSISTENT_DELIVERY_MODE
-            ),
-        )
+        # Only queued here; the publisher retries until the broker confirms.
+        # The trace context travels in the headers to the converter.
+        with tracing.producer_span(video_queue, video_fid=str(fid)) as headers:
+            if not publisher.publish(video_queue, json.dumps(message), headers):
+                raise RuntimeError("publish outbox is full")
         
         logger.info("Message published successfully", extra={
             'request_id': request_id,
@@ -74,11 +205,12 @@ async def upload(f: UploadFile, fs, channel, access):
             'error': str(err)
         })
         
-        # Cleanup: delete the file if message publishing fails
-        logger.debug(f"Cleaning up file from GridFS after queue error", extra={
-            'request_id': request_id,
-            'file_id': str(fid)
-        })
-        fs.delete(fid)
+        if delete_on_error:
+            # Cleanup: delete the file if message publishing fails
+            logger.debug(f"Cleaning up file from GridFS after queue error", extra={
+                'request_id': request_id,
+                'file_id': str(fid)
+            })
+            await fs.delete(fid)
         
-        return f"internal server error rabbitmq issue, {err}", 500
\ No newline at end of file
+        return f"service unavailable, rabbitmq issue: {err}", 503
\ No newline at end of file
@@ -1,38 +1,109 @@
-import pika, sys, os
+import pika, sys, os, time, functools, asyncio
+from concurrent.futures import ThreadPoolExecutor
 from send import email
+from send.pool import SMTPPool, SMTP_POOL_SIZE
 from src.common.log.custom_logger import get_custom_logger
+from src.common.metrics import prometheus as metrics
+from src.common.tracing import otel as tracing
+
+# Messages sent over one SMTP session per batch, and how long to wait for a
+# batch to fill up before sending what we have
+BATCH_SIZE = int(os.environ.get("NOTIFICATION_BATCH_SIZE", 20))
+BATCH_WINDOW_MS = int(os.environ.get("NOTIFICATION_BATCH_WINDOW_MS", 200))
+# Enough unacked messages for every pooled session to work on a full batch
+PREFETCH_COUNT = int(os.environ.get("NOTIFICATION_PREFETCH_COUNT", SMTP_POOL_SIZE * BATCH_SIZE))
+HEARTBEAT = int(os.environ.get("RABBITMQ_HEARTBEAT", 60))
+MP3_QUEUE = os.environ.get("MP3_QUEUE")
+# "asyncio" (aio_consumer) or "blocking" (the batched pika consumer below)
+CONSUMER_MODE = os.environ.get("NOTIFICATION_CONSUMER", "asyncio")
 
 def main(logger):
+    _, smtp_user, smtp_password = email.get_credentials(logger)
+    pool = SMTPPool(logger, smtp_user, smtp_password)
+    # One sender thread per pooled session
+    senders = ThreadPoolExecutor(max_workers=pool.size, thread_name_prefix="smtp")
+
     # rabbitmq connection
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host="rabbitmq",heartbeat=0))
+    connection = pika.BlockingConnection(pika.ConnectionParameters(host="rabbitmq", heartbeat=HEARTBEAT))
     channel = connection.channel()
+    channel.basic_qos(prefetch_count=PREFETCH_COUNT)
+
+    batch = []
+    flush_timer = None
+
+    def settle(ch, delivery_tag, received, span, error):
+        # Runs on the connection thread once the SMTP server answered
+        tracing.end_span(span, error)
+        metrics.QUEUE_IN_FLIGHT.labels(MP3_QUEUE).dec()
+        metrics.QUEUE_ACK_SECONDS.labels(MP3_QUEUE, "nack" if error else "ack").observe(time.monotonic() - received)
+        if not ch.is_open:
+            return
+        if error is None:
+            logger.info(f"Successfully processed message", extra={'message_id': delivery_tag})
+            ch.basic_ack(delivery_tag=delivery_tag)
+        else:
+            logger.error(f"Exception processing message: {str(error)}", extra={'message_id': delivery_tag})
+            ch.basic_nack(delivery_tag=delivery_tag)
+
+    def on_result(item, error):
+        # Runs on a sender thread, right after each message was accepted or rejected
+        ch, delivery_tag, received, span = item
+        connection.add_callback_threadsafe(functools.partial(settle, ch, delivery_tag, received, span, error))
+
+    def flush():
+        nonlocal batch, flush_timer
+        if flush_timer is not None:
+            connection.remove_timeout(flush_timer)
+            flush_timer = None
+        if batch:
+            logger.info("Sending notification batch", extra={'batch_size': len(batch)})
+            senders.submit(email.send_batch, logger, pool, batch, on_result)
+            batch = []
 
     def callback(ch, method, properties, body):
-        logger.info(f"Processing message: {body}", extra={'message_id': method.delivery_tag})
-        try:
-            email.notification(logger, body)
-            logger.info(f"Successfully processed message", extra={'message_id': method.delivery_tag})
-            ch.basic_ack(delivery_tag=method.delivery_tag)
-        except Exception as e:
-            logger.error(f"Exception processing message: {str(e)}", extra={'message_id': method.delivery_tag})
-            ch.basic_nack(delivery_tag=method.delivery_tag)
+        nonlocal flush_timer
+        logger.debug(f"Queued message for sending", extra={'message_id': method.delivery_tag})
+        metrics.QUEUE_IN_FLIGHT.labels(MP3_QUEUE).inc()
+        # Continues the converter's trace; ended once the message is settled,
+        # so it covers the wait for the batch and the send
+        span = tracing.start_consumer_span(MP3_QUEUE, properties.headers)
+        batch.append(((ch, method.delivery_tag, time.monotonic(), span), body))
+        if len(batch) >= BATCH_SIZE:
+            flush()
+        elif flush_timer is None:
+            flush_timer = connection.call_later(BATCH_WINDOW_MS / 1000, flush)
 
     channel.basic_consume(
-        queue=os.environ.get("MP3_QUEUE"), on_message_callback=callback
+        queue=MP3_QUEUE, on_message_callback=callback
     )
 
-    logger.info("Waiting for messages.")
-    channel.start_consuming()
+    logger.info("Waiting for messages.", extra={
+        'prefetch_count': PREFETCH_COUNT,
+        'batch_size': BATCH_SIZE,
+        'smtp_pool_size': pool.size
+    })
+    try:
+        channel.start_consuming()
+    finally:
+        senders.shutdown(wait=True)
+        pool.close()
 
 if __name__ == "__main__":
+    # Spans are exported to OTEL_EXPORTER_OTLP_ENDPOINT when it is set
+    tracing.setup("notification-service")
     logger = get_custom_logger(service_name="notification-service")
 
     try:
-        logger.info("Starting notification service")
-        main(logger)
+        logger.info("Starting notification service", extra={'mode': CONSUMER_MODE})
+        metrics.serve()
+        if CONSUMER_MODE == "blocking":
+            main(logger)
+        else:
+            import aio_consumer
+            asyncio.run(aio_consumer.main(logger))
     except KeyboardInterrupt:
         logger.info("Service interrupted by user")
         sys.exit(0)
     except Exception as e:
         logger.error(f"Unexpected error: {str(e)}")
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
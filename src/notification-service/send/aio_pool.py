@@ -0,0 +1,89 @@
+import asyncio, time
+import aiosmtplib
+from src.common.metrics import prometheus as metrics
+from src.common.tracing import otel as tracing
+from send.pool import SMTP_HOST, SMTP_PORT, SMTP_TIMEOUT, SMTP_POOL_SIZE, SMTP_HEALTHCHECK_IDLE, SMTP_LOGIN
+
+
+class AsyncSMTPPool:
+    """
+    asyncio counterpart of send.pool.SMTPPool: up to `size` logged-in
+    aiosmtplib sessions, NOOP-checked after being idle and replaced when
+    broken. `send` borrows a session for a single message.
+    """
+
+    def __init__(self, logger, user, password, host=SMTP_HOST, port=SMTP_PORT,
+                 size=SMTP_POOL_SIZE, healthcheck_idle=SMTP_HEALTHCHECK_IDLE):
+        self.logger = logger
+        self.user = user
+        self.password = password
+        self.host = host
+        self.port = port
+        self.size = size
+        self.healthcheck_idle = healthcheck_idle
+        self._idle = []
+        self._slots = asyncio.Semaphore(size)
+
+    async def _connect(self):
+        self.logger.info("Connecting to SMTP server", extra={'server': self.host, 'port': self.port})
+        smtp = aiosmtplib.SMTP(hostname=self.host, port=self.port, timeout=SMTP_TIMEOUT, start_tls=False)
+        await smtp.connect()
+        if SMTP_LOGIN:
+            try:
+                await smtp.login(self.user, self.password)
+            except Exception:
+                smtp.close()
+                raise
+        return smtp
+
+    async def _healthy(self, smtp, last_used):
+        if not smtp.is_connected:
+            return False
+        if time.monotonic() - last_used < self.healthcheck_idle:
+            return True
+        try:
+            response = await smtp.noop()
+            return response.code == 250
+        except aiosmtplib.SMTPException:
+            return False
+
+    @staticmethod
+    async def _quit(smtp):
+        try:
+            await smtp.quit()
+        except Exception:
+            smtp.close()
+
+    async def send(self, msg):
+        """Send one EmailMessage over a pooled session"""
+        async with self._slots:
+            smtp = None
+            while self._idle:
+                candidate, last_used = self._idle.pop()
+                if await self._healthy(candidate, last_used):
+                    smtp = candidate
+                    break
+                await self._quit(candidate)
+            if smtp is None:
+                smtp = await self._connect()
+
+            started = time.perf_counter()
+            metrics.SMTP_IN_FLIGHT.inc()
+            try:
+                with tracing.tracer.start_as_current_span("smtp send"):
+                    await smtp.send_message(msg)
+            except BaseException:
+                # Rejected, dropped, cancelled or timed out mid-transaction:
+                # the session state is unknown, so do not reuse it
+                smtp.close()
+                metrics.SMTP_SEND_SECONDS.labels("error").observe(time.perf_counter() - started)
+                raise
+            finally:
+                metrics.SMTP_IN_FLIGHT.dec()
+            metrics.SMTP_SEND_SECONDS.labels("sent").observe(time.perf_counter() - started)
+            self._idle.append((smtp, time.monotonic()))
+
+    async def close(self):
+        while self._idle:
+            smtp, _ = self._idle.pop()
+            await self._quit(smtp)
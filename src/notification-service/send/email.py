@@ -1,69 +1,98 @@
-import smtplib, os, json, sys
+import smtplib, os, json, sys, time
 from email.message import EmailMessage
+from send.pool import SMTP_LOGIN
+from src.common.metrics import prometheus as metrics
 
-def notification(logger, message):
-    try:
-        # Parse message
-        message_data = json.loads(message)
-        mp3_fid = message_data.get("mp3_fid")
-        receiver_address = message_data.get("username")
-        
-        logger.info("Processing notification request", extra={
-            'mp3_id': mp3_fid,
-            'recipient': receiver_address
-        })
-        
-        # Get email configuration
-        sender_address = os.environ.get("FROM_ADDRESS")
-        smtp_user = os.environ.get("SMTP_USER")
-        smtp_password = os.environ.get("SMTP_PASSWORD")
-        
-        if not sender_address or not smtp_user or not smtp_password:
-            logger.error("Missing email configuration", extra={
-                'has_address': bool(sender_address),
-                'has_smtp_user': bool(smtp_user),
-                'has_smtp_password': bool(smtp_password),
-            })
-            raise ValueError("Email configuration is incomplete")
-        
-        # Create email message
-        logger.debug("Creating email message")
-        msg = EmailMessage()
-        msg.set_content(f"mp3 file_id: {mp3_fid} is now ready!")
-        msg["Subject"] = "MP3 Download"
-        msg["From"] = sender_address
-        msg["To"] = receiver_address
-        
-        # Connect to SMTP server
-        logger.info("Connecting to SMTP server", extra={'server': "192.168.0.119"})
-        session = smtplib.SMTP("192.168.0.119", 25)
-        
-        # Log in to SMTP server
-        logger.debug("Logging in to SMTP server", extra={'user': smtp_user})
-        session.login(smtp_user, smtp_password)
-        
-        # Send email
-        logger.info("Sending email", extra={
-            'from': sender_address,
-            'to': receiver_address,
-            'mp3_id': mp3_fid
-        })
-        session.send_message(msg, sender_address, receiver_address)
-        
-        # Close connection
-        session.quit()
-        
-        logger.info("Email sent successfully", extra={
-            'mp3_id': mp3_fid,
-            'recipient': receiver_address
+def get_credentials(logger):
+    """Return (sender_address, smtp_user, smtp_password) from the environment"""
+    sender_address = os.environ.get("FROM_ADDRESS")
+    smtp_user = os.environ.get("SMTP_USER")
+    smtp_password = os.environ.get("SMTP_PASSWORD")
+
+    # Relays without AUTH only need the sender address
+    has_login = (smtp_user and smtp_password) or not SMTP_LOGIN
+    if not sender_address or not has_login:
+        logger.error("Missing email configuration", extra={
+            'has_address': bool(sender_address),
+            'has_smtp_user': bool(smtp_user),
+            'has_smtp_password': bool(smtp_password),
         })
-        
-    except json.JSONDecodeError as e:
-        logger.error(f"Invalid message format: {str(e)}")
-        raise
-    except smtplib.SMTPException as e:
-        logger.error(f"SMTP error: {str(e)}")
-        raise
+        raise ValueError("Email configuration is incomplete")
+    return sender_address, smtp_user, smtp_password
+
+def build_email(logger, message, sender_address):
+    """Parse a queue message and build the notification email for it"""
+    message_data = json.loads(message)
+    mp3_fid = message_data.get("mp3_fid")
+    receiver_address = message_data.get("username")
+
+    logger.info("Processing notification request", extra={
+        'mp3_id': mp3_fid,
+        'recipient': receiver_address
+    })
+
+    # Create email message
+    logger.debug("Creating email message")
+    msg = EmailMessage()
+    msg.set_content(f"mp3 file_id: {mp3_fid} is now ready!")
+    msg["Subject"] = "MP3 Download"
+    msg["From"] = sender_address
+    msg["To"] = receiver_address
+    return msg
+
+def send_batch(logger, pool, messages, on_result):
+    """
+    Send a batch of queue messages over one pooled SMTP session.
+
+    `on_result(item, error)` is called for every (item, body) pair as soon as
+    the server accepted (error None) or rejected the message, so callers can
+    ack each message individually. A dropped connection is reconnected once
+    and the message retried; if the session is still unusable, every message
+    not yet sent is reported with the error.
+    """
+    pending = list(messages)
+    try:
+        sender_address, _, _ = get_credentials(logger)
+
+        with pool.session() as session:
+            while pending:
+                item, body = pending[0]
+                try:
+                    msg = build_email(logger, body, sender_address)
+                except Exception as e:
+                    logger.error(f"Invalid message format: {str(e)}")
+                    pending.pop(0)
+                    on_result(item, e)
+                    continue
+
+                started = time.perf_counter()
+                metrics.SMTP_IN_FLIGHT.inc()
+                try:
+                    try:
+                        session.smtp.send_message(msg, sender_address, msg["To"])
+                    except smtplib.SMTPServerDisconnected:
+                        logger.warning("SMTP session dropped, reconnecting")
+                        pool.reconnect(session)
+                        session.smtp.send_message(msg, sender_address, msg["To"])
+                except smtplib.SMTPServerDisconnected:
+                    # Still unusable after reconnecting: give up on this session
+                    metrics.SMTP_SEND_SECONDS.labels("error").observe(time.perf_counter() - started)
+                    raise
+                except smtplib.SMTPException as e:
+                    metrics.SMTP_SEND_SECONDS.labels("error").observe(time.perf_counter() - started)
+                    logger.error(f"SMTP error: {str(e)}")
+                    pending.pop(0)
+                    on_result(item, e)
+                    continue
+                finally:
+                    metrics.SMTP_IN_FLIGHT.dec()
+                metrics.SMTP_SEND_SECONDS.labels("sent").observe(time.perf_counter() - started)
+
+                logger.info("Email sent successfully", extra={'recipient': msg["To"]})
+                pending.pop(0)
+                on_result(item, None)
+
     except Exception as e:
-        logger.error(f"Unexpected error sending notification: {str(e)}")
-        raise
\ No newline at end of file
+        logger.error(f"Failed to send notification batch: {str(e)}", extra={'unsent': len(pending)})
+        for item, _ in pending:
+            on_result(item, e)
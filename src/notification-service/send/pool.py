@@ -0,0 +1,129 @@
+import smtplib, os, time, queue, threading
+from contextlib import contextmanager
+
+SMTP_HOST = os.environ.get("SMTP_HOST", "192.168.0.119")
+SMTP_PORT = int(os.environ.get("SMTP_PORT", 25))
+SMTP_TIMEOUT = float(os.environ.get("SMTP_TIMEOUT", 30))
+# Authenticated sessions kept open at most
+SMTP_POOL_SIZE = int(os.environ.get("SMTP_POOL_SIZE", 4))
+# A session idle for longer than this is NOOP-checked before it is reused
+SMTP_HEALTHCHECK_IDLE = float(os.environ.get("SMTP_HEALTHCHECK_IDLE", 30))
+# Set to "false" for relays without AUTH, such as a local aiosmtpd test server
+SMTP_LOGIN = os.environ.get("SMTP_LOGIN", "true").lower() != "false"
+
+
+class PooledSession:
+    """An authenticated SMTP connection plus the time it was last used"""
+
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.last_used = time.monotonic()
+
+
+class SMTPPool:
+    """
+    Pool of logged-in SMTP sessions shared by the sender threads.
+
+    Sessions are opened lazily up to `size`, checked with NOOP when they have
+    been idle for a while, and replaced when they turn out to be broken, so
+    the TCP + AUTH handshake is paid once per session instead of per message.
+    """
+
+    def __init__(self, logger, user, password, host=SMTP_HOST, port=SMTP_PORT,
+                 size=SMTP_POOL_SIZE, healthcheck_idle=SMTP_HEALTHCHECK_IDLE):
+        self.logger = logger
+        self.user = user
+        self.password = password
+        self.host = host
+        self.port = port
+        self.size = size
+        self.healthcheck_idle = healthcheck_idle
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._closed = False
+
+    def _connect(self):
+        self.logger.info("Connecting to SMTP server", extra={'server': self.host, 'port': self.port})
+        smtp = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+        if not SMTP_LOGIN:
+            return PooledSession(smtp)
+        try:
+            self.logger.debug("Logging in to SMTP server", extra={'user': self.user})
+            smtp.login(self.user, self.password)
+        except Exception:
+            self._quit(smtp)
+            raise
+        return PooledSession(smtp)
+
+    @staticmethod
+    def _quit(smtp):
+        try:
+            smtp.quit()
+        except Exception:
+            smtp.close()
+
+    def _healthy(self, session):
+        if time.monotonic() - session.last_used < self.healthcheck_idle:
+            return True
+        try:
+            return session.smtp.noop()[0] == 250
+        except smtplib.SMTPException:
+            return False
+        except OSError:
+            return False
+
+    def acquire(self):
+        """Return a healthy session, opening or replacing one as needed"""
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    session = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if self._healthy(session):
+                    return session
+                self.logger.info("Discarding stale SMTP session")
+                self._quit(session.smtp)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, session, broken=False):
+        """Return a session to the pool; broken sessions are closed instead"""
+        try:
+            if broken or self._closed:
+                self._quit(session.smtp)
+            else:
+                session.last_used = time.monotonic()
+                self._idle.put(session)
+        finally:
+            self._slots.release()
+
+    def reconnect(self, session):
+        """Replace a session whose connection dropped, keeping its pool slot"""
+        self._quit(session.smtp)
+        fresh = self._connect()
+        session.smtp = fresh.smtp
+        session.last_used = fresh.last_used
+        return session
+
+    @contextmanager
+    def session(self):
+        session = self.acquire()
+        broken = False
+        try:
+            yield session
+        except (smtplib.SMTPServerDisconnected, OSError):
+            broken = True
+            raise
+        finally:
+            self.release(session, broken)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._quit(self._idle.get_nowait().smtp)
+            except queue.Empty:
+                return